@@ -1,7 +1,51 @@
-import os, time, math, tempfile
-from dataclasses import dataclass
-from mathutils import Matrix, Vector
-from . import sanitize_dmx
+import os, tempfile, shutil
+from dataclasses import dataclass, field
+from . import sanitize_dmx, metrics
+from .qc_parser import parse_qc, MESH_EXTENSIONS
+from .local_cache import get_cache_dir
+from .compile_cache import hash_file
+
+SANITISE_BACKENDS = ("native", "blender")
+# The native backend falls back to Blender if it can't handle a file
+sanitise_backend = "native"
+
+QC_TEMPLATE = '$modelname "{model_path}"\n{cdmaterials}$staticprop\n$model "studio" "{mesh_name}"\n$sequence idle "{mesh_name}" loop fps 1.00\n'
+# Converted materials are shared between all generated models, rather than duplicated for each one
+SHARED_CDMATERIALS = "models/hammer_minus/converted"
+LOD_TEMPLATE = '$lod {switch_point:g}\n{{\n\treplacemodel "studio" "{mesh_name}"\n}}\n'
+# (fraction of triangles to keep, switch point) for each LOD of a generated QC. None are generated by default.
+lods = []
+COLLISION_TEMPLATE = '$collisionmodel "{mesh_name}"\n{{\n\t$concave\n\t$maxconvexpieces {max_hulls}\n}}\n'
+# Whether generated QCs get a collision model made by convex decomposition
+collision = False
+COLLISION_MAX_HULLS = 16
+# Whether a DMX of several objects is compiled as a model for each top-level object
+split_meshes = False
+# Bump this whenever a change to sanitising would make previously sanitised meshes wrong
+SANITISED_FORMAT_VERSION = 1
+# How many sanitised meshes are kept for reuse, so a mesh isn't sanitised again when it's rebuilt unchanged
+SANITISED_CACHE_ENTRIES = 64
+SANITISED_TEMP_PREFIX = ".tmp"
+# Generated QCs can end up next to the mesh, so the daemon needs to be able to recognise and ignore them
+TEMP_QC_PREFIX = "hammer_minus_tmp_"
+
+
+def parse_lod(text: str) -> tuple[float, float]:
+    # For command line arguments: RATIO or RATIO:SWITCH_POINT
+    ratio, _, switch_point = text.partition(":")
+    ratio = float(ratio)
+    if not 0 < ratio < 1:
+        raise ValueError("LOD ratio must be between 0 and 1")
+    # Without a switch point, a LOD with half the triangles switches in at twice the distance, and so on
+    return ratio, float(switch_point) if switch_point else round(10 / ratio)
+
+
+def get_lod_mesh_name(mesh_name: str, index: int) -> str:
+    return "{}{}_lod{}".format(TEMP_QC_PREFIX, mesh_name, index + 1)
+
+
+def get_collision_mesh_name(mesh_name: str) -> str:
+    return "{}{}_physics".format(TEMP_QC_PREFIX, mesh_name)
 
 
 @dataclass
@@ -9,61 +53,34 @@ class CompileInputs:
     model_path: str
     mesh_paths: list[str]
     cdmaterials: str
+    extra_cdmaterials: list[str] = field(default_factory=list)
+    lods: list[tuple[float, float]] = field(default_factory=list)
+    collision: bool = False
 
-    _temp_meshes: list = list
+    _temp_meshes: list = field(default_factory=list)
 
     _pre_existing_qc: str or None = None
 
     @classmethod
     def from_qc_file(cls, path: str):
-        model_path = None
-        mesh_paths = []
-        cdmaterials = None
-        keyvalues = {}
-
         print("Parsing QC file:", path)
-        with open(path) as f:
-            for line in f:
-                tokens = line.split()
-                for i, token in enumerate(tokens):
-                    if token.startswith("//"):
-                        tokens = tokens[:i]
-                        break
-
-                if not tokens:
-                    continue
-
-                if tokens[0].startswith("$"):
-                    key = tokens[0][1:]
-                    if len(tokens) == 1:
-                        value = True
-                    if len(tokens) == 2:
-                        value = tokens[1].strip("\"")
-                    else:
-                        value = tuple(t.strip("\"") for t in tokens[1:])
-                    keyvalues[key] = value
-
-                    if key.lower() == "model":
-                        mesh_paths.append(tokens[2].strip("\""))
-                    elif key.lower() == "modelname":
-                        assert type(value) is str
-                        model_path = value
-                    elif key.lower() == "cdmaterials":
-                        assert type(value) is str
-                        cdmaterials = value
-                else:
-                    print("WARNING - ignoring line:", line.strip())
+        parsed_qc = parse_qc(path)
+        model_path = parsed_qc.get_value("modelname")
+        mesh_paths = parsed_qc.mesh_paths
+        cdmaterials = parsed_qc.get_values("cdmaterials")
 
         print(model_path)
         print(mesh_paths)
         print(cdmaterials)
-        print(keyvalues)
         if not all([model_path, mesh_paths, cdmaterials]):
             raise ValueError("Couldn't parse all necessary data from the QC!")
-        return cls(model_path, mesh_paths, cdmaterials, _pre_existing_qc=path)
+        return cls(
+            model_path, mesh_paths, cdmaterials[0], extra_cdmaterials=cdmaterials[1:], _pre_existing_qc=path
+        )
 
     @classmethod
-    def from_mesh_file(cls, path: str):
+    def from_mesh_file(cls, path: str, sanitised: bool = False):
+        # sanitised is for DMX files which have already been through sanitising, like the parts of a split one
         mesh_name, extension = os.path.splitext(os.path.basename(path))
 
         # TODO: more sensible defaults
@@ -73,19 +90,55 @@ class CompileInputs:
 
         # If it's a DMX, create a sanitized version first
         # TODO: check whether this is actually necessary depending on studiomdl's requirements
-        if extension.lower() == ".dmx":
+        if extension.lower() == ".dmx" and not sanitised:
             temp_meshes = [TemporarySanitisedDMX(path)]
             mesh_paths = []
         else:
             temp_meshes = []
             mesh_paths = [path]
 
-        return cls(model_path, mesh_paths, cdmaterials, _temp_meshes=temp_meshes)
+        return cls(
+            model_path,
+            mesh_paths,
+            cdmaterials,
+            extra_cdmaterials=[SHARED_CDMATERIALS],
+            lods=list(lods),
+            collision=collision,
+            _temp_meshes=temp_meshes,
+        )
 
     @property
     def model_name(self):
         return os.path.splitext(os.path.basename(self.model_path))[0]
 
+    @property
+    def source_mesh_paths(self) -> list[str]:
+        # The meshes as the user saved them, before any sanitising
+        return [temp_mesh._input_path for temp_mesh in self._temp_meshes] + self.mesh_paths
+
+    def get_qc_text(self) -> str:
+        if self._pre_existing_qc:
+            texts = []
+            for qc_path in [self._pre_existing_qc] + parse_qc(self._pre_existing_qc).included_paths:
+                with open(qc_path) as f:
+                    texts.append(f.read())
+            return "\n".join(texts)
+        mesh_name, _ = os.path.splitext(os.path.basename(self.source_mesh_paths[0]))
+        return self.format_qc(mesh_name)
+
+    def format_qc(self, mesh_name: str, lods: list[tuple[float, float]] = None, collision: bool = None) -> str:
+        cdmaterials = "".join(
+            "$cdmaterials {}\n".format(d) for d in [self.cdmaterials] + self.extra_cdmaterials
+        )
+        qc_text = QC_TEMPLATE.format(model_path=self.model_path, mesh_name=mesh_name, cdmaterials=cdmaterials)
+        for i, (ratio, switch_point) in enumerate(self.lods if lods is None else lods):
+            qc_text += LOD_TEMPLATE.format(switch_point=switch_point, mesh_name=get_lod_mesh_name(mesh_name, i))
+        if self.collision if collision is None else collision:
+            qc_text += COLLISION_TEMPLATE.format(
+                mesh_name=get_collision_mesh_name(mesh_name), max_hulls=COLLISION_MAX_HULLS
+            )
+        return qc_text
+
     # Returns a context manager, not the path itself
     def get_qc_with_dependencies(self):
         if self._pre_existing_qc:
@@ -106,29 +159,215 @@ class TemporaryButActuallyNotTemporaryFile:
         pass
 
 
+def get_sanitised_cache_path(input_path: str, clear_material_path: bool, name: str = "") -> str:
+    hasher = hash_file(input_path)
+    hasher.update("{} {} {}".format(SANITISED_FORMAT_VERSION, clear_material_path, name).encode())
+    return os.path.join(get_cache_dir("sanitised"), hasher.hexdigest())
+
+
+def _get_mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        # Evicted by someone else already
+        return 0.0
+
+
+def _remove_sanitised(path: str):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+def _store_sanitised(path: str, cache_path: str):
+    # Copied in under a unique temporary name and swapped in, since other threads and processes can be storing
+    # the same mesh at the same time
+    cache_dir = os.path.dirname(cache_path)
+    temp_path = None
+    try:
+        if os.path.isdir(path):
+            temp_path = tempfile.mkdtemp(dir=cache_dir, prefix=SANITISED_TEMP_PREFIX)
+            shutil.copytree(path, temp_path, dirs_exist_ok=True)
+        else:
+            handle, temp_path = tempfile.mkstemp(dir=cache_dir, prefix=SANITISED_TEMP_PREFIX)
+            os.close(handle)
+            shutil.copyfile(path, temp_path)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print("Couldn't cache sanitised mesh ({})".format(e))
+        if temp_path:
+            _remove_sanitised(temp_path)
+        return
+
+    # Entries can vanish while they're being looked at, when other processes evict at the same time
+    entries = [
+        os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if not name.startswith(SANITISED_TEMP_PREFIX)
+    ]
+    entries.sort(key=_get_mtime, reverse=True)
+    for entry in entries[SANITISED_CACHE_ENTRIES:]:
+        _remove_sanitised(entry)
+
+
+def _restore_sanitised(cache_path: str, output_path: str) -> bool:
+    # Copies a cached file, or a cached folder's files into output_path if it's a folder. An entry which is
+    # evicted part way through is just a miss.
+    try:
+        if os.path.isdir(output_path):
+            for name in os.listdir(cache_path):
+                shutil.copyfile(os.path.join(cache_path, name), os.path.join(output_path, name))
+        else:
+            shutil.copyfile(cache_path, output_path)
+    except OSError:
+        return False
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return True
+
+
 class TemporarySanitisedDMX:
-    def __init__(self, input_path: str, clear_material_path: bool = True):
+    def __init__(self, input_path: str, clear_material_path: bool = True, backend: str = None):
         self._input_path = input_path
         self._clear_material_path = clear_material_path
+        self._backend = backend or sanitise_backend
         mesh_name, extension = os.path.splitext(os.path.basename(self._input_path))
         mesh_name = mesh_name + "_" + next(tempfile._get_candidate_names())
-        self._output_path = os.path.join(os.path.dirname(self._input_path), mesh_name + ".dmx")
+        # Keep this out of the input directory, where the daemon would see it as a new mesh
+        self._output_path = os.path.join(tempfile.gettempdir(), mesh_name + ".dmx")
 
     def __enter__(self) -> str:
+        mesh_name, _ = os.path.splitext(os.path.basename(self._input_path))
+        cache_path = get_sanitised_cache_path(self._input_path, self._clear_material_path)
+        if _restore_sanitised(cache_path, self._output_path):
+            print("Using cached sanitised DMX for", self._input_path)
+            return self._output_path
         print("Sanitising DMX", self._input_path, "using temp path", self._output_path)
+        with metrics.stage("sanitise", mesh_name):
+            self._sanitise()
+        _store_sanitised(self._output_path, cache_path)
+        return self._output_path
+
+    def _sanitise(self):
+        if self._backend == "native":
+            from . import downconvert_dmx
+
+            try:
+                downconvert_dmx.downconvert_dmx(
+                    self._input_path, self._output_path, clear_material_path=self._clear_material_path
+                )
+                return
+            except Exception as e:
+                print("Native DMX conversion failed ({}), falling back to Blender".format(e))
         sanitize_dmx.external_sanitize_dmx(
             self._input_path, self._output_path, clear_material_path=self._clear_material_path
         )
-        return self._output_path
 
     def __exit__(self, exc_type, exc_value, traceback):
         os.remove(self._output_path)
 
 
+class TemporarySplitDMX:
+    # Sanitises a DMX into a file for each of its top-level objects, all in one go
+    def __init__(self, input_path: str, clear_material_path: bool = True, backend: str = None):
+        self._input_path = input_path
+        self._clear_material_path = clear_material_path
+        self._backend = backend or sanitise_backend
+        self._output_dir = None
+
+    def __enter__(self) -> list[str]:
+        # Returns the path of each part
+        self._output_dir = tempfile.mkdtemp(prefix=TEMP_QC_PREFIX)
+        mesh_name, _ = os.path.splitext(os.path.basename(self._input_path))
+        cache_path = get_sanitised_cache_path(self._input_path, self._clear_material_path, mesh_name)
+        if _restore_sanitised(cache_path, self._output_dir):
+            print("Using cached split DMX for", self._input_path)
+            return [os.path.join(self._output_dir, name) for name in sorted(os.listdir(self._output_dir))]
+        # Don't let parts of a failed restore get mixed up with the fresh ones
+        for name in os.listdir(self._output_dir):
+            os.remove(os.path.join(self._output_dir, name))
+        print("Splitting DMX", self._input_path, "into", self._output_dir)
+        with metrics.stage("sanitise", mesh_name):
+            part_paths = self._split(mesh_name)
+        _store_sanitised(self._output_dir, cache_path)
+        return part_paths
+
+    def _split(self, mesh_name: str) -> list[str]:
+        if self._backend == "native":
+            from . import downconvert_dmx
+
+            try:
+                parts = downconvert_dmx.downconvert_dmx_split(
+                    self._input_path, self._output_dir, mesh_name, clear_material_path=self._clear_material_path
+                )
+                return [path for _, path in parts]
+            except Exception as e:
+                print("Native DMX conversion failed ({}), falling back to Blender".format(e))
+        # Blender can't split it, so it's compiled as a single model instead
+        output_path = os.path.join(self._output_dir, mesh_name + ".dmx")
+        sanitize_dmx.external_sanitize_dmx(
+            self._input_path, output_path, clear_material_path=self._clear_material_path
+        )
+        return [output_path]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        shutil.rmtree(self._output_dir, ignore_errors=True)
+
+
 class TemporaryQCFile:
     def __init__(self, compile_inputs: CompileInputs):
         self._compile_inputs = compile_inputs
         self._path = None
+        # LOD and collision meshes written next to the QC
+        self._generated_paths = []
+
+    def _write_lods(self, directory: str, mesh_name: str) -> list[tuple[float, float]]:
+        # Returns the LODs which were written. A model without them is better than no model at all.
+        lods = self._compile_inputs.lods
+        if not lods:
+            return []
+        try:
+            from . import lod
+        except ImportError as e:
+            print("Can't generate LODs without NumPy ({})".format(e))
+            return []
+
+        try:
+            with metrics.stage("lod", self._compile_inputs.model_name):
+                cached_paths = lod.generate_lods(self._compile_inputs.source_mesh_paths[0], [r for r, _ in lods])
+        except Exception as e:
+            print("Couldn't generate LODs ({}), compiling without them".format(e))
+            return []
+        for i, cached_path in enumerate(cached_paths):
+            lod_path = os.path.join(directory, get_lod_mesh_name(mesh_name, i) + ".smd")
+            shutil.copyfile(cached_path, lod_path)
+            self._generated_paths.append(lod_path)
+        return lods
+
+    def _write_collision(self, directory: str, mesh_name: str) -> bool:
+        # Returns whether a collision model was written
+        if not self._compile_inputs.collision:
+            return False
+        try:
+            from . import collision
+        except ImportError as e:
+            print("Can't generate a collision model without NumPy ({})".format(e))
+            return False
+
+        try:
+            with metrics.stage("collision", self._compile_inputs.model_name):
+                cached_path = collision.generate_collision(self._compile_inputs.source_mesh_paths[0])
+        except Exception as e:
+            print("Couldn't generate a collision model ({}), compiling without one".format(e))
+            return False
+        collision_path = os.path.join(directory, get_collision_mesh_name(mesh_name) + ".smd")
+        shutil.copyfile(cached_path, collision_path)
+        self._generated_paths.append(collision_path)
+        return True
 
     def __enter__(self) -> str:
         # TODO: support multiple meshes
@@ -139,19 +378,15 @@ class TemporaryQCFile:
             mesh_path = self._compile_inputs.mesh_paths[0]
 
         mesh_name, _ = os.path.splitext(os.path.basename(mesh_path))
+        lods = self._write_lods(os.path.dirname(mesh_path), mesh_name)
+        has_collision = self._write_collision(os.path.dirname(mesh_path), mesh_name)
 
-        qc_template = '$modelname "{model_path}"\n$cdmaterials {cdmaterials}\n$staticprop\n$model "studio" "{mesh_name}"\n$sequence idle "{mesh_name}" loop fps 1.00\n'
-        qc_file = tempfile.NamedTemporaryFile(
-            mode="w", dir=os.path.dirname(mesh_path), suffix=".qc", delete=False
-        )
-        qc_file.write(
-            qc_template.format(
-                model_path=self._compile_inputs.model_path,
-                mesh_name=mesh_name,
-                cdmaterials=self._compile_inputs.cdmaterials,
+        with metrics.stage("qc", self._compile_inputs.model_name):
+            qc_file = tempfile.NamedTemporaryFile(
+                mode="w", dir=os.path.dirname(mesh_path), prefix=TEMP_QC_PREFIX, suffix=".qc", delete=False
             )
-        )
-        qc_file.close()
+            qc_file.write(self._compile_inputs.format_qc(mesh_name, lods, has_collision))
+            qc_file.close()
         print("Creating temporary QC file", qc_file.name)
         self._path = qc_file.name
 
@@ -159,5 +394,7 @@ class TemporaryQCFile:
 
     def __exit__(self, exc_type, exc_value, traceback):
         os.remove(self._path)
+        for generated_path in self._generated_paths:
+            os.remove(generated_path)
         for temp_mesh in self._compile_inputs._temp_meshes:
             temp_mesh.__exit__(None, None, None)
\ No newline at end of file
@@ -0,0 +1,167 @@
+import argparse, os, time, traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from . import crowbar_settings, compile_model, auto_qc
+from .auto_qc import CompileInputs, MESH_EXTENSIONS
+
+"""
+Compiles every model under a directory tree in one go: every QC, plus every mesh which isn't referenced by one
+of those QCs. Models are compiled in parallel across a process pool, a failure doesn't stop the rest of the
+batch, and a summary of the results is printed at the end.
+"""
+
+
+def find_batch_inputs(root: str, recursive: bool = True) -> list[str]:
+    qcs = []
+    meshes = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        if not recursive:
+            dir_names.clear()
+        for file_name in sorted(file_names):
+            if file_name.startswith(auto_qc.TEMP_QC_PREFIX):
+                continue
+            extension = os.path.splitext(file_name)[1].lower()
+            if extension == ".qc":
+                qcs.append(os.path.join(dir_path, file_name))
+            elif extension in MESH_EXTENSIONS:
+                meshes.append(os.path.join(dir_path, file_name))
+
+    referenced_meshes = set()
+    for qc in qcs:
+        try:
+            compile_inputs = CompileInputs.from_qc_file(qc)
+        except (OSError, ValueError) as e:
+            # Still try to compile it, so the error shows up in the summary
+            print("Couldn't read", qc, "-", e)
+            continue
+        referenced_meshes.update(os.path.normcase(os.path.abspath(p)) for p in compile_inputs.source_mesh_paths)
+
+    standalone_meshes = [m for m in meshes if os.path.normcase(os.path.abspath(m)) not in referenced_meshes]
+    return qcs + standalone_meshes
+
+
+def _compile_one(
+    path: str,
+    game,
+    addon_path: str,
+    convert_materials: bool,
+    use_cache: bool,
+    sanitise_backend: str,
+    lods: list,
+    collision: bool,
+    split_meshes: bool,
+    vpk_path: str,
+):
+    # Runs in a worker process. DEFAULT_GAME doesn't survive pickling, so None stands in for it.
+    auto_qc.sanitise_backend = sanitise_backend
+    auto_qc.lods = lods
+    auto_qc.collision = collision
+    auto_qc.split_meshes = split_meshes
+    start_time = time.perf_counter()
+    try:
+        compile_model.main(
+            path,
+            crowbar_settings.DEFAULT_GAME if game is None else game,
+            addon_path,
+            do_convert_materials=convert_materials and path.lower().endswith(".dmx"),
+            use_cache=use_cache,
+            vpk_path=vpk_path,
+        )
+        error = None
+    except Exception as e:
+        traceback.print_exc()
+        error = "{}: {}".format(type(e).__name__, e).splitlines()[0]
+    return path, error, time.perf_counter() - start_time
+
+
+def print_summary(root: str, results: list[tuple[str, str, float]]):
+    rows = [
+        (os.path.relpath(path, root), "FAILED" if error else "ok", "{:.1f}s".format(duration), error or "")
+        for path, error, duration in sorted(results)
+    ]
+    headings = ("Model", "Result", "Time", "Error")
+    widths = [max(len(row[i]) for row in rows + [headings]) for i in range(3)]
+
+    print()
+    print("  ".join(h.ljust(w) for h, w in zip(headings, widths)), headings[3])
+    for row in rows:
+        print("  ".join(c.ljust(w) for c, w in zip(row, widths)), row[3])
+    failures = sum(1 for _, error, _ in results if error)
+    print("\n{} compiled, {} failed".format(len(results) - failures, failures))
+
+
+def main(
+    root: str,
+    game=None,
+    addon_path: str = None,
+    convert_materials: bool = False,
+    jobs: int = None,
+    use_cache: bool = True,
+    vpk_path: str = None,
+) -> bool:
+    paths = find_batch_inputs(root)
+    print("Found", len(paths), "models to compile under", root)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(
+                _compile_one,
+                path,
+                game,
+                addon_path,
+                convert_materials,
+                use_cache,
+                auto_qc.sanitise_backend,
+                auto_qc.lods,
+                auto_qc.collision,
+                auto_qc.split_meshes,
+                vpk_path,
+            )
+            for path in paths
+        ]
+        for future in as_completed(futures):
+            results.append(future.result())
+
+    print_summary(root, results)
+    return all(error is None for _, error, _ in results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile every QC and standalone mesh under a directory")
+    parser.add_argument("path")
+    parser.add_argument("--game", default=None)
+    parser.add_argument("--addon-path", default=None)
+    parser.add_argument("--convert-materials", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--jobs", type=int, default=None, help="Number of models to compile at once (default: CPU count)")
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--dmx-backend", choices=auto_qc.SANITISE_BACKENDS, default=auto_qc.sanitise_backend)
+    parser.add_argument(
+        "--lods",
+        type=auto_qc.parse_lod,
+        nargs="*",
+        default=[],
+        metavar="RATIO[:SWITCH_POINT]",
+        help="Generate LODs keeping these fractions of the triangles (generated QCs only; needs NumPy)",
+    )
+    parser.add_argument(
+        "--collision",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Generate a collision model by convex decomposition (generated QCs only; needs NumPy)",
+    )
+    parser.add_argument(
+        "--split",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Compile each top-level object of a DMX as a model of its own",
+    )
+    parser.add_argument("--vpk", default=None, help="Publish into this VPK instead of as loose files")
+    args = parser.parse_args()
+
+    auto_qc.sanitise_backend = args.dmx_backend
+    auto_qc.lods = args.lods
+    auto_qc.collision = args.collision
+    auto_qc.split_meshes = args.split
+
+    success = main(args.path, args.game, args.addon_path, args.convert_materials, args.jobs, args.cache, args.vpk)
+    raise SystemExit(0 if success else 1)
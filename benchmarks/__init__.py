@@ -0,0 +1,6 @@
+"""
+Benchmarks for the whole pipeline, from a mesh being saved to the compiled model being published.
+Blender, studiomdl and Crowbar are replaced with stand-ins (see environment.py), so the benchmarks run anywhere
+and measure Hammer Minus's own overhead plus whatever tool delays you configure.
+Run them with `python -m hammer_minus.benchmarks`.
+"""
@@ -0,0 +1,289 @@
+import argparse, os, sys, json, time, shutil, subprocess, contextlib
+from .. import compile_model, auto_qc, metrics
+from ..local_cache import get_cache_dir
+from .environment import BenchmarkEnvironment, GAME_NAME
+from .synthetic import write_mesh
+
+"""
+Measures how long it takes from a mesh being saved to its model being published, both by calling
+compile_model.main directly and through a running minus_daemon, as well as how many models the daemon gets
+through when lots are saved at once. Results are appended to a file and compared against the previous run
+with the same settings, so regressions show up.
+"""
+
+PACKAGE_NAME = __package__.rsplit(".", 1)[0]
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_SIZES = (1000, 20000, 100000)
+DEFAULT_THRESHOLD = 0.1
+PUBLISH_TIMEOUT = 120.0
+
+
+def get_results_path() -> str:
+    return os.path.join(get_cache_dir("benchmarks"), "results.jsonl")
+
+
+def summarise(durations: list[float]) -> dict:
+    values = sorted(durations)
+    return {
+        "count": len(values),
+        "min": round(values[0], 4),
+        "median": round(metrics.percentile(values, 50), 4),
+        "p90": round(metrics.percentile(values, 90), 4),
+    }
+
+
+def save_mesh(environment: BenchmarkEnvironment, source_path: str, directory: str, mesh_name: str) -> float:
+    # Copy then rename, so watchers see the file appear all at once, like a finished export
+    temp_path = environment.path("input", mesh_name + ".part")
+    shutil.copyfile(source_path, temp_path)
+    saved_at = time.time()
+    os.replace(temp_path, os.path.join(directory, mesh_name + ".dmx"))
+    return saved_at
+
+
+def wait_for_published(environment: BenchmarkEnvironment, mesh_names: list[str], timeout: float = PUBLISH_TIMEOUT):
+    # Returns the time each model appeared, in the same order
+    remaining = {name: environment.published_model_path(name) for name in mesh_names}
+    published = {}
+    deadline = time.monotonic() + timeout
+    while remaining:
+        for name, path in list(remaining.items()):
+            if os.path.exists(path):
+                published[name] = time.time()
+                del remaining[name]
+        if time.monotonic() > deadline:
+            raise TimeoutError("Timed out waiting for {} to be published".format(", ".join(remaining)))
+        time.sleep(0.005)
+    return [published[name] for name in mesh_names]
+
+
+def benchmark_compile_model(environment: BenchmarkEnvironment, meshes: dict, runs: int) -> dict:
+    results = {}
+    directory = environment.path("input")
+    for size, source_path in meshes.items():
+        durations = []
+        cached_durations = []
+        for run in range(runs):
+            mesh_name = "direct_{}_{}".format(size, run)
+            saved_at = save_mesh(environment, source_path, directory, mesh_name)
+            mesh_path = os.path.join(directory, mesh_name + ".dmx")
+            compile_model.main(mesh_path, GAME_NAME, use_cache=True)
+            durations.append(time.time() - saved_at)
+
+            # Same inputs again, so this one comes out of the compile cache
+            start_time = time.time()
+            compile_model.main(mesh_path, GAME_NAME, use_cache=True)
+            cached_durations.append(time.time() - start_time)
+        results["compile_model/{}".format(size)] = summarise(durations)
+        results["compile_model_cached/{}".format(size)] = summarise(cached_durations)
+    return results
+
+
+@contextlib.contextmanager
+def run_daemon(environment: BenchmarkEnvironment, log_file, jobs: int, debounce: float):
+    watch_dir = environment.path("watch")
+    os.makedirs(watch_dir, exist_ok=True)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = PACKAGE_PARENT + os.pathsep + env.get("PYTHONPATH", "")
+    env["PYTHONUNBUFFERED"] = "1"
+    cmd_list = [
+        sys.executable,
+        "-m",
+        PACKAGE_NAME + ".minus_daemon",
+        "--path", watch_dir,
+        "--game", GAME_NAME,
+        "--no-start-mapping-tool",
+        # The stand-in studiomdl doesn't write real models, so there are no materials to find
+        "--no-convert-materials",
+        "--blender-workers", "0",
+        "--dmx-backend", auto_qc.sanitise_backend,
+        "--debounce", str(debounce),
+    ]
+    if jobs:
+        cmd_list += ["--jobs", str(jobs)]
+    process = subprocess.Popen(cmd_list, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    try:
+        yield watch_dir
+    finally:
+        process.kill()
+        process.wait()
+
+
+def benchmark_daemon(
+    environment: BenchmarkEnvironment, meshes: dict, runs: int, batch_size: int, log_file, jobs: int, debounce: float
+) -> dict:
+    results = {}
+    with run_daemon(environment, log_file, jobs, debounce) as watch_dir:
+        # There's no telling exactly when the daemon starts watching, so keep saving until it notices.
+        # This also gets it to import everything before anything is timed.
+        smallest = meshes[min(meshes)]
+        deadline = time.monotonic() + PUBLISH_TIMEOUT
+        while True:
+            save_mesh(environment, smallest, watch_dir, "warmup")
+            try:
+                wait_for_published(environment, ["warmup"], timeout=1.0)
+                break
+            except TimeoutError:
+                if time.monotonic() > deadline:
+                    raise
+
+        for size, source_path in meshes.items():
+            durations = []
+            for run in range(runs):
+                mesh_name = "daemon_{}_{}".format(size, run)
+                saved_at = save_mesh(environment, source_path, watch_dir, mesh_name)
+                [published_at] = wait_for_published(environment, [mesh_name])
+                durations.append(published_at - saved_at)
+            results["daemon/{}".format(size)] = summarise(durations)
+
+        mesh_names = ["throughput_{}".format(i) for i in range(batch_size)]
+        start_time = time.time()
+        for mesh_name in mesh_names:
+            save_mesh(environment, smallest, watch_dir, mesh_name)
+        published_times = wait_for_published(environment, mesh_names)
+        duration = max(published_times) - start_time
+        results["daemon_throughput/{}".format(min(meshes))] = {
+            "count": batch_size,
+            "seconds": round(duration, 4),
+            "models_per_second": round(batch_size / duration, 4),
+        }
+    return results
+
+
+def load_previous(results_path: str, settings: dict) -> dict or None:
+    previous = None
+    try:
+        with open(results_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("settings") == settings:
+                    previous = entry
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def compare(results: dict, previous: dict or None, threshold: float) -> list[str]:
+    regressions = []
+    print()
+    print("{:<32}{:>12}{:>12}{:>10}".format("Benchmark", "Result", "Previous", "Change"))
+    for name, result in results.items():
+        # Lower is better for latencies, higher is better for throughput
+        if "models_per_second" in result:
+            value, key, lower_is_better = result["models_per_second"], "models_per_second", False
+            unit = "/s"
+        else:
+            value, key, lower_is_better = result["median"], "median", True
+            unit = "s"
+        previous_value = (previous or {}).get("results", {}).get(name, {}).get(key)
+        if not previous_value:
+            print("{:<32}{:>12}{:>12}{:>10}".format(name, "{:.3f}{}".format(value, unit), "-", "-"))
+            continue
+        change = (value - previous_value) / previous_value
+        worse = change > threshold if lower_is_better else change < -threshold
+        print(
+            "{:<32}{:>12}{:>12}{:>+10.1%}{}".format(
+                name,
+                "{:.3f}{}".format(value, unit),
+                "{:.3f}{}".format(previous_value, unit),
+                change,
+                "  REGRESSION" if worse else "",
+            )
+        )
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def main(
+    sizes=DEFAULT_SIZES,
+    materials: int = 4,
+    runs: int = 5,
+    batch_size: int = 10,
+    jobs: int = None,
+    debounce: float = 0.5,
+    studiomdl_delay: float = 0.0,
+    studiomdl_delay_per_kb: float = 0.0,
+    blender_delay: float = 0.0,
+    include_daemon: bool = True,
+    threshold: float = DEFAULT_THRESHOLD,
+    results_path: str = None,
+) -> bool:
+    # Work this out before the benchmark environment moves the cache somewhere temporary
+    results_path = results_path or get_results_path()
+    settings = {
+        "sizes": list(sizes),
+        "materials": materials,
+        "runs": runs,
+        "batch_size": batch_size,
+        "jobs": jobs,
+        "debounce": debounce,
+        "studiomdl_delay": studiomdl_delay,
+        "studiomdl_delay_per_kb": studiomdl_delay_per_kb,
+        "blender_delay": blender_delay,
+        "dmx_backend": auto_qc.sanitise_backend,
+    }
+
+    with BenchmarkEnvironment(studiomdl_delay, studiomdl_delay_per_kb, blender_delay) as environment:
+        meshes = {}
+        for size in sizes:
+            meshes[size] = environment.path("mesh_{}.dmx.source".format(size))
+            write_mesh(meshes[size], size, materials)
+
+        log_path = environment.path("benchmark.log")
+        print("Running benchmarks in", environment.root)
+        with open(log_path, "w") as log_file:
+            # The pipeline is chatty, and the output would drown out the results
+            with contextlib.redirect_stdout(log_file):
+                results = benchmark_compile_model(environment, meshes, runs)
+            if include_daemon:
+                log_file.flush()
+                results.update(benchmark_daemon(environment, meshes, runs, batch_size, log_file, jobs, debounce))
+
+    previous = load_previous(results_path, settings)
+    regressions = compare(results, previous, threshold)
+    with open(results_path, "a") as f:
+        f.write(json.dumps({"time": time.time(), "settings": settings, "results": results}) + "\n")
+    print("\nResults appended to", results_path)
+    if previous is None:
+        print("No previous run with the same settings to compare against")
+    return not regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline using stand-ins for Blender and studiomdl")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Triangle counts of the meshes")
+    parser.add_argument("--materials", type=int, default=4, help="Number of materials in each mesh")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=10, help="Number of meshes saved at once for throughput")
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument("--debounce", type=float, default=0.5)
+    parser.add_argument("--studiomdl-delay", type=float, default=0.0, help="Seconds the studiomdl stand-in takes")
+    parser.add_argument("--studiomdl-delay-per-kb", type=float, default=0.0, help="Extra seconds per KB of mesh")
+    parser.add_argument("--blender-delay", type=float, default=0.0, help="Seconds the Blender stand-in takes")
+    parser.add_argument("--dmx-backend", choices=auto_qc.SANITISE_BACKENDS, default=auto_qc.sanitise_backend)
+    parser.add_argument("--daemon", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Fractional change counted as a regression")
+    parser.add_argument("--results", default=None, help="File to append results to")
+    args = parser.parse_args()
+
+    auto_qc.sanitise_backend = args.dmx_backend
+
+    success = main(
+        args.sizes,
+        args.materials,
+        args.runs,
+        args.batch_size,
+        args.jobs,
+        args.debounce,
+        args.studiomdl_delay,
+        args.studiomdl_delay_per_kb,
+        args.blender_delay,
+        args.daemon,
+        args.threshold,
+        args.results,
+    )
+    raise SystemExit(0 if success else 1)
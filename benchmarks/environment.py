@@ -0,0 +1,100 @@
+import os, sys, stat, shutil, tempfile
+from xml.etree import ElementTree
+from .. import crowbar_settings
+from . import stub_tools
+
+"""
+A throwaway setup for benchmarks to run in: Crowbar settings pointing at a fake game, stand-in studiomdl and
+Blender executables at the front of PATH, and a separate cache directory so real caches aren't touched.
+"""
+
+GAME_NAME = "Hammer Minus Benchmark"
+USER_NAME = "benchmark"
+
+
+def _write_executable(directory: str, name: str, tool: str) -> str:
+    script = os.path.abspath(stub_tools.__file__)
+    if os.name == "nt":
+        path = os.path.join(directory, name + ".cmd")
+        with open(path, "w") as f:
+            f.write('@"{}" "{}" {} %*\n'.format(sys.executable, script, tool))
+    else:
+        path = os.path.join(directory, name)
+        with open(path, "w") as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(sys.executable, script, tool))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def _write_crowbar_settings(path: str, game_info_path: str, studiomdl_path: str, output_dir: str):
+    root = ElementTree.Element("AppSettings")
+    game_setup = ElementTree.SubElement(ElementTree.SubElement(root, "GameSetups"), "GameSetup")
+    for tag, text in (
+        ("GameName", GAME_NAME),
+        ("GamePathFileName", game_info_path),
+        ("CompilerPathFileName", studiomdl_path),
+    ):
+        ElementTree.SubElement(game_setup, tag).text = text
+    ElementTree.SubElement(root, "SteamLibraryPaths")
+    for tag, text in (
+        ("CompileGameSetupSelectedIndex", "0"),
+        ("CompileOptionNoP4IsChecked", "True"),
+        ("CompileOutputFolderOption", "WorkFolder"),
+        ("CompileOutputFullPath", output_dir),
+    ):
+        ElementTree.SubElement(root, tag).text = text
+    ElementTree.ElementTree(root).write(path, encoding="utf-8", xml_declaration=True)
+
+
+class BenchmarkEnvironment:
+    def __init__(self, studiomdl_delay: float = 0.0, studiomdl_delay_per_kb: float = 0.0, blender_delay: float = 0.0):
+        self.delays = {
+            stub_tools.STUDIOMDL_DELAY_VARIABLE: studiomdl_delay,
+            stub_tools.STUDIOMDL_DELAY_PER_KB_VARIABLE: studiomdl_delay_per_kb,
+            stub_tools.BLENDER_DELAY_VARIABLE: blender_delay,
+        }
+        self.root = None
+        self._old_environ = None
+
+    def __enter__(self):
+        self.root = tempfile.mkdtemp(prefix="hammer_minus_benchmark_")
+        for directory in "bin", "appdata", "game", "addon", "cache", "input":
+            os.makedirs(self.path(directory))
+
+        studiomdl_path = _write_executable(self.path("bin"), "studiomdl", "studiomdl")
+        _write_executable(self.path("bin"), "blender", "blender")
+
+        game_info_path = self.path("game", "gameinfo.txt")
+        with open(game_info_path, "w") as f:
+            f.write('"GameInfo"\n{\n\tgame "%s"\n}\n' % GAME_NAME)
+
+        settings_dir = self.path("appdata", "ZeqMacaw", "Crowbar 0.74")
+        os.makedirs(settings_dir)
+        _write_crowbar_settings(
+            os.path.join(settings_dir, crowbar_settings.SETTINGS_FILE_NAME),
+            game_info_path,
+            studiomdl_path,
+            self.path("addon"),
+        )
+
+        self._old_environ = dict(os.environ)
+        os.environ.update({name: str(delay) for name, delay in self.delays.items()})
+        os.environ["APPDATA"] = self.path("appdata")
+        os.environ["USERNAME"] = USER_NAME
+        os.environ["HAMMER_MINUS_CACHE"] = self.path("cache")
+        os.environ["PATH"] = self.path("bin") + os.pathsep + os.environ.get("PATH", "")
+        # Settings may already have been loaded from the real Crowbar install
+        crowbar_settings._settings = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        os.environ.clear()
+        os.environ.update(self._old_environ)
+        crowbar_settings._settings = None
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def path(self, *parts: str) -> str:
+        return os.path.join(self.root, *parts)
+
+    def published_model_path(self, mesh_name: str) -> str:
+        return self.path("addon", "models", USER_NAME, mesh_name + ".mdl")
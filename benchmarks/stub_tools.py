@@ -0,0 +1,62 @@
+import os, re, sys, time, shutil
+
+"""
+Stand-ins for studiomdl and Blender. This is run as a plain script by the wrapper executables that
+environment.py writes, so it must only import from the standard library.
+Each tool sleeps for a configurable time, then produces the same outputs as the real thing would.
+"""
+
+STUDIOMDL_DELAY_VARIABLE = "HAMMER_MINUS_STUB_STUDIOMDL_DELAY"
+BLENDER_DELAY_VARIABLE = "HAMMER_MINUS_STUB_BLENDER_DELAY"
+# Roughly how long the real studiomdl spends per kilobyte of input mesh, on top of the fixed delay
+STUDIOMDL_DELAY_PER_KB_VARIABLE = "HAMMER_MINUS_STUB_STUDIOMDL_DELAY_PER_KB"
+
+
+def _get_delay(variable: str) -> float:
+    return float(os.environ.get(variable, "0"))
+
+
+def studiomdl(args: list[str]) -> int:
+    game_dir = args[args.index("-game") + 1]
+    qc_path = args[-1]
+    with open(qc_path) as f:
+        qc_text = f.read()
+
+    model_path = re.search(r'\$modelname\s+"?([^"\s]+)', qc_text).group(1)
+    mesh_size = 0
+    for mesh_name in re.findall(r'\$model\s+"?[^"\s]+"?\s+"?([^"\s]+)', qc_text):
+        mesh_path = os.path.join(os.path.dirname(qc_path), mesh_name)
+        for candidate in mesh_path, mesh_path + ".dmx", mesh_path + ".smd":
+            if os.path.isfile(candidate):
+                mesh_size += os.path.getsize(candidate)
+                break
+
+    time.sleep(_get_delay(STUDIOMDL_DELAY_VARIABLE) + _get_delay(STUDIOMDL_DELAY_PER_KB_VARIABLE) * mesh_size / 1024)
+
+    output_base = os.path.join(game_dir, "models", os.path.splitext(model_path)[0])
+    os.makedirs(os.path.dirname(output_base), exist_ok=True)
+    for extension in ".mdl", ".vvd", ".dx90.vtx":
+        with open(output_base + extension, "w") as f:
+            f.write(qc_text)
+        if extension == ".dx90.vtx":
+            print('Generating optimized mesh "{}":'.format(output_base + extension))
+        else:
+            print("writing {}:".format(output_base + extension))
+    return 0
+
+
+def blender(args: list[str]) -> int:
+    # Everything Blender itself would parse comes before the "--"
+    script_args = args[args.index("--") + 1 :]
+    if "--serve" in script_args:
+        print("The Blender stand-in doesn't support worker mode; run with --blender-workers 0")
+        return 1
+    input_path, output_path = script_args[:2]
+    time.sleep(_get_delay(BLENDER_DELAY_VARIABLE))
+    shutil.copyfile(input_path, output_path)
+    return 0
+
+
+if __name__ == "__main__":
+    tool = sys.argv[1]
+    raise SystemExit({"studiomdl": studiomdl, "blender": blender}[tool](sys.argv[2:]))
@@ -0,0 +1,62 @@
+import math
+from srctools.dmx import Element, Attribute, ValueType
+from srctools.math import Vec
+
+"""
+Generates DMX meshes shaped like Source 2 Hammer's exports: semantic vertex field names and full material paths.
+They're written as binary version 5, which is the newest srctools can write; the real exports use version 9.
+"""
+
+
+def build_mesh(name: str, triangles: int, materials: int = 1) -> Element:
+    # A square grid of quads, split into face sets round-robin so every material gets a share
+    size = max(1, math.ceil(math.sqrt(triangles / 2)))
+    positions = [Vec(x * 16, y * 16, 0) for y in range(size + 1) for x in range(size + 1)]
+    texture_coordinates = [(x / size, y / size) for y in range(size + 1) for x in range(size + 1)]
+
+    face_indices = [[] for _ in range(max(1, materials))]
+    vertex_indices = []
+    for quad in range(size * size):
+        x, y = quad % size, quad // size
+        corner = y * (size + 1) + x
+        for triangle in (corner, corner + 1, corner + size + 1), (corner + 1, corner + size + 2, corner + size + 1):
+            face = face_indices[quad % len(face_indices)]
+            face.extend(range(len(vertex_indices), len(vertex_indices) + 3))
+            face.append(-1)
+            vertex_indices.extend(triangle)
+
+    vertex_data = Element("bind", "DmeVertexData")
+    vertex_data["vertexFormat"] = ["position$0", "normal$0", "texcoord$0"]
+    vertex_data["position$0"] = positions
+    vertex_data["position$0Indices"] = vertex_indices
+    vertex_data["normal$0"] = [Vec(0, 0, 1)]
+    vertex_data["normal$0Indices"] = [0] * len(vertex_indices)
+    vertex_data["texcoord$0"] = Attribute.array("texcoord$0", ValueType.VEC2, texture_coordinates)
+    vertex_data["texcoord$0Indices"] = vertex_indices
+
+    face_sets = []
+    for i, faces in enumerate(face_indices):
+        material = Element("material{}".format(i), "DmeMaterial")
+        material["mtlName"] = "materials/benchmark/material{}.vmat".format(i)
+        face_set = Element("faceSet{}".format(i), "DmeFaceSet")
+        face_set["material"] = material
+        face_set["faces"] = faces
+        face_sets.append(face_set)
+
+    mesh = Element(name, "DmeMesh")
+    mesh["currentState"] = vertex_data
+    mesh["bindState"] = [vertex_data]
+    mesh["faceSets"] = face_sets
+    dag = Element(name, "DmeDag")
+    dag["shape"] = mesh
+    model = Element(name, "DmeModel")
+    model["children"] = [dag]
+    root = Element(name, "DmElement")
+    root["model"] = model
+    return root
+
+
+def write_mesh(path: str, triangles: int, materials: int = 1):
+    root = build_mesh("mesh", triangles, materials)
+    with open(path, "wb") as f:
+        root.export_binary(f, version=5, fmt_name="model", fmt_ver=22)
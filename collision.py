@@ -0,0 +1,147 @@
+import os, heapq, hashlib
+import numpy as np
+from .local_cache import get_cache_dir
+from .compile_cache import hash_file
+from .auto_qc import COLLISION_MAX_HULLS
+from .mesh_data import MeshData, read_mesh, write_smd, compute_vertex_normals, unique_rows
+
+"""
+Generates a collision model from a mesh by approximate convex decomposition. The mesh is split in two along its
+principal axis for as long as some part of it is too concave for a single hull, up to a limit on the number of
+hulls. Each hull is made of the mesh's most extreme points in a fixed set of directions, which caps how many
+vertices it has. Both limits keep the result cheap for vphysics.
+studiomdl builds the actual hulls itself from each connected piece of a $concave collision mesh, so each piece
+is written out as a fan of triangles through its points.
+Results are cached by a hash of the source mesh.
+"""
+
+# Bump this whenever a change here would make previously generated collision models wrong
+COLLISION_FORMAT_VERSION = 1
+MAX_HULLS = COLLISION_MAX_HULLS
+MAX_HULL_VERTICES = 32
+# How far a part's hull can reach out past its surface, relative to the part's size, before it gets split
+CONCAVITY_THRESHOLD = 0.05
+MATERIAL_NAME = "phy"
+
+
+def _fibonacci_directions(count: int) -> np.ndarray:
+    # Evenly spread unit vectors
+    i = np.arange(count) + 0.5
+    polar = np.arccos(1 - 2 * i / count)
+    azimuth = np.pi * (1 + 5**0.5) * i
+    return np.stack([np.cos(azimuth) * np.sin(polar), np.sin(azimuth) * np.sin(polar), np.cos(polar)], axis=1)
+
+
+class _Surface:
+    # The whole mesh, which every part refers into
+    def __init__(self, mesh: MeshData, directions: np.ndarray):
+        first_vertices, point_ids = unique_rows(mesh.positions)
+        self.points = mesh.positions[first_vertices].astype(np.float64)
+        self.triangle_points = point_ids[mesh.triangles]
+        corners = self.points[self.triangle_points]
+        self.centres = corners.mean(axis=1)
+        normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        self.normals = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+        self.directions = directions
+
+
+class _Part:
+    def __init__(self, surface: _Surface, triangles: np.ndarray):
+        # triangles are indices into the surface's triangles
+        self.triangles = triangles
+        self.point_indices = np.unique(surface.triangle_points[triangles])
+        part_points = surface.points[self.point_indices]
+        self.support_points = self.point_indices[np.unique(np.argmax(part_points @ surface.directions.T, axis=0))]
+
+        # A triangle of a convex part has nothing in front of it, so how far the hull reaches out past each
+        # triangle shows how badly the part is approximated by its hull. Measuring against the support points
+        # rather than every point keeps this cheap, at the cost of missing a little.
+        support = surface.points[self.support_points]
+        normals = surface.normals[triangles]
+        reach = np.max(normals @ support.T, axis=1) - np.einsum("ij,ij->i", normals, surface.centres[triangles])
+        size = float(np.linalg.norm(part_points.max(axis=0) - part_points.min(axis=0))) or 1.0
+        self.concavity = float(reach.max()) / size
+
+    def split(self, surface: _Surface) -> list["_Part"] or None:
+        if len(self.point_indices) < 8:
+            return None
+        centres = surface.centres[self.triangles]
+        mean = centres.mean(axis=0)
+        # The direction the part is longest in
+        _, _, components = np.linalg.svd(centres - mean, full_matrices=False)
+        side = (centres - mean) @ components[0] > 0
+        if side.all() or not side.any():
+            return None
+        return [_Part(surface, self.triangles[side]), _Part(surface, self.triangles[~side])]
+
+
+def decompose(
+    mesh: MeshData,
+    max_hulls: int = MAX_HULLS,
+    max_vertices: int = MAX_HULL_VERTICES,
+    concavity_threshold: float = CONCAVITY_THRESHOLD,
+) -> list[np.ndarray]:
+    # Returns the points of each hull
+    surface = _Surface(mesh, _fibonacci_directions(max_vertices))
+    parts = [_Part(surface, np.arange(mesh.triangle_count))]
+
+    # Always split the most concave part next
+    queue = [(-parts[0].concavity, 0)]
+    finished = []
+    while queue and len(finished) + len(queue) < max_hulls:
+        concavity, index = heapq.heappop(queue)
+        part = parts[index]
+        halves = part.split(surface) if -concavity > concavity_threshold else None
+        if halves is None:
+            finished.append(part)
+            continue
+        for half in halves:
+            parts.append(half)
+            heapq.heappush(queue, (-half.concavity, len(parts) - 1))
+
+    return [surface.points[part.support_points] for part in finished + [parts[i] for _, i in queue]]
+
+
+def build_collision_mesh(hulls: list[np.ndarray]) -> MeshData:
+    positions = []
+    triangles = []
+    offset = 0
+    for hull in hulls:
+        if len(hull) < 3:
+            continue
+        # Any triangles will do, as long as they connect all of a hull's points into one piece
+        fan = np.arange(1, len(hull) - 1)
+        triangles.append(np.stack([np.zeros_like(fan), fan, fan + 1], axis=1) + offset)
+        positions.append(hull)
+        offset += len(hull)
+
+    positions = np.concatenate(positions)
+    triangles = np.concatenate(triangles)
+    return MeshData(
+        positions,
+        compute_vertex_normals(positions, triangles),
+        np.zeros((len(positions), 2)),
+        triangles,
+        np.zeros(len(triangles), dtype=np.int32),
+        [MATERIAL_NAME],
+    )
+
+
+def get_collision_cache_path(source_hash: str) -> str:
+    settings = (COLLISION_FORMAT_VERSION, MAX_HULLS, MAX_HULL_VERTICES, CONCAVITY_THRESHOLD)
+    key = hashlib.sha256("{} {!r}".format(source_hash, settings).encode()).hexdigest()
+    return os.path.join(get_cache_dir("collision"), key + ".smd")
+
+
+def generate_collision(source_path: str) -> str:
+    # Returns the path of the collision SMD, which mustn't be modified
+    cache_path = get_collision_cache_path(hash_file(source_path).hexdigest())
+    if os.path.isfile(cache_path):
+        print("Using cached collision model for", source_path)
+        return cache_path
+
+    hulls = decompose(read_mesh(source_path))
+    print("Generated collision model for {} with {} hulls".format(source_path, len(hulls)))
+    write_smd(build_collision_mesh(hulls), cache_path)
+    return cache_path
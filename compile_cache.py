@@ -0,0 +1,164 @@
+import argparse, os, json, time, shutil, hashlib, tempfile
+from . import crowbar_settings
+from .local_cache import get_cache_dir
+
+"""
+Compiled models are cached by a hash of everything that goes into them: the source meshes, the QC text and
+the game setup. If none of that has changed since a previous compile, the output files are restored from the
+cache instead of running Blender and studiomdl again.
+The least recently used entries are evicted once the cache grows beyond its maximum size.
+"""
+
+# Bump this whenever a change to the pipeline would make previously cached output wrong
+CACHE_FORMAT_VERSION = 1
+DEFAULT_MAX_SIZE = 2 * 1024**3
+GAME_SETUP_KEYS = ("GameName", "GamePathFileName", "CompilerPathFileName")
+MANIFEST_NAME = "manifest.json"
+TEMP_SUFFIX = ".tmp"
+
+
+def get_entries_dir() -> str:
+    return get_cache_dir("compile_cache")
+
+
+def hash_file(path: str, hasher=None):
+    hasher = hasher or hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher
+
+
+def get_cache_key(compile_inputs, game_setup: dict) -> str:
+    hasher = hashlib.sha256()
+    hasher.update("version {}\n".format(CACHE_FORMAT_VERSION).encode())
+    for key in GAME_SETUP_KEYS:
+        hasher.update("{}={}\n".format(key, game_setup.get(key)).encode())
+    hasher.update("nop4={}\n".format(crowbar_settings.nop4).encode())
+    hasher.update(compile_inputs.get_qc_text().encode())
+    # The QC only has the LODs' switch points, not how much they're reduced by
+    hasher.update("lods={}\n".format(compile_inputs.lods).encode())
+    for mesh_path in compile_inputs.source_mesh_paths:
+        hasher.update(os.path.basename(mesh_path).encode())
+        if os.path.isfile(mesh_path):
+            hash_file(mesh_path, hasher)
+    return hasher.hexdigest()
+
+
+def _read_manifest(entry_dir: str) -> dict or None:
+    try:
+        with open(os.path.join(entry_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def restore(key: str, game_dir: str) -> set[str] or None:
+    entry_dir = os.path.join(get_entries_dir(), key)
+    manifest = _read_manifest(entry_dir)
+    if manifest is None:
+        return None
+
+    restored_files = set()
+    try:
+        for relative_path in manifest["files"]:
+            output_path = os.path.join(game_dir, relative_path)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            shutil.copy2(os.path.join(entry_dir, "files", relative_path), output_path)
+            restored_files.add(output_path)
+
+        # The manifest's mtime is what eviction goes by
+        os.utime(os.path.join(entry_dir, MANIFEST_NAME))
+    except OSError as e:
+        # Most likely evicted by another process part way through, so compile it after all
+        print("Couldn't restore {} from the compile cache ({})".format(manifest["model"], e))
+        return None
+    print("Restored", manifest["model"], "from the compile cache")
+    return restored_files
+
+
+def store(key: str, model_name: str, compiled_files: set[str], game_dir: str, max_size: int = DEFAULT_MAX_SIZE):
+    entry_dir = os.path.join(get_entries_dir(), key)
+    # Unique, since other threads and processes can be storing the same entry at once
+    temp_dir = tempfile.mkdtemp(dir=get_entries_dir(), prefix=key + TEMP_SUFFIX)
+
+    relative_paths = []
+    size = 0
+    try:
+        for compiled_file in compiled_files:
+            relative_path = os.path.relpath(os.path.abspath(compiled_file), os.path.abspath(game_dir))
+            cached_path = os.path.join(temp_dir, "files", relative_path)
+            os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+            shutil.copy2(compiled_file, cached_path)
+            relative_paths.append(relative_path)
+            size += os.path.getsize(cached_path)
+
+        manifest = {"model": model_name, "files": relative_paths, "size": size, "created": time.time()}
+        with open(os.path.join(temp_dir, MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f)
+    except OSError:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    try:
+        os.replace(temp_dir, entry_dir)
+    except OSError:
+        # Someone else stored it in the meantime, which is just as good
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    evict(max_size)
+
+
+def list_entries() -> list[tuple[str, dict, float]]:
+    entries = []
+    entries_dir = get_entries_dir()
+    for key in os.listdir(entries_dir):
+        if TEMP_SUFFIX in key:
+            # Still being stored
+            continue
+        entry_dir = os.path.join(entries_dir, key)
+        manifest = _read_manifest(entry_dir)
+        if manifest is not None:
+            try:
+                last_used = os.path.getmtime(os.path.join(entry_dir, MANIFEST_NAME))
+            except OSError:
+                # Evicted by someone else since
+                continue
+            entries.append((key, manifest, last_used))
+    return sorted(entries, key=lambda e: e[2], reverse=True)
+
+
+def evict(max_size: int = DEFAULT_MAX_SIZE):
+    total_size = 0
+    for key, manifest, last_used in list_entries():
+        total_size += manifest["size"]
+        if total_size > max_size:
+            print("Evicting", manifest["model"], "from the compile cache")
+            shutil.rmtree(os.path.join(get_entries_dir(), key), ignore_errors=True)
+
+
+def clear():
+    shutil.rmtree(get_entries_dir(), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or clear the compile cache")
+    parser.add_argument("command", choices=("list", "clear", "evict"), nargs="?", default="list")
+    parser.add_argument("--max-size", type=int, default=DEFAULT_MAX_SIZE, help="Size in bytes to evict down to")
+    args = parser.parse_args()
+
+    if args.command == "clear":
+        clear()
+        print("Cleared", get_entries_dir())
+    elif args.command == "evict":
+        evict(args.max_size)
+    else:
+        entries = list_entries()
+        for key, manifest, last_used in entries:
+            print(
+                "{}  {:<32} {:>10.1f} KB  last used {}".format(
+                    key[:12], manifest["model"], manifest["size"] / 1024, time.ctime(last_used)
+                )
+            )
+        total_size = sum(manifest["size"] for _, manifest, _ in entries)
+        print("{} entries, {:.1f} MB in {}".format(len(entries), total_size / 1024**2, get_entries_dir()))
@@ -1,7 +1,7 @@
-import argparse, os, subprocess, pathlib
-from . import crowbar_settings
+import argparse, os, subprocess, threading, tempfile, shutil, contextlib
+from concurrent.futures import ThreadPoolExecutor
+from . import crowbar_settings, auto_qc, compile_cache, metrics, vpk_publish
 from .auto_qc import CompileInputs
-from .convert_materials import convert_all_materials
 
 """
 We want to be able to compile a model as quickly and easily as possible.
@@ -12,41 +12,65 @@ If a QC is not supplied (in the path or its directory), one will be generated au
 """
 
 
-def get_compiled_files(studiomdl_output: str) -> set[str]:
-    lines = studiomdl_output.split("\n")
-    files = set()
-    for line in lines:
-        for prefix in "writing ", "Generating optimized mesh ":
-            if line.startswith(prefix):
-                path = line.lstrip(prefix)
-                path = path.lstrip("\"").rstrip("\":\r")
-                files.add(path)
-    return files
+class CompileCancelled(Exception):
+    pass
+
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise CompileCancelled()
+
+
+class StudiomdlError(Exception):
+    pass
 
 
-def move_compiled_files(compiled_files: set[str], game_path: str, destination: str):
-    print("Moving compiled files from {} to {}".format(game_path, destination))
+def get_compiled_file(line: str) -> str or None:
+    for prefix in "writing ", "Generating optimized mesh ":
+        if line.startswith(prefix):
+            path = line[len(prefix) :]
+            return path.strip().lstrip("\"").rstrip("\":")
+    return None
+
+
+def publish_compiled_files(compiled_files: set[str], game_path: str, destination: str):
+    """
+    Hammer++ hotloads a model as soon as its .mdl changes, so the whole set of output files is staged next to
+    the destination first and then swapped in together, .mdl last. Staging on the destination's volume means
+    the swap is a series of atomic renames even when the game and addon are on different drives.
+    """
+    print("Publishing compiled files from {} to {}".format(game_path, destination))
     game_path = os.path.abspath(game_path)
-    parts = pathlib.Path(game_path).parts
-    for input_path in compiled_files:
-        input_path_parts = pathlib.Path(os.path.abspath(input_path)).parts
-        same = 0
-        for i in range(len(parts)):
-            if input_path_parts[i] == parts[i]:
-                same += 1
+    same_volume = os.stat(game_path).st_dev == os.stat(destination).st_dev
+    staging_dir = tempfile.mkdtemp(prefix=".hammer_minus_staging_", dir=destination)
+
+    try:
+        staged_files = []
+        for input_path in compiled_files:
+            input_path = os.path.abspath(input_path)
+            relative_path = os.path.relpath(input_path, os.path.commonpath([input_path, game_path]))
+            staged_path = os.path.join(staging_dir, relative_path)
+            output_path = os.path.join(destination, relative_path)
+            os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+            if same_volume:
+                os.replace(input_path, staged_path)
             else:
-                break
+                shutil.copy2(input_path, staged_path)
+            staged_files.append((input_path, staged_path, output_path))
 
-        relative_path = os.path.join(*input_path_parts[same:])
-        output_path = os.path.join(destination, relative_path)
-        print("{} -> {}".format(input_path, output_path))
+        staged_files.sort(key=lambda f: f[2].lower().endswith(".mdl"))
+        for input_path, staged_path, output_path in staged_files:
+            print("{} -> {}".format(input_path, output_path))
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            if os.path.exists(output_path):
+                print("OVERWRITING", output_path)
+            os.replace(staged_path, output_path)
 
-        if not os.path.isdir(os.path.dirname(output_path)):
-            os.makedirs(os.path.dirname(output_path))
-        elif os.path.exists(output_path):
-            print("OVERWRITING", output_path)
-            os.remove(output_path)
-        os.rename(input_path, output_path)
+        if not same_volume:
+            for input_path, _, _ in staged_files:
+                os.remove(input_path)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
 
 def find_compile_inputs_from_path(path: str) -> CompileInputs:
@@ -56,11 +80,11 @@ def find_compile_inputs_from_path(path: str) -> CompileInputs:
             f for f in os.listdir(path) if f.lower().endswith(".smd") or f.lower().endswith(".dmx")
         ]
         if len(qcs) > 1:
-            raise FileExistsError("Folder contains more than one QC file")
+            raise FileExistsError("Folder contains more than one QC file; use batch_compile to compile them all")
         elif len(qcs) == 1:
             compile_inputs = CompileInputs.from_qc_file(os.path.join(path, qcs[0]))
         elif len(meshes) > 1:
-            raise FileExistsError("Folder contains more than one mesh")
+            raise FileExistsError("Folder contains more than one mesh; use batch_compile to compile them all")
         else:
             compile_inputs = CompileInputs.from_mesh_file(os.path.join(path, meshes[0]))
     else:
@@ -72,7 +96,7 @@ def find_compile_inputs_from_path(path: str) -> CompileInputs:
     return compile_inputs
 
 
-def compile_qc(qc_path: str, game_setup: dict) -> set[str]:
+def compile_qc(qc_path: str, game_setup: dict, cancel_event=None) -> set[str]:
     cmd_list = [
         game_setup["CompilerPathFileName"],
         "-game",
@@ -83,12 +107,198 @@ def compile_qc(qc_path: str, game_setup: dict) -> set[str]:
     cmd_list.append(qc_path)
 
     print(" ".join(cmd_list))
-    result = subprocess.run(cmd_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    result.check_returncode()
-    output = result.stdout.decode()
+    process = subprocess.Popen(
+        cmd_list,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        bufsize=1,
+    )
+
+    if cancel_event is not None:
+        def kill_when_cancelled():
+            while process.poll() is None:
+                if cancel_event.wait(0.1):
+                    process.kill()
+                    return
+
+        threading.Thread(target=kill_when_cancelled, daemon=True).start()
+
+    files = set()
+    error_line = None
+    with process.stdout:
+        for line in process.stdout:
+            line = line.rstrip("\r\n")
+            print(line, flush=True)
+            path = get_compiled_file(line)
+            if path:
+                files.add(path)
+            elif line.startswith("ERROR:"):
+                # studiomdl can carry on for a long time after a fatal error, so don't wait for it
+                error_line = line
+                process.kill()
+                break
+    return_code = process.wait()
+
+    check_cancelled(cancel_event)
+    if error_line:
+        raise StudiomdlError("studiomdl failed to compile {}: {}".format(qc_path, error_line))
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, cmd_list)
+    return files
+
+
+def strip_for_preview(compile_inputs: CompileInputs):
+    # Generated meshes take longer to make than the model takes to compile
+    compile_inputs.lods = []
+    compile_inputs.collision = False
+
+
+def needs_full_build(path: str, do_convert_materials: bool = False, vpk_path: str = None) -> bool:
+    # Whether a preview of the model leaves anything out
+    if do_convert_materials or vpk_path:
+        return True
+    if os.path.splitext(path)[1].lower() == ".qc":
+        return False
+    return bool(auto_qc.lods or auto_qc.collision)
+
+
+def build_model(compile_inputs: CompileInputs, game_setup: dict, cancel_event=None, use_cache: bool = True) -> set[str]:
+    # Returns the compiled files, which are left in the game directory
+    model_name = compile_inputs.model_name
+    game_dir = os.path.dirname(game_setup["GamePathFileName"])
+
+    compiled_files = None
+    if use_cache:
+        with metrics.stage("cache_restore", model_name):
+            cache_key = compile_cache.get_cache_key(compile_inputs, game_setup)
+            compiled_files = compile_cache.restore(cache_key, game_dir)
 
-    print(output)
-    return get_compiled_files(output)
+    if compiled_files is None:
+        print("Compiling", model_name, "for", game_setup["GameName"])
+        with compile_inputs.get_qc_with_dependencies() as qc_path:
+            check_cancelled(cancel_event)
+            with metrics.stage("studiomdl", model_name):
+                compiled_files = compile_qc(qc_path, game_setup, cancel_event)
+        if use_cache:
+            compile_cache.store(cache_key, model_name, compiled_files, game_dir)
+    return compiled_files
+
+
+def compile_and_publish(
+    compile_inputs: CompileInputs,
+    path: str,
+    game,
+    game_setup: dict,
+    addon_path: str = None,
+    do_convert_materials: bool = False,
+    cancel_event=None,
+    use_cache: bool = True,
+    servers: list[str] = None,
+    vpk_path: str = None,
+    preview: bool = False,
+) -> set[str]:
+    # Returns any files outside of the QC and meshes which the result depends on, i.e. parent materials
+    model_name = compile_inputs.model_name
+    if preview:
+        strip_for_preview(compile_inputs)
+    with metrics.stage("total", model_name), contextlib.ExitStack() as stack:
+        game_dir = os.path.dirname(game_setup["GamePathFileName"])
+        destination = vpk_publish.get_staging_dir(vpk_path) if vpk_path else addon_path
+
+        compiled_files = None
+        if servers:
+            from .compile_server import compile_remotely
+
+            # The files come back into a directory laid out like the game's, and are published from there
+            output_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix="hammer_minus_remote_"))
+            with metrics.stage("remote", model_name):
+                compiled_files = compile_remotely(
+                    servers, compile_inputs, game_setup["GameName"], output_dir, cancel_event, use_cache
+                )
+            if compiled_files is not None:
+                game_dir, destination = output_dir, destination or game_dir
+        if compiled_files is None:
+            compiled_files = build_model(compile_inputs, game_setup, cancel_event, use_cache)
+
+        # Don't publish anything once a newer version of the model is on its way
+        check_cancelled(cancel_event)
+        if destination:
+            with metrics.stage("publish", model_name):
+                publish_compiled_files(compiled_files, game_dir, destination)
+
+        dependencies = set()
+        check_cancelled(cancel_event)
+        if do_convert_materials and not preview:
+            # This pulls in most of srctools, so only import it when it's needed
+            from .convert_materials import convert_all_materials
+
+            with metrics.stage("materials", model_name):
+                # Materials for a VPK go in along with the model
+                dependencies = convert_all_materials(compile_inputs, path, game, destination if vpk_path else None)
+
+        if vpk_path and not preview:
+            with metrics.stage("vpk", model_name):
+                vpk_publish.pack(destination, vpk_path)
+        return dependencies
+
+
+def compile_split_dmx(
+    path: str,
+    game,
+    game_setup: dict,
+    addon_path: str = None,
+    do_convert_materials: bool = False,
+    cancel_event=None,
+    use_cache: bool = True,
+    servers: list[str] = None,
+    vpk_path: str = None,
+    preview: bool = False,
+) -> set[str]:
+    # Compiles a model for each top-level object in the DMX, all at once
+    destination = vpk_publish.get_staging_dir(vpk_path) if vpk_path else addon_path
+    with auto_qc.TemporarySplitDMX(path) as part_paths:
+        check_cancelled(cancel_event)
+        print("Compiling", len(part_paths), "models from", path)
+        parts = [CompileInputs.from_mesh_file(part_path, sanitised=True) for part_path in part_paths]
+
+        # studiomdl does the work in a process of its own, so threads are enough to run them side by side
+        with ThreadPoolExecutor(max_workers=min(len(parts), os.cpu_count() or 1)) as executor:
+            futures = [
+                executor.submit(
+                    compile_and_publish,
+                    compile_inputs,
+                    path,
+                    game,
+                    game_setup,
+                    # The VPK is packed once everything's in
+                    destination,
+                    False,
+                    cancel_event,
+                    use_cache,
+                    servers,
+                    preview=preview,
+                )
+                for compile_inputs in parts
+            ]
+        for future in futures:
+            future.result()
+
+    # The parts mostly share materials, so convert them one model at a time to avoid doing any twice at once
+    dependencies = set()
+    if do_convert_materials and not preview:
+        from .convert_materials import convert_all_materials
+
+        for compile_inputs in parts:
+            check_cancelled(cancel_event)
+            with metrics.stage("materials", compile_inputs.model_name):
+                dependencies |= convert_all_materials(compile_inputs, path, game, destination if vpk_path else None)
+
+    if vpk_path and not preview:
+        with metrics.stage("vpk", os.path.splitext(os.path.basename(path))[0]):
+            vpk_publish.pack(destination, vpk_path)
+    return dependencies
 
 
 def main(
@@ -96,7 +306,14 @@ def main(
     game=crowbar_settings.DEFAULT_GAME,
     addon_path: str = None,
     do_convert_materials: bool = False,
-):
+    cancel_event=None,
+    use_cache: bool = True,
+    servers: list[str] = None,
+    vpk_path: str = None,
+    preview: bool = False,
+) -> set[str]:
+    # Returns any files outside of the QC and meshes which the result depends on, i.e. parent materials.
+    # A preview is the model alone, without its materials, LODs or collision model, for when it's wanted quickly.
     addon_path = addon_path or crowbar_settings.compile_output_dir
     if addon_path and not os.path.isdir(addon_path):
         raise ValueError("Addon path", addon_path, "does not exist")
@@ -107,22 +324,11 @@ def main(
             raise ValueError("Converting materials for non-DMX meshes is currently unsupported")
 
     game_setup = crowbar_settings.get_game_setup(game)
+    args = (game, game_setup, addon_path, do_convert_materials, cancel_event, use_cache, servers, vpk_path, preview)
 
-    compile_inputs = find_compile_inputs_from_path(path)
-
-    print("Compiling", compile_inputs.model_name, "for", game_setup["GameName"])
-    with compile_inputs.get_qc_with_dependencies() as qc_path:
-        compiled_files = compile_qc(qc_path, game_setup)
-
-        if addon_path:
-            move_compiled_files(
-                compiled_files,
-                os.path.dirname(game_setup["GamePathFileName"]),
-                addon_path,
-            )
-
-        if do_convert_materials:
-            convert_all_materials(compile_inputs, path, game)
+    if auto_qc.split_meshes and os.path.isfile(path) and os.path.splitext(path)[1].lower() == ".dmx":
+        return compile_split_dmx(path, *args)
+    return compile_and_publish(find_compile_inputs_from_path(path), path, *args)
 
 
 if __name__ == "__main__":
@@ -132,6 +338,51 @@ if __name__ == "__main__":
     parser.add_argument("--game", default=crowbar_settings.DEFAULT_GAME)
     parser.add_argument("--addon-path", default=None)
     parser.add_argument('--convert-materials', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--dmx-backend", choices=auto_qc.SANITISE_BACKENDS, default=auto_qc.sanitise_backend)
+    parser.add_argument(
+        "--lods",
+        type=auto_qc.parse_lod,
+        nargs="*",
+        default=[],
+        metavar="RATIO[:SWITCH_POINT]",
+        help="Generate LODs keeping these fractions of the triangles (generated QCs only; needs NumPy)",
+    )
+    parser.add_argument(
+        "--collision",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Generate a collision model by convex decomposition (generated QCs only; needs NumPy)",
+    )
+    parser.add_argument(
+        "--split",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Compile each top-level object of a DMX as a model of its own",
+    )
+    parser.add_argument("--vpk", default=None, help="Publish into this VPK instead of as loose files")
+    parser.add_argument(
+        "--server", action="append", default=[], metavar="HOST:PORT", help="Compile on this compile server (repeatable)"
+    )
+    parser.add_argument("--server-token", default=None, help="Defaults to $HAMMER_MINUS_SERVER_TOKEN")
     args = parser.parse_args()
 
-    main(args.path, args.game, args.addon_path, args.convert_materials)
+    auto_qc.sanitise_backend = args.dmx_backend
+    auto_qc.lods = args.lods
+    auto_qc.collision = args.collision
+    auto_qc.split_meshes = args.split
+
+    if args.server_token:
+        from . import compile_server
+
+        compile_server.token = args.server_token
+
+    main(
+        args.path,
+        args.game,
+        args.addon_path,
+        args.convert_materials,
+        use_cache=args.cache,
+        servers=args.server,
+        vpk_path=args.vpk,
+    )
@@ -0,0 +1,138 @@
+import os, time, threading, traceback
+from collections import deque
+from typing import Callable
+from .compile_model import CompileCancelled
+from . import metrics
+
+"""
+Sits between the file watcher and the compiler so that compiles run in the background, several at a time.
+Events for a path which is already queued are merged into the queued job, and a newer save of a path which
+is currently compiling cancels that compile and queues a fresh one behind it.
+With previews on, each save is first compiled as a quick preview, and the full build follows once the preview
+is published. Full builds only start when no preview is waiting, so saving again is always seen to quickly.
+"""
+
+PREVIEW_PRIORITY = 0
+FULL_BUILD_PRIORITY = 1
+
+
+class CompileJob:
+    def __init__(self, path: str, preview: bool = False):
+        self.path = path
+        self.preview = preview
+        self.priority = PREVIEW_PRIORITY if preview else FULL_BUILD_PRIORITY
+        self.state = "queued"
+        self.cancel_event = threading.Event()
+        self.queued_at = time.monotonic()
+        self.started_at = None
+
+    @property
+    def name(self):
+        return os.path.basename(self.path) + (" preview" if self.preview else "")
+
+    def describe(self):
+        if self.started_at is None:
+            return "{} ({})".format(self.name, self.state)
+        return "{} ({}, {:.1f}s)".format(self.name, self.state, time.monotonic() - self.started_at)
+
+
+class CompileScheduler:
+    def __init__(
+        self,
+        compile_function: Callable[[str, threading.Event, bool], bool],
+        workers: int = None,
+        preview: bool = False,
+    ):
+        # compile_function(path, cancel_event, preview) returns whether a preview left anything out
+        self._compile_function = compile_function
+        self._preview = preview
+        self._order = deque()
+        self._queued = {}
+        self._running = {}
+        self._condition = threading.Condition()
+
+        workers = workers or os.cpu_count() or 1
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        print("Compile scheduler running with", workers, "workers")
+
+    def _print_status(self, message: str):
+        # Must be called with the lock held
+        print(
+            "[scheduler] {} - {} queued, {} running".format(message, len(self._queued), len(self._running))
+        )
+        for job in self._running.values():
+            print("[scheduler]   ", job.describe())
+
+    def submit(self, path: str):
+        with self._condition:
+            if path in self._queued and self._queued[path].preview == self._preview:
+                self._print_status("Merged new event into queued job for " + os.path.basename(path))
+                return
+
+            if path in self._queued:
+                # Only a full build can still be waiting, and it would be out of date
+                self._order.remove(path)
+            job = CompileJob(path, self._preview)
+            if path in self._running:
+                running_job = self._running[path]
+                running_job.cancel_event.set()
+                running_job.state = "cancelling"
+            self._queue(job)
+
+    def _queue(self, job: CompileJob):
+        # Must be called with the lock held
+        self._queued[job.path] = job
+        self._order.append(job.path)
+        self._print_status("Queued " + job.name)
+        self._condition.notify()
+
+    def _take_job(self) -> CompileJob:
+        # Must be called with the lock held. Paths which are still compiling have to wait their turn, and
+        # previews go first.
+        while True:
+            ready = [path for path in self._order if path not in self._running]
+            if ready:
+                path = min(ready, key=lambda p: self._queued[p].priority)
+                self._order.remove(path)
+                job = self._queued.pop(path)
+                self._running[path] = job
+                return job
+            self._condition.wait()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._take_job()
+                job.state = "compiling"
+                job.started_at = time.monotonic()
+                model_name = os.path.splitext(os.path.basename(job.path))[0]
+                metrics.record("queue", model_name, job.started_at - job.queued_at, preview=job.preview)
+                self._print_status(
+                    "Started {} after waiting {:.1f}s".format(job.name, job.started_at - job.queued_at)
+                )
+
+            incomplete = False
+            try:
+                incomplete = self._compile_function(job.path, job.cancel_event, job.preview)
+                job.state = "done"
+            except CompileCancelled:
+                job.state = "cancelled"
+            except Exception:
+                traceback.print_exc()
+                job.state = "failed"
+
+            with self._condition:
+                del self._running[job.path]
+                self._print_status(
+                    "Finished {} ({}) in {:.1f}s".format(job.name, job.state, time.monotonic() - job.started_at)
+                )
+                # A newer save which is already queued will get its own full build
+                if job.preview and job.state == "done" and incomplete and job.path not in self._queued:
+                    self._queue(CompileJob(job.path))
+                self._condition.notify_all()
+
+    @property
+    def queue_depth(self) -> int:
+        with self._condition:
+            return len(self._queued)
@@ -0,0 +1,321 @@
+import argparse, os, socket, threading, json, secrets, tempfile, shutil, traceback
+from multiprocessing.connection import Connection
+from . import crowbar_settings, auto_qc, sanitize_dmx
+from .auto_qc import CompileInputs
+from .compile_model import build_model, find_compile_inputs_from_path, check_cancelled, CompileCancelled
+from .dependency_graph import get_qc_dependencies
+
+"""
+Lets models be compiled on other machines, so studiomdl and Blender don't compete with Hammer for the CPU.
+A compile server takes a bundle of a model's source files, runs the usual pipeline on them with its own
+Crowbar setup and sends the compiled files back, and the client publishes them as if it had compiled them
+itself. A client spreads its jobs over several servers, giving each job to whichever server it has the
+fewest jobs running on, and falls back to compiling locally if none of them can be reached.
+Connections are plain TCP, authenticated with a token shared between the clients and servers.
+"""
+
+TOKEN_VARIABLE = "HAMMER_MINUS_SERVER_TOKEN"
+DEFAULT_PORT = 27960
+CONNECT_TIMEOUT = 5.0
+CHUNK_SIZE = 1024 * 1024
+# Anything bigger isn't from a client, and isn't worth allocating the memory for
+MAX_TOKEN_SIZE = 1024
+MAX_JOB_SIZE = 1024 * 1024
+CANCEL_POLL_INTERVAL = 0.1
+
+# What clients authenticate with
+token = os.environ.get(TOKEN_VARIABLE)
+
+# Server address -> number of jobs this process has running on it
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+class RemoteCompileError(Exception):
+    pass
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    # HOST:PORT, HOST or :PORT
+    host, _, port = address.rpartition(":") if ":" in address else (address, "", "")
+    return host or "127.0.0.1", int(port) if port else DEFAULT_PORT
+
+
+def _safe_join(directory: str, relative_path: str) -> str:
+    # Paths come from the other end of the connection, so don't let them escape the directory
+    directory = os.path.normpath(directory)
+    path = os.path.normpath(os.path.join(directory, *relative_path.split("/")))
+    if os.path.isabs(relative_path) or os.path.commonpath([path, directory]) != directory:
+        raise ValueError("Refusing to write outside of {}: {}".format(directory, relative_path))
+    return path
+
+
+def _describe_files(files: list[tuple[str, str]]) -> list[dict]:
+    # (local path, relative path) -> what's sent ahead of the files themselves
+    return [{"path": relative_path, "size": os.path.getsize(path)} for path, relative_path in files]
+
+
+def _send_files(connection: Connection, files: list[tuple[str, str]]):
+    for path, _ in files:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                connection.send_bytes(chunk)
+
+
+def _receive_files(connection: Connection, descriptions: list[dict], directory: str) -> set[str]:
+    paths = set()
+    for description in descriptions:
+        path = _safe_join(directory, description["path"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        remaining = description["size"]
+        with open(path, "wb") as f:
+            while remaining > 0:
+                chunk = connection.recv_bytes(maxlength=CHUNK_SIZE)
+                f.write(chunk)
+                remaining -= len(chunk)
+        paths.add(path)
+    return paths
+
+
+def get_bundle_files(compile_inputs: CompileInputs) -> list[tuple[str, str]]:
+    # The files a server needs to compile the model, relative to the directory they all share. The QC or mesh
+    # that gets compiled comes first.
+    if compile_inputs._pre_existing_qc:
+        qc_path = compile_inputs._pre_existing_qc
+        dependencies = get_qc_dependencies(qc_path) - {qc_path}
+        paths = [qc_path] + sorted(p for p in dependencies if os.path.isfile(p))
+    else:
+        paths = compile_inputs.source_mesh_paths
+    paths = [os.path.abspath(p) for p in paths]
+    root = os.path.commonpath([os.path.dirname(p) for p in paths])
+    return [(p, os.path.relpath(p, root).replace(os.sep, "/")) for p in paths]
+
+
+def _run_on_server(
+    server: str, job: dict, files: list[tuple[str, str]], output_dir: str, cancel_event=None
+) -> set[str]:
+    sock = socket.create_connection(parse_address(server), timeout=CONNECT_TIMEOUT)
+    sock.settimeout(None)
+    connection = Connection(sock.detach())
+    try:
+        connection.send_bytes(token.encode())
+        if not json.loads(connection.recv_bytes())["ok"]:
+            raise ConnectionRefusedError("Compile server rejected the token")
+
+        print("Compiling on", server)
+        connection.send_bytes(json.dumps(job).encode())
+        _send_files(connection, files)
+        # Hanging up tells the server to abort, so a superseded job doesn't hold up this worker
+        while not connection.poll(CANCEL_POLL_INTERVAL):
+            check_cancelled(cancel_event)
+        check_cancelled(cancel_event)
+
+        reply = json.loads(connection.recv_bytes())
+        if not reply["ok"]:
+            raise RemoteCompileError("{} failed to compile {}: {}".format(server, job["entry"], reply["error"]))
+        return _receive_files(connection, reply["files"], output_dir)
+    finally:
+        connection.close()
+
+
+def compile_remotely(
+    servers: list[str],
+    compile_inputs: CompileInputs,
+    game_name: str,
+    output_dir: str,
+    cancel_event=None,
+    use_cache: bool = True,
+) -> set[str] or None:
+    # Returns the compiled files, laid out in output_dir like they would be in the game directory,
+    # or None if none of the servers could be reached
+    if not token:
+        raise ValueError("Set {} or pass --server-token to use compile servers".format(TOKEN_VARIABLE))
+
+    files = get_bundle_files(compile_inputs)
+    job = {
+        "game": game_name,
+        "entry": files[0][1],
+        "files": _describe_files(files),
+        "use_cache": use_cache,
+        # Generated QCs are made with the client's settings, not the server's
+        "model_path": compile_inputs.model_path,
+        "cdmaterials": compile_inputs.cdmaterials,
+        "extra_cdmaterials": compile_inputs.extra_cdmaterials,
+        "lods": compile_inputs.lods,
+        "collision": compile_inputs.collision,
+    }
+
+    with _in_flight_lock:
+        by_load = sorted(servers, key=lambda s: _in_flight.get(s, 0))
+    for server in by_load:
+        with _in_flight_lock:
+            _in_flight[server] = _in_flight.get(server, 0) + 1
+        try:
+            return _run_on_server(server, job, files, output_dir, cancel_event)
+        except (OSError, EOFError) as e:
+            print("Couldn't compile on {}: {}".format(server, e))
+            # Don't let anything half received from this server get published
+            for name in os.listdir(output_dir):
+                shutil.rmtree(os.path.join(output_dir, name), ignore_errors=True)
+            check_cancelled(cancel_event)
+        finally:
+            with _in_flight_lock:
+                _in_flight[server] -= 1
+
+    print("No compile servers available, compiling locally")
+    return None
+
+
+def run_job(job: dict, work_dir: str, cancel_event=None) -> tuple[set[str], str]:
+    # Returns the compiled files and the game directory they're in
+    compile_inputs = find_compile_inputs_from_path(_safe_join(work_dir, job["entry"]))
+    if not compile_inputs._pre_existing_qc:
+        compile_inputs.model_path = job["model_path"]
+        compile_inputs.cdmaterials = job["cdmaterials"]
+        compile_inputs.extra_cdmaterials = job["extra_cdmaterials"]
+        compile_inputs.lods = [tuple(lod) for lod in job["lods"]]
+        compile_inputs.collision = job["collision"]
+
+    game_setup = crowbar_settings.get_game_setup(job["game"])
+    compiled_files = build_model(compile_inputs, game_setup, cancel_event, use_cache=job["use_cache"])
+    return compiled_files, os.path.dirname(game_setup["GamePathFileName"])
+
+
+class CompileServer:
+    def __init__(self, address: str, server_token: str, jobs: int = None):
+        self._socket = socket.create_server(parse_address(address))
+        self._token = server_token
+        self._slots = threading.Semaphore(jobs or os.cpu_count() or 1)
+        # Model path -> lock held while that model is compiled and sent
+        self._model_locks = {}
+        self._model_locks_lock = threading.Lock()
+
+    @property
+    def address(self) -> str:
+        return "{}:{}".format(*self._socket.getsockname()[:2])
+
+    def serve_forever(self):
+        print("Compile server listening on", self.address)
+        while True:
+            sock, client_address = self._socket.accept()
+            threading.Thread(target=self._handle, args=(sock, client_address), daemon=True).start()
+
+    def close(self):
+        self._socket.close()
+
+    def _get_model_lock(self, model_path: str) -> threading.Lock:
+        with self._model_locks_lock:
+            return self._model_locks.setdefault(model_path.replace("\\", "/").lower(), threading.Lock())
+
+    @staticmethod
+    def _watch_for_hang_up(connection: Connection, cancel_event: threading.Event, done: threading.Event):
+        # The client sends nothing while its job compiles, so anything readable means it has gone
+        while not done.is_set():
+            try:
+                if connection.poll(CANCEL_POLL_INTERVAL):
+                    break
+            except (EOFError, OSError):
+                break
+        else:
+            return
+        cancel_event.set()
+
+    def _handle(self, sock: socket.socket, client_address):
+        connection = Connection(sock.detach())
+        try:
+            try:
+                client_token = connection.recv_bytes(maxlength=MAX_TOKEN_SIZE)
+            except OSError:
+                # Too long to be a token, and the connection is closed
+                print("Rejected a connection from", client_address[0])
+                return
+            if not secrets.compare_digest(client_token, self._token.encode()):
+                print("Rejected a connection from", client_address[0])
+                connection.send_bytes(json.dumps({"ok": False}).encode())
+                return
+            connection.send_bytes(json.dumps({"ok": True}).encode())
+
+            try:
+                job = json.loads(connection.recv_bytes(maxlength=MAX_JOB_SIZE))
+            except OSError:
+                print("Rejected an oversized job from", client_address[0])
+                return
+            with tempfile.TemporaryDirectory(prefix="hammer_minus_job_") as work_dir:
+                _receive_files(connection, job["files"], work_dir)
+                print("Received", job["entry"], "from", client_address[0])
+
+                # studiomdl writes every job for a model to the same place in the game directory, so jobs for the
+                # same model take turns until their files have been sent and removed. The model lock is taken
+                # first, so waiting for it doesn't hold up a slot.
+                with self._get_model_lock(job["model_path"]), self._slots:
+                    cancel_event = threading.Event()
+                    done = threading.Event()
+                    watcher = threading.Thread(target=self._watch_for_hang_up, args=(connection, cancel_event, done))
+                    watcher.start()
+                    try:
+                        compiled_files, game_dir = run_job(job, work_dir, cancel_event)
+                    except CompileCancelled:
+                        print("Client hung up, aborted", job["entry"])
+                        return
+                    except Exception as e:
+                        traceback.print_exc()
+                        error = "{}: {}".format(type(e).__name__, e)
+                        connection.send_bytes(json.dumps({"ok": False, "error": error}).encode())
+                        return
+                    finally:
+                        done.set()
+                        watcher.join()
+
+                    try:
+                        files = [
+                            (p, os.path.relpath(os.path.abspath(p), os.path.abspath(game_dir)).replace(os.sep, "/"))
+                            for p in sorted(compiled_files)
+                        ]
+                        connection.send_bytes(json.dumps({"ok": True, "files": _describe_files(files)}).encode())
+                        _send_files(connection, files)
+                    finally:
+                        # They belong to the client, which publishes them wherever it wants
+                        for path in compiled_files:
+                            if os.path.exists(path):
+                                os.remove(path)
+        except (EOFError, OSError) as e:
+            print("Lost connection to {}: {}".format(client_address[0], e))
+        finally:
+            connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile models sent by other machines running Hammer Minus")
+    parser.add_argument(
+        "--address",
+        default="127.0.0.1:{}".format(DEFAULT_PORT),
+        help="HOST:PORT to listen on; use 0.0.0.0 to accept connections from other machines",
+    )
+    parser.add_argument("--token", default=token, help="Defaults to ${}, or a new random token".format(TOKEN_VARIABLE))
+    parser.add_argument("--jobs", type=int, default=None, help="Number of models to compile at once (default: CPU count)")
+    parser.add_argument(
+        "--blender-workers",
+        type=int,
+        default=1,
+        help="Blender processes to keep running; with the native DMX backend they're only started if it falls back",
+    )
+    parser.add_argument("--dmx-backend", choices=auto_qc.SANITISE_BACKENDS, default=auto_qc.sanitise_backend)
+    args = parser.parse_args()
+
+    auto_qc.sanitise_backend = args.dmx_backend
+    server_token = args.token
+    if not server_token:
+        server_token = secrets.token_hex(16)
+        print("Clients need to set {}={}".format(TOKEN_VARIABLE, server_token))
+
+    if args.blender_workers > 0:
+        try:
+            sanitize_dmx.start_worker_pool(args.blender_workers, lazy=auto_qc.sanitise_backend == "native")
+        except RuntimeError as e:
+            print(e, "- continuing without Blender workers")
+    server = CompileServer(args.address, server_token, args.jobs)
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+        sanitize_dmx.stop_worker_pool()
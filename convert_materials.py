@@ -1,30 +1,255 @@
-import os, itertools
+import os, io, itertools, json, threading, hashlib, time
 from srctools.game import Game
-from srctools.filesys import FileSystemChain
+from srctools.filesys import FileSystemChain, RawFileSystem, VPKFileSystem
 from srctools.mdl import Model
-from srctools.dmx import Element
 from srctools.vmt import Material
+from srctools.vpk import VPK
 from . import crowbar_settings
-from .auto_qc import CompileInputs, TemporarySanitisedDMX
+from .local_cache import get_cache_dir
+from .auto_qc import CompileInputs, SHARED_CDMATERIALS
+from .downconvert_dmx import get_material_paths
+
+
+# How often lookups check whether the game's VPKs have changed
+VPK_RECHECK_INTERVAL = 2.0
+
+_filesystems = {}
+_material_indexes = {}
+_filesystem_lock = threading.Lock()
 
 
 def get_game_filesystem(game: str) -> FileSystemChain:
-    game_setup = crowbar_settings.get_game_setup(game)
-    g = Game(os.path.dirname(game_setup["GamePathFileName"]))
-    return g.get_filesystem()
+    # Mounting every search path and VPK is slow, so keep the result around for the life of the process
+    with _filesystem_lock:
+        if game not in _filesystems:
+            game_setup = crowbar_settings.get_game_setup(game)
+            g = Game(os.path.dirname(game_setup["GamePathFileName"]))
+            _filesystems[game] = g.get_filesystem()
+        return _filesystems[game]
+
+
+class MaterialIndex:
+    """
+    Every materials/**.vmt path in a game's filesystem, so that existence checks are set lookups.
+    VPK contents are cached on disk and only re-read when a VPK's directory file changes size or mtime. Lookups
+    check for that every few seconds, so a VPK which is updated while the daemon runs gets remounted.
+    """
+
+    def __init__(self, filesystem: FileSystemChain):
+        self._filesystem = filesystem
+        # Loose materials, and ones added since
+        self._paths = set()
+        # VPK path -> (prefix, [mtime, size] when it was indexed, its materials)
+        self._vpks = {}
+        # File name without extension -> paths, only built if something needs it
+        self._by_name = None
+        self._raw_dirs = []
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+
+        for system, prefix in filesystem.systems:
+            if isinstance(system, VPKFileSystem):
+                self._vpks[system.path] = (prefix, None, frozenset())
+            elif isinstance(system, RawFileSystem):
+                self._raw_dirs.append((system.path, prefix))
+                materials_dir = os.path.join(system.path, "materials")
+                for dir_path, dir_names, file_names in os.walk(materials_dir):
+                    for file_name in file_names:
+                        if file_name.lower().endswith(".vmt"):
+                            path = os.path.relpath(os.path.join(dir_path, file_name), system.path)
+                            self._paths.add(self._normalise(prefix + path))
+        with self._lock:
+            self._refresh_vpks(initial=True)
+
+    def _refresh_vpks(self, initial: bool = False):
+        # Must be called with the lock held
+        self._checked_at = time.monotonic()
+        index_path = os.path.join(get_cache_dir(), "vpk_material_index.json")
+        vpk_index = None
+        index_changed = False
+
+        for vpk_path, (prefix, indexed_stat, materials) in list(self._vpks.items()):
+            try:
+                stat = os.stat(vpk_path)
+                stat = [stat.st_mtime, stat.st_size]
+            except OSError:
+                stat = None
+            if stat == indexed_stat:
+                continue
+
+            if stat is None:
+                print("Unmounting removed VPK", vpk_path)
+                materials = frozenset()
+            else:
+                if vpk_index is None:
+                    try:
+                        with open(index_path) as f:
+                            vpk_index = json.load(f)
+                    except (OSError, ValueError):
+                        vpk_index = {}
+                try:
+                    if not initial:
+                        print("Remounting changed VPK", vpk_path)
+                        self._remount(vpk_path)
+                    entry = vpk_index.get(vpk_path)
+                    if entry is None or [entry["mtime"], entry["size"]] != stat:
+                        print("Indexing materials in", vpk_path)
+                        materials = list(VPK(vpk_path).filenames("vmt", "materials"))
+                        entry = {"mtime": stat[0], "size": stat[1], "materials": materials}
+                        vpk_index[vpk_path] = entry
+                        index_changed = True
+                except (OSError, ValueError) as e:
+                    # Most likely still being written, so try again next time
+                    print("Couldn't read {} ({})".format(vpk_path, e))
+                    continue
+                materials = frozenset(self._normalise(prefix + path) for path in entry["materials"])
+            self._vpks[vpk_path] = (prefix, stat, materials)
+            self._by_name = None
 
+        if index_changed:
+            with open(index_path, "w") as f:
+                json.dump(vpk_index, f)
 
-def filesystem_contains_material(filesystem, model: Model, mat_name: str) -> bool:
+    def _remount(self, vpk_path: str):
+        # The filesystem only reads a VPK's directory when it's mounted, so files in it would be read from the
+        # wrong place
+        for i, (system, prefix) in enumerate(self._filesystem.systems):
+            if isinstance(system, VPKFileSystem) and system.path == vpk_path:
+                self._filesystem.systems[i] = (VPKFileSystem(vpk_path), prefix)
+
+    def _check_vpks(self):
+        # Must be called with the lock held
+        if time.monotonic() - self._checked_at > VPK_RECHECK_INTERVAL:
+            self._refresh_vpks()
+
+    @staticmethod
+    def _normalise(path: str) -> str:
+        return path.replace("\\", "/").lstrip("/").lower()
+
+    @staticmethod
+    def _get_name(path: str) -> str:
+        return os.path.splitext(path.rsplit("/", 1)[-1])[0]
+
+    def add(self, path: str):
+        with self._lock:
+            path = self._normalise(path)
+            self._paths.add(path)
+            if self._by_name is not None:
+                self._by_name.setdefault(self._get_name(path), set()).add(path)
+
+    def find_by_name(self, mat_name: str) -> list[str]:
+        # Every material with this file name, wherever it is
+        with self._lock:
+            self._check_vpks()
+            if self._by_name is None:
+                self._by_name = {}
+                for path in itertools.chain(self._paths, *(materials for _, _, materials in self._vpks.values())):
+                    self._by_name.setdefault(self._get_name(path), set()).add(path)
+            return sorted(self._by_name.get(self._get_name(self._normalise(mat_name)), ()))
+
+    def __contains__(self, path: str) -> bool:
+        path = self._normalise(path)
+        with self._lock:
+            self._check_vpks()
+            if path in self._paths or any(path in materials for _, _, materials in self._vpks.values()):
+                return True
+        # Loose files can appear at any time, but checking for one is a single stat
+        for raw_dir, prefix in self._raw_dirs:
+            if path.startswith(prefix.lower()) and os.path.isfile(os.path.join(raw_dir, path[len(prefix) :])):
+                self.add(path)
+                return True
+        return False
+
+
+def get_material_index(game: str) -> MaterialIndex:
+    filesystem = get_game_filesystem(game)
+    with _filesystem_lock:
+        if game not in _material_indexes:
+            _material_indexes[game] = MaterialIndex(filesystem)
+        return _material_indexes[game]
+
+
+def find_material_dir(material_index: MaterialIndex, model: Model, mat_name: str) -> str or None:
     for mat_dir in model.cdmaterials:
         mat_dir = mat_dir.lstrip("/").rstrip("/")
         if mat_dir:
             mat_path = "/".join(["materials", mat_dir, mat_name + ".vmt"])
         else:
             mat_path = "/".join(["materials", mat_name + ".vmt"])
-        if mat_path in filesystem:
+        if mat_path in material_index:
             print("Found", mat_path)
-            return True
-    return False
+            return mat_dir
+    return None
+
+
+def filesystem_contains_material(material_index: MaterialIndex, model: Model, mat_name: str) -> bool:
+    return find_material_dir(material_index, model, mat_name) is not None
+
+
+def convert_material(parent_contents: str) -> str:
+    # Brushes are lit with lightmaps, which models don't have
+    new_mat = Material.parse(parent_contents)
+    if new_mat.shader.lower() == "lightmappedgeneric":
+        new_mat.shader = "VertexLitGeneric"
+    else:
+        print("Shader is", new_mat.shader)
+    output = io.StringIO()
+    new_mat.export(output)
+    return output.getvalue()
+
+
+class ConvertedMaterialCache:
+    """
+    Remembers which parent material (and which version of it) each converted material was made from,
+    so that outputs are only rewritten when their parent changes and each parent is only parsed once.
+    """
+
+    def __init__(self):
+        self._path = os.path.join(get_cache_dir(), "converted_materials.json")
+        self._lock = threading.Lock()
+        self._converted = {}
+        try:
+            with open(self._path) as f:
+                self._records = json.load(f)
+        except (OSError, ValueError):
+            self._records = {}
+
+    def get_parent(self, output_path: str) -> str or None:
+        with self._lock:
+            record = self._records.get(os.path.normcase(output_path))
+        return record and record["parent"]
+
+    def is_up_to_date(self, output_path: str, parent_path: str, parent_hash: str) -> bool:
+        with self._lock:
+            record = self._records.get(os.path.normcase(output_path))
+        return record == {"parent": parent_path, "hash": parent_hash} and os.path.isfile(output_path)
+
+    def convert(self, parent_path: str, parent_hash: str, parent_contents: str) -> str:
+        with self._lock:
+            if (parent_path, parent_hash) in self._converted:
+                return self._converted[parent_path, parent_hash]
+
+        new_mat_contents = convert_material(parent_contents)
+        with self._lock:
+            self._converted[parent_path, parent_hash] = new_mat_contents
+        return new_mat_contents
+
+    def record(self, output_path: str, parent_path: str, parent_hash: str):
+        with self._lock:
+            self._records[os.path.normcase(output_path)] = {"parent": parent_path, "hash": parent_hash}
+            with open(self._path, "w") as f:
+                json.dump(self._records, f)
+
+
+_converted_material_cache = None
+
+
+def get_converted_material_cache() -> ConvertedMaterialCache:
+    global _converted_material_cache
+    with _filesystem_lock:
+        if _converted_material_cache is None:
+            _converted_material_cache = ConvertedMaterialCache()
+        return _converted_material_cache
 
 
 def get_original_mat_paths(orig_mesh_path: str) -> set[str]:
@@ -32,27 +257,23 @@ def get_original_mat_paths(orig_mesh_path: str) -> set[str]:
     if extension.lower() != ".dmx":
         raise NotImplementedError("Only DMX is supported currently")
 
-    with open(orig_mesh_path, "rb") as f:
-        dmx, format_name, format_version = Element.parse(f)
-
-    paths = set()
-    model = dmx["model"].val_elem
-    for dag_node in model["children"].iter_elem():
-        shape = dag_node["shape"].val_elem
-        for face_set in shape["faceSets"].iter_elem():
-            material = face_set["material"].val_elem
-            mat_path = material["mtlName"].val_string
-            paths.add(mat_path)
-
-    return paths
+    # Only the material names are needed, so there's no point loading all the vertex data
+    return get_material_paths(orig_mesh_path)
 
 
 def convert_all_materials(
     compile_inputs: CompileInputs, orig_mesh_path: str, game: str, addon_path=None
-):
+) -> set[str]:
+    # Returns the loose parent material files on disk, so the caller can rebuild when they change
     print("Converting materials for", compile_inputs.model_name)
     filesystem = get_game_filesystem(game)
-    model = Model(filesystem, filesystem["models/" + compile_inputs.model_path])
+    material_index = get_material_index(game)
+    model_path = "models/" + compile_inputs.model_path
+    if addon_path and os.path.isfile(os.path.join(addon_path, model_path)):
+        # Somewhere the game doesn't look, like a VPK's staging folder
+        model = Model(filesystem, RawFileSystem(addon_path)[model_path])
+    else:
+        model = Model(filesystem, filesystem[model_path])
 
     original_mats = None
 
@@ -60,34 +281,55 @@ def convert_all_materials(
         crowbar_settings.get_game_setup(game)["GamePathFileName"]
     )
 
+    # Prefer the shared directory if the model looks there, so each material is only converted once
+    model_dirs = [d.strip("/").lower() for d in model.cdmaterials]
+    if SHARED_CDMATERIALS.lower() in model_dirs:
+        output_mat_dir = SHARED_CDMATERIALS
+    else:
+        output_mat_dir = compile_inputs.cdmaterials
+    cache = get_converted_material_cache()
+    parent_files = set()
+
     mat_names = set(itertools.chain(*model.skins))
     for mat_name in mat_names:
-        if not filesystem_contains_material(filesystem, model, mat_name):
+        found_dir = find_material_dir(material_index, model, mat_name)
+        output_path = os.path.join(output_dir, "materials", output_mat_dir, mat_name + ".vmt")
+        parent_mat_path = cache.get_parent(output_path)
+
+        if found_dir is not None and (found_dir.lower() != output_mat_dir.lower() or parent_mat_path is None):
+            # It's a real material rather than one we converted, so leave it alone
+            continue
+
+        if parent_mat_path is None:
             print("Couldn't find", mat_name, "- attempting to replace it")
             if original_mats is None:
-                with TemporarySanitisedDMX(orig_mesh_path, clear_material_path=False) as clean_orig_mesh_path:
-                    original_mats = get_original_mat_paths(clean_orig_mesh_path)
+                original_mats = get_original_mat_paths(orig_mesh_path)
             try:
                 parent_mat_path = next(
                     m for m in original_mats if os.path.splitext(os.path.basename(m))[0] == mat_name
-                )
+                ).replace(".vmat", ".vmt")
             except StopIteration:
                 print("Couldn't find a parent material to copy from :(")
                 continue
 
-            parent_file = filesystem[parent_mat_path.replace(".vmat", ".vmt")]
-            parent_file_contents = parent_file.open_str().read()
-            new_mat = Material.parse(parent_file_contents)
-            if new_mat.shader.lower() == "lightmappedgeneric":
-                new_mat.shader = "VertexLitGeneric"
-            else:
-                print("Shader is", new_mat.shader)
-            output_path = os.path.join(
-                output_dir, "materials", compile_inputs.cdmaterials, mat_name + ".vmt"
-            )
-
-            print("Writing new material", output_path)
-            if not os.path.isdir(os.path.dirname(output_path)):
-                os.makedirs(os.path.dirname(output_path))
-            with open(output_path, "w") as f:
-                new_mat.export(f)
+        parent_file = filesystem[parent_mat_path]
+        parent_system = FileSystemChain.get_system(parent_file)
+        if isinstance(parent_system, RawFileSystem):
+            parent_files.add(os.path.join(parent_system.path, parent_file.path))
+        parent_file_contents = parent_file.open_str().read()
+        parent_hash = hashlib.sha256(parent_file_contents.encode()).hexdigest()
+        if cache.is_up_to_date(output_path, parent_mat_path, parent_hash):
+            print(output_path, "is up to date")
+            continue
+
+        new_mat_contents = cache.convert(parent_mat_path, parent_hash, parent_file_contents)
+
+        print("Writing new material", output_path)
+        if not os.path.isdir(os.path.dirname(output_path)):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "w") as f:
+            f.write(new_mat_contents)
+        cache.record(output_path, parent_mat_path, parent_hash)
+        material_index.add(os.path.relpath(output_path, output_dir))
+
+    return parent_files
@@ -1,43 +1,35 @@
-import os
-from xml.etree import ElementTree
-
-zm_path = os.path.join(os.environ["APPDATA"], "ZeqMacaw")
-is_crowbar_dir = lambda d: os.path.isdir(os.path.join(zm_path, d)) and d.startswith("Crowbar ")
-crowbar_versions = [d for d in os.listdir(zm_path) if is_crowbar_dir(d)]
-chosen_version = max(crowbar_versions)
-print("Using settings from", chosen_version)
-chosen_dir = os.path.join(zm_path, chosen_version)
-
-cb_settings_tree = ElementTree.parse(os.path.join(chosen_dir, "Crowbar Settings.xml"))
-root = cb_settings_tree.getroot()
-game_setups = root.find("GameSetups")
-library_paths = root.find("SteamLibraryPaths")
-
-library_path_macros = {}
-for lib_path in library_paths:
-    search = lib_path.find("Macro").text
-    replace = lib_path.find("LibraryPath").text
-    library_path_macros[search] = replace
+import os, json
+from .local_cache import get_cache_dir
 
-DEFAULT_GAME = object()
+"""
+Game setups and compile options come from Crowbar's settings. Nothing is read until it's first needed, and the
+parsed settings are cached on disk against the XML's modification time, so scripts start quickly and can still
+be imported (e.g. for --help) on a machine without Crowbar.
+The settings can be read as module attributes, e.g. crowbar_settings.nop4.
+"""
 
-def text_setting(name: str):
-    return root.find(name).text
+DEFAULT_GAME = object()
+SETTINGS_FILE_NAME = "Crowbar Settings.xml"
+# Bump this if the cached representation changes
+CACHE_VERSION = 1
 
-# Compile options
-default_game_index = int(text_setting("CompileGameSetupSelectedIndex"))
-nop4 = text_setting("CompileOptionNoP4IsChecked").lower() == "true"
-if text_setting("CompileOutputFolderOption") == "WorkFolder":
-    compile_output_dir = text_setting("CompileOutputFullPath")
-else:
-    compile_output_dir = None
+_settings = None
 
 
-def element_to_dict(element: ElementTree.Element):
-    return {e.tag: e.text for e in element}
+def find_settings_file() -> str:
+    if "APPDATA" not in os.environ:
+        raise FileNotFoundError("%APPDATA% isn't set, so Crowbar's settings can't be found")
+    zm_path = os.path.join(os.environ["APPDATA"], "ZeqMacaw")
+    is_crowbar_dir = lambda d: os.path.isdir(os.path.join(zm_path, d)) and d.startswith("Crowbar ")
+    crowbar_versions = [d for d in os.listdir(zm_path) if is_crowbar_dir(d)] if os.path.isdir(zm_path) else []
+    if not crowbar_versions:
+        raise FileNotFoundError("Couldn't find any Crowbar settings in " + zm_path)
+    chosen_version = max(crowbar_versions)
+    print("Using settings from", chosen_version)
+    return os.path.join(zm_path, chosen_version, SETTINGS_FILE_NAME)
 
 
-def apply_macros(path: str):
+def apply_macros(path: str, library_path_macros: dict):
     if not path:
         return path
     for search, replace in library_path_macros.items():
@@ -45,11 +37,87 @@ def apply_macros(path: str):
     return path
 
 
-def get_game_setup(game_name=DEFAULT_GAME):
-    if game_name is DEFAULT_GAME:
-        setup_element = game_setups[default_game_index]
+def parse_settings_file(path: str) -> dict:
+    from xml.etree import ElementTree
+
+    root = ElementTree.parse(path).getroot()
+    text_setting = lambda name: root.find(name).text
+
+    library_path_macros = {}
+    for lib_path in root.find("SteamLibraryPaths"):
+        search = lib_path.find("Macro").text
+        replace = lib_path.find("LibraryPath").text
+        library_path_macros[search] = replace
+
+    if text_setting("CompileOutputFolderOption") == "WorkFolder":
+        compile_output_dir = text_setting("CompileOutputFullPath")
     else:
-        setup_element = next(e for e in game_setups if e.find("GameName").text == game_name)
-    if not setup_element:
-        raise KeyError('Couldn\'t find settings for "{}"'.format(game_name))
-    return {e.tag: apply_macros(e.text) for e in setup_element}
+        compile_output_dir = None
+
+    return {
+        "default_game_index": int(text_setting("CompileGameSetupSelectedIndex")),
+        "nop4": text_setting("CompileOptionNoP4IsChecked").lower() == "true",
+        "compile_output_dir": compile_output_dir,
+        "game_setups": [
+            {e.tag: apply_macros(e.text, library_path_macros) for e in setup_element}
+            for setup_element in root.find("GameSetups")
+        ],
+    }
+
+
+class CrowbarSettings:
+    def __init__(self, settings: dict):
+        self.default_game_index = settings["default_game_index"]
+        self.nop4 = settings["nop4"]
+        self.compile_output_dir = settings["compile_output_dir"]
+        self.game_setups = settings["game_setups"]
+        self._game_setups_by_name = {}
+        for game_setup in self.game_setups:
+            self._game_setups_by_name.setdefault(game_setup.get("GameName"), game_setup)
+
+    def get_game_setup(self, game_name=DEFAULT_GAME) -> dict:
+        if game_name is DEFAULT_GAME:
+            return dict(self.game_setups[self.default_game_index])
+        try:
+            return dict(self._game_setups_by_name[game_name])
+        except KeyError:
+            raise KeyError('Couldn\'t find settings for "{}"'.format(game_name)) from None
+
+
+def load_settings() -> CrowbarSettings:
+    settings_path = find_settings_file()
+    mtime = os.stat(settings_path).st_mtime_ns
+    cache_path = os.path.join(get_cache_dir(), "crowbar_settings.json")
+
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached["version"] == CACHE_VERSION and cached["path"] == settings_path and cached["mtime"] == mtime:
+            return CrowbarSettings(cached["settings"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    settings = parse_settings_file(settings_path)
+    try:
+        with open(cache_path, "w") as f:
+            json.dump({"version": CACHE_VERSION, "path": settings_path, "mtime": mtime, "settings": settings}, f)
+    except OSError as e:
+        print("Couldn't cache Crowbar settings:", e)
+    return CrowbarSettings(settings)
+
+
+def get_settings() -> CrowbarSettings:
+    global _settings
+    if _settings is None:
+        _settings = load_settings()
+    return _settings
+
+
+def get_game_setup(game_name=DEFAULT_GAME) -> dict:
+    return get_settings().get_game_setup(game_name)
+
+
+def __getattr__(name: str):
+    if name in ("default_game_index", "nop4", "compile_output_dir"):
+        return getattr(get_settings(), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
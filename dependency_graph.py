@@ -0,0 +1,98 @@
+import os, threading
+from collections import defaultdict
+from .auto_qc import MESH_EXTENSIONS
+from .qc_parser import parse_qc
+from .batch_compile import find_batch_inputs
+
+"""
+Tracks which source files (meshes, QCs and their includes, parent materials) each compile target depends on,
+so that a change to any of them rebuilds exactly the models which use it. A target is something that can be
+passed to compile_model: a QC, or a mesh which no QC references.
+"""
+
+
+def _key(path: str) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def get_qc_dependencies(qc_path: str) -> set[str]:
+    try:
+        parsed_qc = parse_qc(qc_path)
+    except (OSError, ValueError) as e:
+        print("Couldn't read", qc_path, "-", e)
+        return {qc_path}
+    return {qc_path} | set(parsed_qc.included_paths) | set(parsed_qc.mesh_paths)
+
+
+class DependencyGraph:
+    def __init__(self):
+        self._targets = {}  # key -> target path
+        self._dependencies = defaultdict(set)  # target key -> source keys
+        self._dependents = defaultdict(set)  # source key -> target keys
+        self._lock = threading.RLock()
+
+    @classmethod
+    def build(cls, directory: str, recursive: bool = False):
+        graph = cls()
+        for target in find_batch_inputs(directory, recursive):
+            graph._refresh_target(target)
+        print("Tracking", len(graph._targets), "models in", directory)
+        return graph
+
+    def _set_dependencies(self, target: str, sources: set[str]):
+        target_key = _key(target)
+        for source_key in self._dependencies.pop(target_key, set()):
+            self._dependents[source_key].discard(target_key)
+        self._targets[target_key] = target
+        self._dependencies[target_key] = {_key(s) for s in sources}
+        for source_key in self._dependencies[target_key]:
+            self._dependents[source_key].add(target_key)
+
+    def _remove_target(self, target_key: str):
+        self._targets.pop(target_key, None)
+        for source_key in self._dependencies.pop(target_key, set()):
+            self._dependents[source_key].discard(target_key)
+
+    def _refresh_target(self, target: str):
+        if target.lower().endswith(".qc"):
+            dependencies = get_qc_dependencies(target)
+            self._set_dependencies(target, dependencies)
+            # Meshes which a QC has claimed aren't models in their own right any more
+            for dependency in dependencies:
+                if _key(dependency) in self._targets and _key(dependency) != _key(target):
+                    self._remove_target(_key(dependency))
+        else:
+            self._set_dependencies(target, self._dependencies.get(_key(target), set()) | {target})
+
+    def add_dependencies(self, target: str, sources: set[str]):
+        with self._lock:
+            target_key = _key(target)
+            for source in sources:
+                self._dependencies[target_key].add(_key(source))
+                self._dependents[_key(source)].add(target_key)
+
+    def update(self, path: str) -> set[str]:
+        # Call this whenever a file changes; it returns the targets which need rebuilding
+        with self._lock:
+            key = _key(path)
+            extension = os.path.splitext(path)[1].lower()
+            if not os.path.isfile(path):
+                self._remove_target(key)
+                return set()
+
+            if extension == ".qc":
+                self._refresh_target(path)
+            else:
+                # The QCs which include this might now reference different meshes
+                for target_key in list(self._dependents.get(key, ())):
+                    if target_key != key and target_key.lower().endswith(".qc"):
+                        self._refresh_target(self._targets[target_key])
+                if extension in MESH_EXTENSIONS and not self._dependents.get(key):
+                    self._refresh_target(path)
+
+            return {self._targets[k] for k in self._dependents.get(key, ()) if k in self._targets}
+
+    @property
+    def targets(self) -> list[str]:
+        with self._lock:
+            return list(self._targets.values())
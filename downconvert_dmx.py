@@ -0,0 +1,561 @@
+import argparse, os, re, mmap
+from uuid import UUID, uuid5
+from srctools import binformat
+from srctools.dmx import Element, Attribute, ValueType, StubElement, NULL, SIZES, TYPE_CONVERT
+
+"""
+Converts DMX files exported by Source 2 tools into a version that studiomdl accepts, without Blender.
+srctools can only parse binary DMX up to version 5, so binary files are read here instead. The result is
+written out the same way Blender Source Tools does it when exporting for Source 1: binary encoding 2,
+model format 1.
+There's also a partial reader, which gets the structure of a DMX without its vertex data, for when only
+things like material names are needed. An export of several objects can also be split into one file per
+object as it's converted.
+"""
+
+OUTPUT_ENCODING_VERSION = 2
+OUTPUT_FORMAT_NAME = "model"
+OUTPUT_FORMAT_VERSION = 1
+
+# Source 2 vertex data uses semantic names; Source 1 uses the older descriptive names
+VERTEX_FIELD_NAMES = {
+    "position$0": "positions",
+    "normal$0": "normals",
+    "texcoord$0": "textureCoordinates",
+    "blendweights$0": "jointWeights",
+    "blendindices$0": "jointIndices",
+    "balance$0": "balance",
+    "wrinkle$0": "wrinkle",
+    "tangent$0": "tangents",
+}
+
+_BASE_TYPES = [
+    None,
+    ValueType.ELEMENT,
+    ValueType.INTEGER,
+    ValueType.FLOAT,
+    ValueType.BOOL,
+    ValueType.STRING,
+    ValueType.BINARY,
+    ValueType.TIME,
+    ValueType.COLOR,
+    ValueType.VEC2,
+    ValueType.VEC3,
+    ValueType.VEC4,
+    ValueType.ANGLE,
+    ValueType.QUATERNION,
+    ValueType.MATRIX,
+]
+# Types which only appear from version 9 onwards, and which srctools has no equivalent for
+_UINT64 = "uint64"
+_UINT8 = "uint8"
+_EXTRA_SIZES = {_UINT64: 8, _UINT8: 1}
+
+
+def _get_attribute_type(type_id: int, version: int):
+    if version >= 9:
+        type_list = _BASE_TYPES + [_UINT64, _UINT8]
+        array_offset = 32
+    else:
+        type_list = _BASE_TYPES
+        array_offset = len(_BASE_TYPES) - 1
+
+    is_array = type_id > array_offset
+    if is_array:
+        type_id -= array_offset
+    if not 0 < type_id < len(type_list):
+        raise ValueError("Unknown DMX attribute type {} for binary version {}".format(type_id, version))
+    if type_list[type_id] is ValueType.TIME and version < 3:
+        raise ValueError("Time attributes aren't supported before binary version 3")
+    return type_list[type_id], is_array
+
+
+def read_header(file) -> tuple[str, int, str, int]:
+    header = file.read(256)
+    match = re.match(
+        rb"<!--\s*dmx\s+encoding\s+(?:unicode_)?(\S+)\s+([0-9]+)\s+format\s+(\S+)\s+([0-9]+)\s*-->", header
+    )
+    if match is None:
+        raise ValueError("Unrecognised DMX header {!r}".format(header[:64]))
+    file.seek(match.end())
+    encoding, encoding_version, format_name, format_version = match.groups()
+    return encoding.decode(), int(encoding_version), format_name.decode(), int(format_version)
+
+
+class BinaryDMXReader:
+    def __init__(self, file, version: int):
+        self._file = file
+        self._version = version
+        self._strings = None
+        self._stubs = {}
+
+        if version >= 5:
+            self._string_count_format = self._string_index_format = "<i"
+        elif version >= 4:
+            self._string_count_format, self._string_index_format = "<i", "<h"
+        else:
+            self._string_count_format = self._string_index_format = "<h"
+
+    def _read_int(self) -> int:
+        return binformat.struct_read("<i", self._file)[0]
+
+    def _read_string(self, from_table: bool = True) -> str:
+        if from_table and self._strings is not None:
+            [index] = binformat.struct_read(self._string_index_format, self._file)
+            return self._strings[index]
+        return binformat.read_nullstr(self._file)
+
+    def _read_value(self, attr_type, elements: list, inline_strings: bool):
+        if attr_type is ValueType.ELEMENT:
+            index = self._read_int()
+            if index == -1:
+                return NULL
+            elif index == -2:
+                uuid = UUID(binformat.read_nullstr(self._file))
+                if uuid not in self._stubs:
+                    self._stubs[uuid] = StubElement.stub(uuid)
+                return self._stubs[uuid]
+            return elements[index]
+        elif attr_type is ValueType.STRING:
+            return self._read_string(from_table=self._version >= 4 and not inline_strings)
+        elif attr_type is ValueType.BINARY:
+            return self._file.read(self._read_int())
+        elif attr_type in _EXTRA_SIZES:
+            return int.from_bytes(self._file.read(_EXTRA_SIZES[attr_type]), "little")
+        return TYPE_CONVERT[ValueType.BINARY, attr_type](self._file.read(SIZES[attr_type]))
+
+    def _should_skip(self, attr_type, is_array: bool) -> bool:
+        # Subclasses can skip over values they don't need, as long as they aren't strings or elements
+        return False
+
+    def _skip_value(self, attr_type, is_array: bool):
+        count = self._read_int() if is_array else 1
+        if attr_type is ValueType.BINARY:
+            for _ in range(count):
+                self._file.seek(self._read_int(), os.SEEK_CUR)
+        else:
+            # Strings and elements can't be skipped like this, but everything else is fixed-size
+            self._file.seek(count * _EXTRA_SIZES.get(attr_type, SIZES.get(attr_type)), os.SEEK_CUR)
+
+    def _read_array(self, attr_type, count: int, elements: list):
+        # String arrays are always stored inline
+        return attr_type, [self._read_value(attr_type, elements, inline_strings=True) for _ in range(count)]
+
+    def _read_attribute(self, elements: list, inline_names: bool = False):
+        name = self._read_string(from_table=not inline_names)
+        [type_id] = binformat.struct_read("<B", self._file)
+        attr_type, is_array = _get_attribute_type(type_id, self._version)
+        if self._should_skip(attr_type, is_array):
+            self._skip_value(attr_type, is_array)
+            return None
+
+        if is_array:
+            attr_type, values = self._read_array(attr_type, self._read_int(), elements)
+        else:
+            values = self._read_value(attr_type, elements, inline_names)
+
+        if attr_type in _EXTRA_SIZES:
+            # Nothing in a Source 1 model needs these, and srctools can't store 64-bit values anyway
+            if attr_type is _UINT64:
+                return None
+            attr_type = ValueType.INTEGER
+        return Attribute(name, attr_type, values)
+
+    def read(self) -> Element:
+        if self._file.read(2) != b"\n\0":
+            raise ValueError("No newline after DMX header")
+
+        if self._version >= 9:
+            # Prefix elements hold file-level metadata, which studiomdl doesn't need
+            for _ in range(self._read_int()):
+                for _ in range(self._read_int()):
+                    self._read_attribute([], inline_names=True)
+
+        if self._version >= 2:
+            [string_count] = binformat.struct_read(self._string_count_format, self._file)
+            self._strings = binformat.read_nullstr_array(self._file, string_count)
+
+        elements = []
+        for _ in range(self._read_int()):
+            element_type = self._read_string()
+            name = self._read_string(from_table=self._version >= 4)
+            uuid = UUID(bytes_le=self._file.read(16))
+            elements.append(Element(name, element_type, uuid))
+
+        for element in elements:
+            for _ in range(self._read_int()):
+                attribute = self._read_attribute(elements)
+                if attribute is not None:
+                    element[attribute.name] = attribute
+
+        if not elements:
+            raise ValueError("No elements in DMX file")
+        return elements[0]
+
+
+class PartialBinaryDMXReader(BinaryDMXReader):
+    """
+    Reads the structure of a binary DMX without its bulk data: arrays of anything other than elements or
+    strings, and binary blobs, are seeked past rather than read. For a big mesh that's nearly all of the file.
+    """
+
+    def _should_skip(self, attr_type, is_array: bool) -> bool:
+        return attr_type is ValueType.BINARY or (is_array and attr_type not in (ValueType.ELEMENT, ValueType.STRING))
+
+
+class RawArrayBinaryDMXReader(BinaryDMXReader):
+    """
+    Leaves arrays of fixed-size values (vectors, numbers and so on) as the raw little-endian bytes from the file,
+    stored as binary attributes. Turning a big mesh's vertex data into Python objects is most of the time it
+    takes to read it, and NumPy can use the bytes as they are.
+    """
+
+    def _read_array(self, attr_type, count: int, elements: list):
+        if attr_type in SIZES and attr_type is not ValueType.ELEMENT:
+            return ValueType.BINARY, self._file.read(count * SIZES[attr_type])
+        return super()._read_array(attr_type, count, elements)
+
+
+class PartialKV2DMXReader:
+    """
+    The keyvalues2 equivalent of PartialBinaryDMXReader. The file is memory-mapped and scanned for tokens, and
+    the contents of arrays other than elements and strings are jumped over without being tokenised.
+    """
+
+    _TOKEN = re.compile(rb'\s*(?://[^\n]*\s*)*(?:"((?:[^"\\]|\\.)*)"|([{}\[\],]))')
+    _ESCAPE = re.compile(r"\\(.)")
+    _ESCAPES = {"n": "\n", "t": "\t"}
+
+    def __init__(self, data, offset: int):
+        self._data = data
+        self._position = offset
+        self._elements_by_id = {}
+        # (element, attribute name, UUID or list of UUIDs) to fill in once every element has been read
+        self._references = []
+
+    def _next(self) -> str or None:
+        match = self._TOKEN.match(self._data, self._position)
+        if match is None:
+            if self._data[self._position :].strip():
+                raise ValueError("Unexpected data at offset {} of keyvalues2 DMX".format(self._position))
+            return None
+        self._position = match.end()
+        if match.group(1) is not None:
+            value = match.group(1).decode("utf-8", "replace")
+            if "\\" in value:
+                value = self._ESCAPE.sub(lambda m: self._ESCAPES.get(m.group(1), m.group(1)), value)
+            return value
+        # Punctuation is returned as bytes, so it can't be confused with a string containing the same character
+        return match.group(2)
+
+    def _expect_string(self) -> str:
+        token = self._next()
+        if not isinstance(token, str):
+            raise ValueError("Expected a string at offset {} of keyvalues2 DMX".format(self._position))
+        return token
+
+    def _expect(self, punctuation: bytes):
+        if self._next() != punctuation:
+            raise ValueError("Expected {} at offset {} of keyvalues2 DMX".format(punctuation.decode(), self._position))
+
+    def _skip_array(self):
+        end = self._data.find(b"]", self._position)
+        if end == -1:
+            raise ValueError("Unterminated array in keyvalues2 DMX")
+        self._position = end + 1
+
+    def _read_element(self, element_type: str) -> Element:
+        self._expect(b"{")
+        element = Element("", element_type)
+        while True:
+            token = self._next()
+            if token == b"}":
+                return element
+            if not isinstance(token, str):
+                raise ValueError("Expected an attribute name at offset {} of keyvalues2 DMX".format(self._position))
+            name, type_name = token, self._expect_string()
+            lower_type = type_name.casefold()
+
+            if name == "id" and lower_type == "elementid":
+                element.uuid = UUID(self._expect_string())
+                self._elements_by_id[element.uuid] = element
+            elif name == "name" and lower_type == "string":
+                element.name = self._expect_string()
+            elif lower_type == "element":
+                uuid = self._expect_string()
+                self._references.append((element, name, UUID(uuid) if uuid else None))
+            elif lower_type == "element_array":
+                self._expect(b"[")
+                values = []
+                while True:
+                    token = self._next()
+                    if token == b"]":
+                        break
+                    elif token == b",":
+                        continue
+                    elif token == "element":
+                        values.append(UUID(self._expect_string()))
+                    else:
+                        # An element written out in full inside the array
+                        values.append(self._read_element(token))
+                self._references.append((element, name, values))
+            elif lower_type == "string_array":
+                self._expect(b"[")
+                values = []
+                while True:
+                    token = self._next()
+                    if token == b"]":
+                        break
+                    elif token != b",":
+                        values.append(token)
+                element[name] = values
+            elif lower_type.endswith("_array"):
+                self._expect(b"[")
+                self._skip_array()
+            elif lower_type == "string":
+                element[name] = self._expect_string()
+            else:
+                try:
+                    attr_type = ValueType(lower_type)
+                except ValueError:
+                    # An element written out in full, with its type in place of a value type
+                    self._references.append((element, name, self._read_element(type_name)))
+                    continue
+                value = self._expect_string()
+                if attr_type is not ValueType.BINARY:
+                    element[name] = Attribute(name, attr_type, TYPE_CONVERT[ValueType.STRING, attr_type](value))
+
+    def _resolve(self, value):
+        if value is None:
+            return NULL
+        elif isinstance(value, Element):
+            return value
+        return self._elements_by_id.get(value) or StubElement.stub(value)
+
+    def read(self) -> Element:
+        elements = []
+        while True:
+            token = self._next()
+            if token is None:
+                break
+            if not isinstance(token, str):
+                raise ValueError("Expected an element type at offset {} of keyvalues2 DMX".format(self._position))
+            elements.append(self._read_element(token))
+
+        for element, name, value in self._references:
+            if isinstance(value, list):
+                element[name] = [self._resolve(v) for v in value]
+            else:
+                element[name] = self._resolve(value)
+
+        if not elements:
+            raise ValueError("No elements in DMX file")
+        return elements[0]
+
+
+def parse_dmx(file, raw_arrays: bool = False) -> tuple[Element, str, int]:
+    # With raw_arrays, binary files are read with RawArrayBinaryDMXReader
+    encoding, encoding_version, format_name, format_version = read_header(file)
+    if encoding == "binary":
+        reader_class = RawArrayBinaryDMXReader if raw_arrays else BinaryDMXReader
+        root = reader_class(file, encoding_version).read()
+    else:
+        file.seek(0)
+        root, format_name, format_version = Element.parse(file)
+    return root, format_name, format_version
+
+
+def parse_dmx_partial(path: str) -> tuple[Element, str, int]:
+    """
+    Like parse_dmx, but leaves out vertex data and any other large arrays. Good for finding out what's in a
+    mesh without the time and memory it takes to load all of it.
+    """
+    with open(path, "rb") as f:
+        encoding, encoding_version, format_name, format_version = read_header(f)
+        if encoding == "binary":
+            root = PartialBinaryDMXReader(f, encoding_version).read()
+        elif encoding == "keyvalues2":
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                root = PartialKV2DMXReader(data, f.tell()).read()
+        else:
+            raise ValueError("Unsupported DMX encoding " + encoding)
+    return root, format_name, format_version
+
+
+def _iter_dags(dag: Element):
+    yield dag
+    if "children" in dag:
+        for child in dag["children"].iter_elem():
+            if child is not NULL and not isinstance(child, StubElement):
+                yield from _iter_dags(child)
+
+
+def get_material_paths(path: str) -> set[str]:
+    # The material of every face set of every mesh in the model, as it was originally exported
+    root, format_name, format_version = parse_dmx_partial(path)
+    paths = set()
+    for dag in _iter_dags(root["model"].val_elem):
+        shape = dag["shape"].val_elem if "shape" in dag else NULL
+        if shape is NULL or isinstance(shape, StubElement) or "faceSets" not in shape:
+            continue
+        for face_set in shape["faceSets"].iter_elem():
+            material = face_set["material"].val_elem
+            if material is not NULL and "mtlName" in material:
+                paths.add(material["mtlName"].val_string.replace("\\", "/"))
+    return paths
+
+
+def _iter_elements(root: Element):
+    seen = set()
+    stack = [root]
+    while stack:
+        element = stack.pop()
+        if id(element) in seen or element is NULL or isinstance(element, StubElement):
+            continue
+        seen.add(id(element))
+        yield element
+        for attribute in element.values():
+            if attribute.type is not ValueType.ELEMENT:
+                continue
+            if attribute.is_array:
+                stack.extend(attribute.iter_elem())
+            else:
+                stack.append(attribute.val_elem)
+
+
+def _rename_vertex_fields(vertex_data: Element):
+    for old_name, new_name in VERTEX_FIELD_NAMES.items():
+        for suffix in "", "Indices":
+            if old_name + suffix in vertex_data:
+                attribute = vertex_data.pop(old_name + suffix)
+                vertex_data[new_name + suffix] = attribute
+
+    if "vertexFormat" in vertex_data:
+        vertex_data["vertexFormat"] = [
+            VERTEX_FIELD_NAMES.get(field, field) for field in vertex_data["vertexFormat"].iter_str()
+        ]
+
+
+def downconvert(root: Element, clear_material_path: bool = True):
+    for element in _iter_elements(root):
+        if element.type == "DmeVertexData":
+            _rename_vertex_fields(element)
+        elif element.type == "DmeMaterial" and clear_material_path:
+            mat_name = element["mtlName"].val_string.replace("\\", "/")
+            element["mtlName"] = os.path.splitext(mat_name.rsplit("/", 1)[-1])[0]
+
+    # studiomdl looks for the skeleton separately, but it's the same DmeModel for a static mesh
+    if "skeleton" not in root and "model" in root:
+        root["skeleton"] = root["model"].val_elem
+
+
+def downconvert_dmx(input_path: str, output_path: str, clear_material_path: bool = True):
+    with open(input_path, "rb") as f:
+        root, format_name, format_version = parse_dmx(f)
+    if format_name != OUTPUT_FORMAT_NAME:
+        raise ValueError("{} is a {} DMX, not a model".format(input_path, format_name))
+
+    downconvert(root, clear_material_path)
+
+    with open(output_path, "wb") as f:
+        root.export_binary(
+            f, version=OUTPUT_ENCODING_VERSION, fmt_name=OUTPUT_FORMAT_NAME, fmt_ver=OUTPUT_FORMAT_VERSION
+        )
+
+
+def split_model(root: Element) -> list[tuple[str, Element]]:
+    # Returns a root for each top-level object of the model, named after it. Everything else about the
+    # model is kept, apart from the joints and base states which belong to the other objects.
+    model = root["model"].val_elem
+    children = [
+        c for c in (model["children"].iter_elem() if "children" in model else ())
+        if c is not NULL and not isinstance(c, StubElement)
+    ]
+    if len(children) < 2:
+        return [(model.name, root)]
+
+    subtrees = [{dag.uuid for dag in _iter_dags(child)} for child in children]
+    parts = []
+    for i, child in enumerate(children):
+        excluded = set().union(*(subtree for j, subtree in enumerate(subtrees) if j != i))
+        # New elements get IDs derived from the object's, so converting the same export gives the same files
+        # It keeps the model's name, since the object is one of its joints and studiomdl matches bones by name
+        part_model = Element(model.name, model.type, uuid5(child.uuid, "model"))
+        for name, attribute in model.items():
+            if name == "name":
+                continue
+            part_model[name] = attribute.copy()
+        part_model["children"] = [child]
+
+        if "jointList" in model:
+            joints = list(model["jointList"].iter_elem())
+            kept = [j for j, joint in enumerate(joints) if joint is NULL or joint.uuid not in excluded]
+            # The model can be a joint of its own, and the old one would drag every other object along with it
+            part_model["jointList"] = [part_model if joints[j] is model else joints[j] for j in kept]
+            if "baseStates" in model:
+                base_states = []
+                for base_state in model["baseStates"].iter_elem():
+                    transforms = list(base_state["transforms"].iter_elem()) if "transforms" in base_state else []
+                    if len(transforms) == len(joints):
+                        # Base state transforms line up with the joints
+                        part_base_state = Element(
+                            base_state.name, base_state.type, uuid5(child.uuid, str(base_state.uuid))
+                        )
+                        for name, attribute in base_state.items():
+                            if name != "name":
+                                part_base_state[name] = attribute.copy()
+                        part_base_state["transforms"] = [transforms[j] for j in kept]
+                        base_state = part_base_state
+                    base_states.append(base_state)
+                part_model["baseStates"] = base_states
+
+        part_root = Element(root.name, root.type, uuid5(child.uuid, "root"))
+        for name, attribute in root.items():
+            if name != "name":
+                part_root[name] = attribute.copy()
+        part_root["model"] = part_model
+        if "skeleton" in root and root["skeleton"].val_elem is model:
+            part_root["skeleton"] = part_model
+        parts.append((child.name, part_root))
+    return parts
+
+
+def downconvert_dmx_split(
+    input_path: str, output_dir: str, mesh_name: str, clear_material_path: bool = True
+) -> list[tuple[str, str]]:
+    # Converts each top-level object to a file of its own, named after the mesh and the object, in one pass.
+    # Returns (object name, path) for each. A model with a single object keeps the mesh's name.
+    with open(input_path, "rb") as f:
+        root, format_name, format_version = parse_dmx(f)
+    if format_name != OUTPUT_FORMAT_NAME:
+        raise ValueError("{} is a {} DMX, not a model".format(input_path, format_name))
+
+    downconvert(root, clear_material_path)
+
+    parts = split_model(root)
+    outputs = []
+    file_names = set()
+    for name, part_root in parts:
+        file_name = mesh_name if len(parts) == 1 else "{}_{}".format(mesh_name, re.sub(r"[^\w.-]", "_", name))
+        while file_name.lower() in file_names:
+            file_name += "_"
+        file_names.add(file_name.lower())
+        output_path = os.path.join(output_dir, file_name + ".dmx")
+        with open(output_path, "wb") as f:
+            part_root.export_binary(
+                f, version=OUTPUT_ENCODING_VERSION, fmt_name=OUTPUT_FORMAT_NAME, fmt_ver=OUTPUT_FORMAT_VERSION
+            )
+        outputs.append((name, output_path))
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path")
+    parser.add_argument("output_path")
+    parser.add_argument(
+        "--clear-material-path", action=argparse.BooleanOptionalAction, default=True
+    )
+    args = parser.parse_args()
+
+    downconvert_dmx(args.input_path, args.output_path, args.clear_material_path)
@@ -0,0 +1,329 @@
+import os, sys, time, errno, struct, select, ctypes
+from typing import Callable
+from . import metrics
+
+"""
+Watches a directory for new or modified files. The operating system's change notifications are used where
+possible (inotify on Linux, ReadDirectoryChangesW on Windows), with os.scandir polling as a fallback.
+Hammer writes exports in several chunks, so a changed file is only reported once its size and modification
+time have stopped changing for the debounce period.
+"""
+
+
+def _file_signature(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _scan(directory: str, recursive: bool) -> dict:
+    signatures = {}
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return signatures
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                if recursive:
+                    signatures.update(_scan(entry.path, recursive))
+            elif entry.is_file():
+                stat = entry.stat()
+                signatures[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            pass  # Deleted while we were looking at it
+    return signatures
+
+
+class PollingBackend:
+    def __init__(self, directory: str, recursive: bool, interval: float):
+        self._directory = directory
+        self._recursive = recursive
+        self._interval = interval
+        self._signatures = _scan(directory, recursive)
+
+    def wait(self, timeout: float = None) -> set[str]:
+        time.sleep(self._interval if timeout is None else min(timeout, self._interval))
+        signatures = _scan(self._directory, self._recursive)
+        changed = {p for p, s in signatures.items() if self._signatures.get(p) != s}
+        self._signatures = signatures
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyBackend:
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    _EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, directory: str, recursive: bool):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._directory = directory
+        self._recursive = recursive
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watch_directories = {}
+        self._add_watch(directory)
+
+    def _add_watch(self, directory: str):
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", directory)
+        self._watch_directories[wd] = directory
+
+        if self._recursive:
+            for entry in os.scandir(directory):
+                if entry.is_dir(follow_symlinks=False):
+                    self._add_subdirectory_watch(entry.path)
+
+    def _add_subdirectory_watch(self, directory: str) -> bool:
+        # A folder can be gone again before we get to it, and there's a limit on the number of watches,
+        # neither of which should stop us watching everything else
+        try:
+            self._add_watch(directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                print("Couldn't watch {} ({})".format(directory, e))
+            return False
+        return True
+
+    def wait(self, timeout: float = None) -> set[str]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        data = os.read(self._fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_length = self._EVENT_HEADER.unpack_from(data, offset)
+            offset += self._EVENT_HEADER.size
+            name = data[offset : offset + name_length].rstrip(b"\0")
+            offset += name_length
+
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were dropped, so we don't know what changed. Watching the tree again picks up any
+                # folders whose events were lost, and files which haven't changed are filtered out later.
+                print("Too many changes at once, rescanning", self._directory)
+                if self._recursive:
+                    self._add_watch(self._directory)
+                changed.update(_scan(self._directory, self._recursive))
+                continue
+            if mask & self.IN_IGNORED:
+                # The folder was deleted
+                self._watch_directories.pop(wd, None)
+                continue
+
+            directory = self._watch_directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & self.IN_ISDIR:
+                if self._recursive and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    if self._add_subdirectory_watch(path):
+                        # Files may have been written before the watch was in place
+                        changed.update(_scan(path, recursive=True))
+            else:
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class WindowsBackend:
+    FILE_LIST_DIRECTORY = 0x0001
+    FILE_SHARE_ALL = 0x00000007
+    OPEN_EXISTING = 3
+    FILE_FLAG_BACKUP_SEMANTICS = 0x02000000
+    FILE_FLAG_OVERLAPPED = 0x40000000
+    FILE_NOTIFY_CHANGE_FILE_NAME = 0x00000001
+    FILE_NOTIFY_CHANGE_SIZE = 0x00000008
+    FILE_NOTIFY_CHANGE_LAST_WRITE = 0x00000010
+    FILE_ACTION_REMOVED = 2
+    FILE_ACTION_RENAMED_OLD_NAME = 4
+    WAIT_OBJECT_0 = 0
+    INFINITE = 0xFFFFFFFF
+    INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+    _NOTIFY_HEADER = struct.Struct("III")
+
+    class OVERLAPPED(ctypes.Structure):
+        _fields_ = [
+            ("Internal", ctypes.c_void_p),
+            ("InternalHigh", ctypes.c_void_p),
+            ("Offset", ctypes.c_uint32),
+            ("OffsetHigh", ctypes.c_uint32),
+            ("hEvent", ctypes.c_void_p),
+        ]
+
+    def __init__(self, directory: str, recursive: bool):
+        from ctypes import wintypes
+
+        self._kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        self._kernel32.CreateFileW.restype = wintypes.HANDLE
+        self._kernel32.CreateEventW.restype = wintypes.HANDLE
+        self._directory = directory
+        self._recursive = recursive
+        self._handle = self._kernel32.CreateFileW(
+            directory,
+            self.FILE_LIST_DIRECTORY,
+            self.FILE_SHARE_ALL,
+            None,
+            self.OPEN_EXISTING,
+            self.FILE_FLAG_BACKUP_SEMANTICS | self.FILE_FLAG_OVERLAPPED,
+            None,
+        )
+        if self._handle == self.INVALID_HANDLE_VALUE:
+            raise ctypes.WinError(ctypes.get_last_error())
+        self._overlapped = self.OVERLAPPED()
+        self._overlapped.hEvent = self._kernel32.CreateEventW(None, True, False, None)
+        self._buffer = ctypes.create_string_buffer(64 * 1024)
+        self._pending_read = False
+
+    def _start_read(self):
+        notify_filter = (
+            self.FILE_NOTIFY_CHANGE_FILE_NAME
+            | self.FILE_NOTIFY_CHANGE_SIZE
+            | self.FILE_NOTIFY_CHANGE_LAST_WRITE
+        )
+        ok = self._kernel32.ReadDirectoryChangesW(
+            ctypes.c_void_p(self._handle),
+            self._buffer,
+            len(self._buffer),
+            self._recursive,
+            notify_filter,
+            None,
+            ctypes.byref(self._overlapped),
+            None,
+        )
+        if not ok:
+            raise ctypes.WinError(ctypes.get_last_error())
+        self._pending_read = True
+
+    def wait(self, timeout: float = None) -> set[str]:
+        if not self._pending_read:
+            self._start_read()
+
+        timeout_ms = self.INFINITE if timeout is None else int(timeout * 1000)
+        if self._kernel32.WaitForSingleObject(ctypes.c_void_p(self._overlapped.hEvent), timeout_ms) != self.WAIT_OBJECT_0:
+            return set()
+
+        transferred = ctypes.c_uint32()
+        self._kernel32.GetOverlappedResult(
+            ctypes.c_void_p(self._handle), ctypes.byref(self._overlapped), ctypes.byref(transferred), False
+        )
+        self._kernel32.ResetEvent(ctypes.c_void_p(self._overlapped.hEvent))
+        self._pending_read = False
+
+        if transferred.value == 0:
+            # The buffer overflowed, so we don't know what changed
+            return set(_scan(self._directory, self._recursive))
+
+        changed = set()
+        data = self._buffer.raw[: transferred.value]
+        offset = 0
+        while True:
+            next_offset, action, name_length = self._NOTIFY_HEADER.unpack_from(data, offset)
+            name_start = offset + self._NOTIFY_HEADER.size
+            name = data[name_start : name_start + name_length].decode("utf-16-le")
+            if action not in (self.FILE_ACTION_REMOVED, self.FILE_ACTION_RENAMED_OLD_NAME):
+                path = os.path.join(self._directory, name)
+                if not os.path.isdir(path):
+                    changed.add(path)
+            if next_offset == 0:
+                break
+            offset += next_offset
+        return changed
+
+    def close(self):
+        self._kernel32.CancelIo(ctypes.c_void_p(self._handle))
+        self._kernel32.CloseHandle(ctypes.c_void_p(self._overlapped.hEvent))
+        self._kernel32.CloseHandle(ctypes.c_void_p(self._handle))
+
+
+def create_backend(directory: str, recursive: bool, interval: float):
+    try:
+        if sys.platform.startswith("linux"):
+            return InotifyBackend(directory, recursive)
+        elif sys.platform == "win32":
+            return WindowsBackend(directory, recursive)
+    except (OSError, AttributeError) as e:
+        print("Couldn't use change notifications ({}), falling back to polling".format(e))
+    return PollingBackend(directory, recursive, interval)
+
+
+class FileWatcher:
+    def __init__(
+        self,
+        directory: str,
+        callback_function: Callable,
+        interval: float = 1.0,
+        recursive: bool = False,
+        debounce: float = 0.5,
+        polling: bool = False,
+    ):
+        self.directory = directory
+        self.callback_function = callback_function
+        self.interval = interval
+        self.recursive = recursive
+        self.debounce = debounce
+        self.polling = polling
+
+        # path -> (size, mtime) when we last reported it
+        self.file_signatures = _scan(self.directory, self.recursive)
+        # path -> (size, mtime, time at which it last changed) for files which are still being written
+        self._pending = {}
+
+    def on_modified(self, file_path, signature):
+        if file_path not in self.file_signatures:
+            print("Adding", file_path)
+        else:
+            print("Updating", file_path)
+        self.file_signatures[file_path] = signature
+        # How long after the file was last written we got round to reporting it
+        mesh_name, _ = os.path.splitext(os.path.basename(file_path))
+        metrics.record("detect", mesh_name, time.time() - signature[1] / 1e9)
+        self.callback_function(file_path)
+
+    def _check_pending(self):
+        now = time.monotonic()
+        for file_path, (signature, changed_at) in list(self._pending.items()):
+            current_signature = _file_signature(file_path)
+            if current_signature is None:
+                del self._pending[file_path]
+            elif current_signature != signature:
+                self._pending[file_path] = current_signature, now
+            elif now - changed_at >= self.debounce:
+                del self._pending[file_path]
+                if current_signature != self.file_signatures.get(file_path):
+                    self.on_modified(file_path, current_signature)
+
+    def start(self):
+        if self.polling:
+            backend = PollingBackend(self.directory, self.recursive, self.interval)
+        else:
+            backend = create_backend(self.directory, self.recursive, self.interval)
+
+        try:
+            while True:
+                # Wake up regularly while files are settling so we notice when they've stopped changing
+                timeout = min(self.debounce / 2, self.interval) if self._pending else None
+                for file_path in backend.wait(timeout):
+                    if file_path not in self._pending:
+                        self._pending[file_path] = _file_signature(file_path), time.monotonic()
+                self._check_pending()
+        finally:
+            backend.close()
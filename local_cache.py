@@ -0,0 +1,18 @@
+import os
+
+"""
+Hammer Minus keeps its caches under %LOCALAPPDATA%\HammerMinus (or ~/.cache/hammer_minus elsewhere).
+Set HAMMER_MINUS_CACHE to put them somewhere else.
+"""
+
+
+def get_cache_dir(*parts: str) -> str:
+    root = os.environ.get("HAMMER_MINUS_CACHE")
+    if not root:
+        if "LOCALAPPDATA" in os.environ:
+            root = os.path.join(os.environ["LOCALAPPDATA"], "HammerMinus")
+        else:
+            root = os.path.join(os.path.expanduser("~"), ".cache", "hammer_minus")
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
@@ -0,0 +1,105 @@
+import os, hashlib
+import numpy as np
+from .local_cache import get_cache_dir
+from .compile_cache import hash_file
+from .mesh_data import MeshData, read_mesh, write_smd, unique_rows
+
+"""
+Generates lower detail versions of a mesh by vertex clustering: the mesh is divided into a grid, every vertex in a
+cell is merged into one, and triangles which collapse as a result are dropped. The cell size is searched for so
+that each LOD ends up with roughly the requested fraction of the original triangles.
+Results are cached by a hash of the source mesh, so an unchanged mesh doesn't get decimated again.
+"""
+
+# Bump this whenever a change here would make previously generated LODs wrong
+LOD_FORMAT_VERSION = 1
+SEARCH_STEPS = 20
+
+
+def _cluster(cells: np.ndarray) -> np.ndarray:
+    # Returns the cluster of each position, given the grid cell it's in
+    cells = cells - cells.min(axis=0)
+    dimensions = cells.max(axis=0) + 1
+    keys = (cells[:, 0] * dimensions[1] + cells[:, 1]) * dimensions[2] + cells[:, 2]
+    _, cluster_ids = np.unique(keys, return_inverse=True)
+    return cluster_ids.reshape(-1)
+
+
+def _surviving_triangles(corners: np.ndarray) -> np.ndarray:
+    return (corners[:, 0] != corners[:, 1]) & (corners[:, 1] != corners[:, 2]) & (corners[:, 0] != corners[:, 2])
+
+
+def decimate(mesh: MeshData, ratio: float) -> MeshData:
+    target = max(1, int(mesh.triangle_count * ratio))
+    # Vertices are split along seams, so cluster the distinct positions rather than every vertex
+    first_vertices, position_ids = unique_rows(mesh.positions)
+    positions = mesh.positions[first_vertices]
+    triangle_positions = position_ids[mesh.triangles]
+    origin = positions.min(axis=0)
+    size = float(np.max(positions.max(axis=0) - origin)) or 1.0
+
+    # Bigger cells mean fewer triangles, so binary search (on a log scale) for the right size
+    low, high = np.log(size * 1e-6), np.log(size)
+    best_cluster_ids = np.arange(len(positions))
+    for _ in range(SEARCH_STEPS):
+        middle = (low + high) / 2
+        cluster_ids = _cluster(np.floor((positions - origin) / np.exp(middle)).astype(np.int64))
+        surviving = np.count_nonzero(_surviving_triangles(cluster_ids[triangle_positions]))
+        if surviving > target:
+            low = middle
+        else:
+            high = middle
+            best_cluster_ids = cluster_ids
+    cluster_ids = best_cluster_ids[position_ids]
+
+    # Each cluster's vertices move to their average position
+    cluster_count = cluster_ids.max() + 1
+    counts = np.bincount(cluster_ids, minlength=cluster_count)[:, None]
+    cluster_positions = np.stack(
+        [np.bincount(cluster_ids, weights=mesh.positions[:, i], minlength=cluster_count) for i in range(3)], axis=1
+    ) / np.maximum(counts, 1)
+
+    keep = _surviving_triangles(cluster_ids[mesh.triangles])
+    triangles = mesh.triangles[keep]
+    triangle_materials = mesh.triangle_materials[keep]
+    # Triangles which have collapsed onto the same three clusters are duplicates
+    cluster_triangles = np.sort(cluster_ids[triangles], axis=1)
+    unique_indices, _ = unique_rows(np.column_stack([cluster_triangles, triangle_materials]))
+    unique_indices.sort()
+    triangles = triangles[unique_indices]
+    triangle_materials = triangle_materials[unique_indices]
+
+    # Normals and texture coordinates stay with their original corners, so UV seams survive
+    used_vertices, new_triangles = np.unique(triangles, return_inverse=True)
+    return MeshData(
+        cluster_positions[cluster_ids[used_vertices]],
+        mesh.normals[used_vertices],
+        mesh.texture_coordinates[used_vertices],
+        new_triangles.reshape(-1, 3),
+        triangle_materials,
+        list(mesh.materials),
+    )
+
+
+def get_lod_cache_path(source_hash: str, ratio: float) -> str:
+    key = hashlib.sha256("{} {} {!r}".format(LOD_FORMAT_VERSION, source_hash, ratio).encode()).hexdigest()
+    return os.path.join(get_cache_dir("lods"), key + ".smd")
+
+
+def generate_lods(source_path: str, ratios: list[float]) -> list[str]:
+    # Returns the path of an SMD for each ratio, which mustn't be modified
+    source_hash = hash_file(source_path).hexdigest()
+    lod_paths = [get_lod_cache_path(source_hash, ratio) for ratio in ratios]
+    missing = [(ratio, path) for ratio, path in zip(ratios, lod_paths) if not os.path.isfile(path)]
+    if not missing:
+        print("Using cached LODs for", source_path)
+        return lod_paths
+
+    mesh = read_mesh(source_path)
+    for ratio, lod_path in missing:
+        # Always decimate the original, so errors don't build up along the chain
+        lod = decimate(mesh, ratio)
+        print("Generated LOD of {} with {} of {} triangles".format(source_path, lod.triangle_count, mesh.triangle_count))
+        write_smd(lod, lod_path)
+    return lod_paths
+
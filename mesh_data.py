@@ -0,0 +1,277 @@
+import os, tempfile
+from dataclasses import dataclass
+import numpy as np
+from srctools.dmx import Element, ValueType, NULL, StubElement
+from .downconvert_dmx import parse_dmx
+
+"""
+Triangle meshes as NumPy arrays, read from DMX or SMD and written back out as SMD, for generating extra meshes
+from a model's source such as LODs and collision models. Only static geometry is supported: bones and weights
+are dropped, and everything is written out attached to a single root bone.
+NumPy is optional for Hammer Minus as a whole, so only import this when it's needed.
+"""
+
+# Source 2 exports use the semantic names, and Source 1 DMX uses the descriptive ones
+POSITION_FIELDS = ("position$0", "positions")
+NORMAL_FIELDS = ("normal$0", "normals")
+TEXTURE_COORDINATE_FIELDS = ("texcoord$0", "textureCoordinates")
+
+# NumPy type, components and the Attribute method to read them with
+_ARRAY_TYPES = {
+    ValueType.INTEGER: ("<i4", 1, "iter_int"),
+    ValueType.FLOAT: ("<f4", 1, "iter_float"),
+    ValueType.VEC2: ("<f4", 2, "iter_vec2"),
+    ValueType.VEC3: ("<f4", 3, "iter_vec3"),
+}
+
+
+@dataclass
+class MeshData:
+    positions: np.ndarray  # (vertices, 3)
+    normals: np.ndarray  # (vertices, 3)
+    texture_coordinates: np.ndarray  # (vertices, 2)
+    triangles: np.ndarray  # (triangles, 3) indices into the vertex arrays
+    triangle_materials: np.ndarray  # (triangles,) indices into materials
+    materials: list[str]
+
+    @property
+    def triangle_count(self) -> int:
+        return len(self.triangles)
+
+    @classmethod
+    def concatenate(cls, meshes: list["MeshData"]) -> "MeshData":
+        materials = []
+        for mesh in meshes:
+            materials.extend(m for m in mesh.materials if m not in materials)
+
+        triangles = []
+        triangle_materials = []
+        offset = 0
+        for mesh in meshes:
+            triangles.append(mesh.triangles + offset)
+            material_map = np.array([materials.index(m) for m in mesh.materials], dtype=np.int32)
+            triangle_materials.append(material_map[mesh.triangle_materials])
+            offset += len(mesh.positions)
+
+        return cls(
+            np.concatenate([m.positions for m in meshes]),
+            np.concatenate([m.normals for m in meshes]),
+            np.concatenate([m.texture_coordinates for m in meshes]),
+            np.concatenate(triangles),
+            np.concatenate(triangle_materials),
+            materials,
+        )
+
+
+def _get_array(element: Element, names: tuple[str, ...], value_type) -> np.ndarray or None:
+    for name in names:
+        if name in element:
+            attribute = element[name]
+            dtype, components, iterator = _ARRAY_TYPES[value_type]
+            if attribute.type is ValueType.BINARY:
+                # Raw bytes from RawArrayBinaryDMXReader
+                values = np.frombuffer(attribute.val_binary, dtype=dtype)
+            elif components == 1:
+                values = np.fromiter(getattr(attribute, iterator)(), dtype=dtype)
+            else:
+                values = np.array([tuple(v) for v in getattr(attribute, iterator)()], dtype=dtype)
+            return values.reshape(-1, components) if components > 1 else values
+    return None
+
+
+def triangulate_faces(faces: np.ndarray) -> np.ndarray:
+    # DmeFaceSet faces are polygons of face-vertex indices, each ended by -1. Each one is split into a fan.
+    if not len(faces):
+        return np.zeros((0, 3), dtype=np.int64)
+    ends = faces == -1
+    polygon_starts = np.flatnonzero(np.concatenate([[True], ends[:-1]]))
+    polygon_ids = np.concatenate([[0], np.cumsum(ends)[:-1]])
+    first = polygon_starts[polygon_ids]
+    corners = np.flatnonzero(~ends & (np.arange(len(faces)) - first >= 2))
+    return np.stack([faces[first[corners]], faces[corners - 1], faces[corners]], axis=1)
+
+
+def _quaternion_matrix(x: float, y: float, z: float, w: float) -> np.ndarray:
+    return np.array(
+        [
+            [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+            [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+            [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)],
+        ]
+    )
+
+
+def _get_transform(dag: Element) -> tuple[np.ndarray, np.ndarray]:
+    rotation, translation = np.identity(3), np.zeros(3)
+    if "transform" in dag and dag["transform"].val_elem is not NULL:
+        transform = dag["transform"].val_elem
+        if "orientation" in transform:
+            q = transform["orientation"].val_quat
+            rotation = _quaternion_matrix(q.x, q.y, q.z, q.w)
+        if "position" in transform:
+            translation = np.array(tuple(transform["position"].val_vec3))
+    return rotation, translation
+
+
+def _read_dmx_shape(shape: Element, rotation: np.ndarray, translation: np.ndarray, clear_material_path: bool):
+    if "currentState" in shape:
+        vertex_data = shape["currentState"].val_elem
+    elif "bindState" in shape and len(shape["bindState"]):
+        vertex_data = next(iter(shape["bindState"].iter_elem()))
+    else:
+        return None
+    positions = _get_array(vertex_data, POSITION_FIELDS, ValueType.VEC3)
+    position_indices = _get_array(vertex_data, tuple(n + "Indices" for n in POSITION_FIELDS), ValueType.INTEGER)
+    if positions is None or position_indices is None:
+        return None
+
+    # Every face-vertex becomes a vertex of its own, which keeps seams in normals and UVs intact
+    mesh_positions = positions[position_indices] @ rotation.T + translation
+
+    normals = _get_array(vertex_data, NORMAL_FIELDS, ValueType.VEC3)
+    normal_indices = _get_array(vertex_data, tuple(n + "Indices" for n in NORMAL_FIELDS), ValueType.INTEGER)
+    mesh_normals = None if normals is None or normal_indices is None else normals[normal_indices] @ rotation.T
+
+    texture_coordinates = _get_array(vertex_data, TEXTURE_COORDINATE_FIELDS, ValueType.VEC2)
+    texture_indices = _get_array(vertex_data, tuple(n + "Indices" for n in TEXTURE_COORDINATE_FIELDS), ValueType.INTEGER)
+    if texture_coordinates is None or texture_indices is None:
+        mesh_texture_coordinates = np.zeros((len(position_indices), 2))
+    else:
+        mesh_texture_coordinates = texture_coordinates[texture_indices].astype(np.float64)
+        # DMX texture coordinates run top to bottom, and SMD ones bottom to top
+        mesh_texture_coordinates[:, 1] = 1 - mesh_texture_coordinates[:, 1]
+
+    materials = []
+    triangles = []
+    triangle_materials = []
+    for face_set in shape["faceSets"].iter_elem():
+        material = face_set["material"].val_elem
+        material_name = material["mtlName"].val_string.replace("\\", "/") if material is not NULL else "default"
+        if clear_material_path:
+            material_name = os.path.splitext(material_name.rsplit("/", 1)[-1])[0]
+        if material_name not in materials:
+            materials.append(material_name)
+        face_triangles = triangulate_faces(_get_array(face_set, ("faces",), ValueType.INTEGER))
+        triangles.append(face_triangles)
+        triangle_materials.append(np.full(len(face_triangles), materials.index(material_name), dtype=np.int32))
+
+    triangles = np.concatenate(triangles) if triangles else np.zeros((0, 3), dtype=np.int64)
+    if mesh_normals is None:
+        mesh_normals = compute_vertex_normals(mesh_positions, triangles)
+    return MeshData(
+        mesh_positions,
+        mesh_normals,
+        mesh_texture_coordinates,
+        triangles,
+        np.concatenate(triangle_materials) if triangle_materials else np.zeros(0, dtype=np.int32),
+        materials,
+    )
+
+
+def read_dmx(path: str, clear_material_path: bool = True) -> MeshData:
+    with open(path, "rb") as f:
+        root, format_name, format_version = parse_dmx(f, raw_arrays=True)
+
+    meshes = []
+    # (DAG node, rotation, translation of its parent)
+    stack = [(root["model"].val_elem, np.identity(3), np.zeros(3))]
+    while stack:
+        dag, parent_rotation, parent_translation = stack.pop()
+        rotation, translation = _get_transform(dag)
+        rotation, translation = parent_rotation @ rotation, parent_rotation @ translation + parent_translation
+
+        shape = dag["shape"].val_elem if "shape" in dag else NULL
+        if shape is not NULL and not isinstance(shape, StubElement) and "faceSets" in shape:
+            mesh = _read_dmx_shape(shape, rotation, translation, clear_material_path)
+            if mesh is not None:
+                meshes.append(mesh)
+        if "children" in dag:
+            for child in dag["children"].iter_elem():
+                if child is not NULL and not isinstance(child, StubElement):
+                    stack.append((child, rotation, translation))
+
+    if not meshes:
+        raise ValueError("No meshes found in " + path)
+    return MeshData.concatenate(meshes)
+
+
+def read_smd(path: str) -> MeshData:
+    from srctools.smd import Mesh
+
+    with open(path, "rb") as f:
+        smd = Mesh.parse_smd(f)
+
+    materials = []
+    triangle_materials = []
+    corners = []
+    for triangle in smd.triangles:
+        if triangle.mat not in materials:
+            materials.append(triangle.mat)
+        triangle_materials.append(materials.index(triangle.mat))
+        for point in triangle.point1, triangle.point2, triangle.point3:
+            corners.append((*point.pos, *point.norm, point.tex_u, point.tex_v))
+
+    corners = np.array(corners, dtype=np.float64).reshape(-1, 8)
+    return MeshData(
+        corners[:, 0:3],
+        corners[:, 3:6],
+        corners[:, 6:8],
+        np.arange(len(corners)).reshape(-1, 3),
+        np.array(triangle_materials, dtype=np.int32),
+        materials,
+    )
+
+
+def read_mesh(path: str, clear_material_path: bool = True) -> MeshData:
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".dmx":
+        return read_dmx(path, clear_material_path)
+    elif extension == ".smd":
+        return read_smd(path)
+    raise ValueError("Can't read meshes from {} files".format(extension))
+
+
+def unique_rows(rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # np.unique(axis=0) is very slow, so sort the rows lexicographically instead.
+    # Returns the index of the first of each distinct row, and which distinct row each row is.
+    order = np.lexsort(rows.T[::-1])
+    sorted_rows = rows[order]
+    starts = np.concatenate([[True], np.any(sorted_rows[1:] != sorted_rows[:-1], axis=1)])
+    group_ids = np.empty(len(rows), dtype=np.int64)
+    group_ids[order] = np.cumsum(starts) - 1
+    return order[starts], group_ids
+
+
+def compute_vertex_normals(positions: np.ndarray, triangles: np.ndarray) -> np.ndarray:
+    corners = positions[triangles]
+    face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    normals = np.zeros_like(positions, dtype=np.float64)
+    for i in range(3):
+        np.add.at(normals, triangles[:, i], face_normals)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    return np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+
+
+def write_smd(mesh: MeshData, path: str, bone_name: str = "root"):
+    # Written to a temporary file first, so nothing ever sees half of it
+    vertex_rows = np.hstack([mesh.positions, mesh.normals, mesh.texture_coordinates])[mesh.triangles.reshape(-1)]
+    vertex_lines = [
+        "0 {:.6f} {:.6f} {:.6f} {:.6f} {:.6f} {:.6f} {:.6f} {:.6f} 1 0 1".format(*row) for row in vertex_rows.tolist()
+    ]
+    lines = ["version 1", "nodes", '0 "{}" -1'.format(bone_name), "end", "skeleton", "time 0", "0 0 0 0 0 0 0", "end"]
+    lines.append("triangles")
+    for i, material_index in enumerate(mesh.triangle_materials.tolist()):
+        lines.append(mesh.materials[material_index])
+        lines.extend(vertex_lines[i * 3 : i * 3 + 3])
+    lines.append("end")
+
+    # Threads can be writing the same file at once, so each gets a temporary file of its own
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".tmp")
+    try:
+        with os.fdopen(handle, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -0,0 +1,154 @@
+import argparse, os, json, time, threading
+from collections import defaultdict
+from contextlib import contextmanager
+from .local_cache import get_cache_dir
+
+"""
+Times each stage of the pipeline, from the watcher noticing an export to the materials being converted.
+Every timing is appended to a log as one JSON object per line, so it can be picked apart later, and the
+recent timings for each stage can be summarised as percentiles with `minus_daemon --stats` or by running
+this module. Once the log gets big, it's trimmed to the most recent timings of each stage.
+"""
+
+METRICS_FILE_NAME = "metrics.jsonl"
+# The order stages happen in, which is also the order they're summarised in
+STAGES = (
+    "detect",
+    "queue",
+    "sanitise",
+    "lod",
+    "collision",
+    "qc",
+    "studiomdl",
+    "remote",
+    "cache_restore",
+    "publish",
+    "materials",
+    "vpk",
+    "total",
+)
+DEFAULT_WINDOW = 200
+# The log is trimmed to the most recent records of each stage once it grows past this size. Keeping more than a
+# window's worth leaves room for failed runs, which summaries skip.
+MAX_METRICS_SIZE = 2 * 1024 * 1024
+RECORDS_KEPT_PER_STAGE = 2 * DEFAULT_WINDOW
+PERCENTILES = (50, 90, 99)
+
+_write_lock = threading.Lock()
+
+
+def get_metrics_path() -> str:
+    return os.path.join(get_cache_dir(), METRICS_FILE_NAME)
+
+
+def record(stage: str, model: str, duration: float, **fields):
+    entry = {"time": time.time(), "stage": stage, "model": model, "duration": round(duration, 4), **fields}
+    line = json.dumps(entry)
+    print("[metrics]", line)
+    with _write_lock:
+        # A single write of a short line, so lines from other processes appending at the same time don't mix
+        with open(get_metrics_path(), "a") as f:
+            f.write(line + "\n")
+            size = f.tell()
+        if size > MAX_METRICS_SIZE:
+            try:
+                trim()
+            except OSError as e:
+                # Another process has it open, most likely, so leave it to the next record
+                print("[metrics] Couldn't trim {} ({})".format(get_metrics_path(), e))
+
+
+def trim(path: str = None, kept_per_stage: int = RECORDS_KEPT_PER_STAGE):
+    # Anything another process appends while this runs is lost, which is only ever a few timings
+    path = path or get_metrics_path()
+    records = load_records(path)
+    counts = defaultdict(int)
+    kept = []
+    for entry in reversed(records):
+        counts[entry.get("stage")] += 1
+        if counts[entry.get("stage")] <= kept_per_stage:
+            kept.append(entry)
+
+    temp_path = "{}.tmp{}.{}".format(path, os.getpid(), threading.get_ident())
+    with open(temp_path, "w") as f:
+        f.writelines(json.dumps(entry) + "\n" for entry in reversed(kept))
+    os.replace(temp_path, path)
+    print("[metrics] Trimmed {} to {} records".format(path, len(kept)))
+
+
+@contextmanager
+def stage(name: str, model: str, **fields):
+    start_time = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        record(name, model, time.perf_counter() - start_time, ok=ok, **fields)
+
+
+def load_records(path: str = None) -> list[dict]:
+    records = []
+    try:
+        with open(path or get_metrics_path()) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Most likely a line that was only half written when a process was killed
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    # Nearest-rank, which is plenty for a few hundred samples
+    index = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarise(records: list[dict], window: int = DEFAULT_WINDOW) -> dict[str, dict]:
+    durations = defaultdict(list)
+    for entry in records:
+        if entry.get("ok", True):
+            durations[entry["stage"]].append(entry["duration"])
+
+    summary = {}
+    for stage_name in sorted(durations, key=lambda s: (STAGES.index(s) if s in STAGES else len(STAGES), s)):
+        values = sorted(durations[stage_name][-window:])
+        summary[stage_name] = {
+            "count": len(values),
+            **{"p{}".format(p): percentile(values, p) for p in PERCENTILES},
+            "max": values[-1],
+        }
+    return summary
+
+
+def print_stats(window: int = DEFAULT_WINDOW):
+    path = get_metrics_path()
+    summary = summarise(load_records(path), window)
+    if not summary:
+        print("No timings recorded yet in", path)
+        return
+
+    headings = ["Stage", "Count"] + ["p{}".format(p) for p in PERCENTILES] + ["Max"]
+    print("Last {} successful runs of each stage, from {}".format(window, path))
+    print("{:<14}{:>7}".format(*headings[:2]) + "".join("{:>10}".format(h) for h in headings[2:]))
+    for stage_name, stats in summary.items():
+        timings = [stats["p{}".format(p)] for p in PERCENTILES] + [stats["max"]]
+        print("{:<14}{:>7}".format(stage_name, stats["count"]) + "".join("{:>9.2f}s".format(t) for t in timings))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarise how long each stage of the pipeline takes")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW, help="Number of recent runs per stage to include")
+    parser.add_argument("--clear", action="store_true", help="Delete the recorded timings")
+    args = parser.parse_args()
+
+    if args.clear:
+        if os.path.exists(get_metrics_path()):
+            os.remove(get_metrics_path())
+        print("Cleared", get_metrics_path())
+    else:
+        print_stats(args.window)
@@ -1,43 +1,25 @@
-import argparse, os, subprocess, time
-from typing import Callable
-from . import crowbar_settings, compile_model
+import argparse, os, subprocess, threading
+from . import crowbar_settings, compile_model, sanitize_dmx, auto_qc, metrics
+from .file_watcher import FileWatcher
+from .compile_scheduler import CompileScheduler
+from .dependency_graph import DependencyGraph
 
 
-class FileWatcher:
-    def __init__(self, directory: str, callback_function: Callable, interval: float = 1.0):
-        self.directory = directory
-        self.callback_function = callback_function
-        self.interval = interval
-        self.file_modification_times = {}
-
-        files = os.listdir(self.directory)
-        for file in files:
-            file_path = os.path.join(self.directory, file)
-            self.file_modification_times[file_path] = os.path.getmtime(file_path)
-
-    def on_modified(self, file_path, mtime):
-        self.file_modification_times[file_path] = mtime
-        self.callback_function(file_path)
-
-    def start(self):
-        while True:
-            files = os.listdir(self.directory)
-
-            for file in files:
-                file_path = os.path.join(self.directory, file)
-                mtime = os.path.getmtime(file_path)
-
-                if file_path not in self.file_modification_times:
-                    print("Adding", file_path)
-                    self.on_modified(file_path, mtime)
-                elif mtime > self.file_modification_times[file_path]:
-                    print("Updating", file_path)
-                    self.on_modified(file_path, mtime)
-
-            time.sleep(self.interval)
-
-
-def main(path, game, addon_path=None, start_mapping_tool=True):
+def main(
+    path,
+    game,
+    addon_path=None,
+    start_mapping_tool=True,
+    blender_workers=1,
+    recursive=False,
+    debounce=0.5,
+    polling=False,
+    jobs=None,
+    convert_materials=True,
+    servers=None,
+    vpk_path=None,
+    preview=False,
+):
     if start_mapping_tool:
         game_setup = crowbar_settings.get_game_setup(game)
         hammer_path = game_setup.get("MappingToolPathFileName")
@@ -46,22 +28,143 @@ def main(path, game, addon_path=None, start_mapping_tool=True):
         else:
             print("Unable to start the mapping tool", hammer_path, "- please check it exists")
 
+    graph = DependencyGraph.build(path, recursive)
+    watched_directories = {os.path.normcase(os.path.abspath(path))}
+    watched_directories_lock = threading.Lock()
+
+    def watch_directory(directory):
+        # Parent materials usually live outside the watched folder, so they get a watcher of their own
+        with watched_directories_lock:
+            key = os.path.normcase(os.path.abspath(directory))
+            if key in watched_directories:
+                return
+            watched_directories.add(key)
+        watcher = FileWatcher(directory, on_new_file, debounce=debounce, polling=polling)
+        threading.Thread(target=watcher.start, daemon=True).start()
+
+    if preview and vpk_path:
+        # The game only reads a VPK when it starts, so there'd be nothing to see
+        print("Previews aren't published into VPKs, so every save gets a full build")
+        preview = False
+
+    def compile_file(file_path, cancel_event, preview=False):
+        # Returns whether a preview left anything out, and so needs a full build after it
+        do_convert_materials = convert_materials and os.path.splitext(file_path)[-1].lower() == ".dmx"
+        parent_materials = compile_model.main(
+            file_path,
+            game,
+            addon_path,
+            do_convert_materials=do_convert_materials,
+            cancel_event=cancel_event,
+            servers=servers,
+            vpk_path=vpk_path,
+            preview=preview,
+        )
+        if preview:
+            return compile_model.needs_full_build(file_path, do_convert_materials, vpk_path)
+        graph.add_dependencies(file_path, parent_materials)
+        for directory in {os.path.dirname(p) for p in parent_materials}:
+            watch_directory(directory)
+        return False
+
+    scheduler = CompileScheduler(compile_file, jobs, preview)
+
     def on_new_file(file_path):
-        if os.path.splitext(file_path)[-1].lower() == ".dmx":
-            compile_model.main(file_path, game, addon_path, do_convert_materials=True)
-        elif os.path.splitext(file_path)[-1].lower() == ".smd":
-            compile_model.main(file_path, game, addon_path)
+        if os.path.basename(file_path).startswith(auto_qc.TEMP_QC_PREFIX):
+            return
+        for target in graph.update(file_path):
+            scheduler.submit(target)
 
-    boy_watcher = FileWatcher(path, on_new_file)
-    boy_watcher.start()
+    if blender_workers > 0:
+        try:
+            sanitize_dmx.start_worker_pool(blender_workers, lazy=auto_qc.sanitise_backend == "native")
+        except RuntimeError as e:
+            # Blender is only a fallback for DMX conversion, so we can carry on without it
+            print(e, "- continuing without Blender workers")
+    try:
+        boy_watcher = FileWatcher(path, on_new_file, recursive=recursive, debounce=debounce, polling=polling)
+        boy_watcher.start()
+    finally:
+        sanitize_dmx.stop_worker_pool()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--path", default=os.getcwd())
     parser.add_argument("--game", default=crowbar_settings.DEFAULT_GAME)
-    parser.add_argument("--addon-path", default=crowbar_settings.compile_output_dir)
+    parser.add_argument("--addon-path", default=None, help="Defaults to Crowbar's compile output folder")
     parser.add_argument("--start-mapping-tool", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument(
+        "--blender-workers",
+        type=int,
+        default=1,
+        help="Blender processes to keep running; with the native DMX backend they're only started if it falls back",
+    )
+    parser.add_argument("--recursive", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--debounce", type=float, default=0.5, help="Seconds a file must stop changing for before it's compiled")
+    parser.add_argument("--poll", action=argparse.BooleanOptionalAction, default=False, help="Poll instead of using change notifications")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of models to compile at once (default: CPU count)")
+    parser.add_argument("--dmx-backend", choices=auto_qc.SANITISE_BACKENDS, default=auto_qc.sanitise_backend)
+    parser.add_argument(
+        "--lods",
+        type=auto_qc.parse_lod,
+        nargs="*",
+        default=[],
+        metavar="RATIO[:SWITCH_POINT]",
+        help="Generate LODs keeping these fractions of the triangles (generated QCs only; needs NumPy)",
+    )
+    parser.add_argument(
+        "--collision",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Generate a collision model by convex decomposition (generated QCs only; needs NumPy)",
+    )
+    parser.add_argument(
+        "--split",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Compile each top-level object of a DMX as a model of its own",
+    )
+    parser.add_argument("--convert-materials", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument(
+        "--preview",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Publish each save without materials, LODs or collision first, then follow up with the full build",
+    )
+    parser.add_argument("--vpk", default=None, help="Publish into this VPK instead of as loose files")
+    parser.add_argument(
+        "--server", action="append", default=[], metavar="HOST:PORT", help="Compile on this compile server (repeatable)"
+    )
+    parser.add_argument("--server-token", default=None, help="Defaults to $HAMMER_MINUS_SERVER_TOKEN")
+    parser.add_argument("--stats", action="store_true", help="Print how long each stage of recent compiles took, then exit")
     args = parser.parse_args()
 
-    main(args.path, args.game, args.addon_path, args.start_mapping_tool)
+    if args.stats:
+        metrics.print_stats()
+        raise SystemExit(0)
+
+    auto_qc.sanitise_backend = args.dmx_backend
+    auto_qc.lods = args.lods
+    auto_qc.collision = args.collision
+    auto_qc.split_meshes = args.split
+    if args.server_token:
+        from . import compile_server
+
+        compile_server.token = args.server_token
+
+    main(
+        args.path,
+        args.game,
+        args.addon_path,
+        args.start_mapping_tool,
+        args.blender_workers,
+        args.recursive,
+        args.debounce,
+        args.poll,
+        args.jobs,
+        args.convert_materials,
+        args.server,
+        args.vpk,
+        args.preview,
+    )
@@ -0,0 +1,250 @@
+import os, threading
+from dataclasses import dataclass, field
+
+"""
+Parses QC files into a tree of commands, following $include and expanding $definevariable the way studiomdl
+does. Results are cached against the modification times of the QC and everything it includes, so unchanged
+QCs aren't parsed again.
+"""
+
+MESH_EXTENSIONS = (".dmx", ".smd")
+# Options which can follow the file name in a one-line $sequence, and so mustn't be mistaken for one
+SEQUENCE_OPTIONS = {
+    "activity", "addlayer", "blend", "blendlayer", "delta", "fadein", "fadeout", "fps", "frame", "hidden",
+    "ikrule", "loop", "node", "numframes", "origin", "predelta", "rotate", "scale", "snap", "subtract", "weightlist",
+}
+
+
+class QCSyntaxError(ValueError):
+    pass
+
+
+@dataclass
+class Token:
+    value: str
+    line: int
+    quoted: bool = False
+
+
+@dataclass
+class QCCommand:
+    name: str
+    args: list[str]
+    path: str
+    line: int
+    quoted: bool = False
+    block: list["QCCommand"] = field(default_factory=list)
+    # The directory $pushd had moved to when this command was read, relative to the QC's directory
+    directory: str = ""
+
+    @property
+    def key(self) -> str:
+        return self.name.lstrip("$").lower()
+
+
+@dataclass
+class ParsedQC:
+    path: str
+    commands: list[QCCommand]
+    included_paths: list[str]
+    variables: dict[str, str]
+
+    def find(self, key: str) -> list[QCCommand]:
+        return [c for c in self.commands if c.key == key]
+
+    def get_value(self, key: str) -> str or None:
+        for command in self.find(key):
+            if command.args:
+                return command.args[0]
+        return None
+
+    def get_values(self, key: str) -> list[str]:
+        return [c.args[0] for c in self.find(key) if c.args]
+
+    @property
+    def mesh_paths(self) -> list[str]:
+        paths = []
+        for command, mesh in self._iter_mesh_references():
+            path = resolve_mesh_path(os.path.join(os.path.dirname(self.path), command.directory, mesh))
+            if path not in paths:
+                paths.append(path)
+        return paths
+
+    def _iter_mesh_references(self):
+        for command in self.commands:
+            key = command.key
+            if key in ("model", "body", "animation") and len(command.args) > 1:
+                yield command, command.args[1]
+            elif key in ("collisionmodel", "collisionjoints") and command.args:
+                yield command, command.args[0]
+            elif key == "sequence":
+                if len(command.args) > 1 and command.args[1].lower() not in SEQUENCE_OPTIONS:
+                    yield command, command.args[1]
+                for entry in command.block:
+                    # In block form, the animation file is the quoted string on its own
+                    if entry.quoted and not entry.name.startswith("$"):
+                        yield command, entry.name
+            elif key == "bodygroup":
+                for entry in command.block:
+                    if entry.key == "studio" and entry.args:
+                        yield command, entry.args[0]
+            elif key == "lod":
+                for entry in command.block:
+                    if entry.key == "replacemodel" and len(entry.args) > 1:
+                        yield command, entry.args[1]
+
+
+def resolve_mesh_path(path: str) -> str:
+    path = os.path.normpath(path)
+    if not os.path.splitext(path)[1]:
+        for extension in MESH_EXTENSIONS:
+            if os.path.isfile(path + extension):
+                return path + extension
+    return path
+
+
+def tokenize(text: str) -> list[Token]:
+    # Newlines are kept as tokens, since they're what separates one command from the next
+    tokens = []
+    line = 1
+    i = 0
+    length = len(text)
+    while i < length:
+        char = text[i]
+        if char == "\n":
+            tokens.append(Token("\n", line))
+            line += 1
+            i += 1
+        elif char.isspace():
+            i += 1
+        elif text.startswith("//", i):
+            end = text.find("\n", i)
+            i = length if end == -1 else end
+        elif text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            if end == -1:
+                raise QCSyntaxError("Unterminated comment on line {}".format(line))
+            line += text.count("\n", i, end)
+            i = end + 2
+        elif char == '"':
+            end = text.find('"', i + 1)
+            if end == -1:
+                raise QCSyntaxError("Unterminated string on line {}".format(line))
+            tokens.append(Token(text[i + 1 : end], line, quoted=True))
+            line += text.count("\n", i, end)
+            i = end + 1
+        elif char in "{}":
+            tokens.append(Token(char, line))
+            i += 1
+        else:
+            start = i
+            while i < length and not text[i].isspace() and text[i] not in '{}"' and not text.startswith("//", i):
+                i += 1
+            tokens.append(Token(text[start:i], line))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, root_path: str):
+        self.root_dir = os.path.dirname(os.path.abspath(root_path))
+        self.variables = {}
+        self.included_paths = []
+        self.directory_stack = [""]
+
+    def expand(self, value: str) -> str:
+        # Variables are referenced as $name$
+        if "$" in value:
+            for name, replacement in self.variables.items():
+                value = value.replace("${}$".format(name), replacement)
+        return value
+
+    def parse_file(self, path: str) -> list[QCCommand]:
+        with open(path) as f:
+            tokens = tokenize(f.read())
+        commands, end = self.parse_block(tokens, 0, path, top_level=True)
+        return commands
+
+    def parse_block(self, tokens: list[Token], i: int, path: str, top_level: bool = False):
+        commands = []
+        while i < len(tokens):
+            token = tokens[i]
+            if token.value == "\n" and not token.quoted:
+                i += 1
+                continue
+            if token.value == "}" and not token.quoted:
+                if top_level:
+                    raise QCSyntaxError("{}:{}: unexpected }}".format(path, token.line))
+                return commands, i + 1
+            if token.value == "{" and not token.quoted:
+                # A block on its own line belongs to the command before it
+                if not commands:
+                    raise QCSyntaxError("{}:{}: block without a command".format(path, token.line))
+                block, i = self.parse_block(tokens, i + 1, path)
+                commands[-1].block.extend(block)
+                continue
+
+            command = QCCommand(
+                self.expand(token.value), [], path, token.line, token.quoted, directory=self.directory_stack[-1]
+            )
+            i += 1
+            while i < len(tokens) and (tokens[i].quoted or tokens[i].value not in ("\n", "{", "}")):
+                command.args.append(self.expand(tokens[i].value))
+                i += 1
+            if i < len(tokens) and tokens[i].value == "{" and not tokens[i].quoted:
+                command.block, i = self.parse_block(tokens, i + 1, path)
+
+            commands.extend(self.handle(command))
+        if not top_level:
+            raise QCSyntaxError("{}: unterminated block".format(path))
+        return commands, i
+
+    def handle(self, command: QCCommand) -> list[QCCommand]:
+        key = command.key
+        if key == "definevariable" and len(command.args) >= 2:
+            self.variables[command.args[0]] = command.args[1]
+        elif key == "pushd" and command.args:
+            self.directory_stack.append(os.path.normpath(os.path.join(self.directory_stack[-1], command.args[0])))
+        elif key == "popd":
+            if len(self.directory_stack) > 1:
+                self.directory_stack.pop()
+        elif key == "include" and command.args:
+            include_path = os.path.join(self.root_dir, self.directory_stack[-1], command.args[0])
+            if not os.path.isfile(include_path):
+                # studiomdl also looks relative to the file doing the including
+                include_path = os.path.join(os.path.dirname(command.path), command.args[0])
+            include_path = os.path.normpath(include_path)
+            self.included_paths.append(include_path)
+            return self.parse_file(include_path)
+        return [command]
+
+
+_parse_cache = {}
+_parse_cache_lock = threading.Lock()
+
+
+def _get_signature(paths: list[str]) -> tuple:
+    signature = []
+    for path in paths:
+        try:
+            signature.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def parse_qc(path: str) -> ParsedQC:
+    path = os.path.abspath(path)
+    with _parse_cache_lock:
+        cached = _parse_cache.get(path)
+    if cached is not None:
+        signature, parsed_qc = cached
+        if _get_signature([path] + parsed_qc.included_paths) == signature:
+            return parsed_qc
+
+    parser = _Parser(path)
+    commands = parser.parse_file(path)
+    parsed_qc = ParsedQC(path, commands, parser.included_paths, parser.variables)
+    signature = _get_signature([path] + parsed_qc.included_paths)
+    with _parse_cache_lock:
+        _parse_cache[path] = signature, parsed_qc
+    return parsed_qc
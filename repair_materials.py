@@ -0,0 +1,174 @@
+import argparse, os, itertools, hashlib
+from concurrent.futures import ProcessPoolExecutor
+from srctools.filesys import RawFileSystem
+from srctools.mdl import Model
+from . import crowbar_settings, vpk_publish
+from .auto_qc import SHARED_CDMATERIALS
+from .convert_materials import (
+    MaterialIndex,
+    get_game_filesystem,
+    get_material_index,
+    get_converted_material_cache,
+    find_material_dir,
+    convert_material,
+)
+
+"""
+Finds every model in an addon whose skins use materials which don't exist, and converts a parent material for
+each one, like compile_model does for a model it's just compiled. That's for models compiled before their
+materials were, or whose converted materials have since been lost.
+Without the mesh a model was compiled from, a parent material is found by its file name anywhere in the game's
+filesystem. Materials are converted in parallel across a process pool, and what was fixed and what couldn't
+be is reported at the end.
+"""
+
+
+def find_models(addon_path: str) -> list[str]:
+    # Relative to the addon, like paths in the game's filesystem
+    models = []
+    for dir_path, dir_names, file_names in os.walk(os.path.join(addon_path, "models")):
+        # Hidden folders are where files are staged while they're being published
+        dir_names[:] = sorted(d for d in dir_names if not d.startswith("."))
+        for file_name in sorted(file_names):
+            if file_name.lower().endswith(".mdl"):
+                models.append(os.path.relpath(os.path.join(dir_path, file_name), addon_path).replace(os.sep, "/"))
+    return models
+
+
+def get_output_dir(model: Model) -> str or None:
+    # Where compile_model would have put the model's converted materials
+    model_dirs = [d.replace("\\", "/").strip("/") for d in model.cdmaterials]
+    if SHARED_CDMATERIALS.lower() in (d.lower() for d in model_dirs):
+        return SHARED_CDMATERIALS
+    return model_dirs[0] if model_dirs else None
+
+
+def find_missing_materials(addon_path: str, game: str) -> tuple[dict[str, set[str]], list[str]]:
+    # Returns the path of each missing material -> the models which use it, and the models which couldn't be read
+    filesystem = get_game_filesystem(game)
+    material_index = get_material_index(game)
+    addon = RawFileSystem(addon_path)
+
+    missing = {}
+    unreadable = []
+    model_paths = find_models(addon_path)
+    print("Checking the materials of", len(model_paths), "models in", addon_path)
+    for model_path in model_paths:
+        try:
+            model = Model(filesystem, addon[model_path])
+        except Exception as e:
+            print("Couldn't read {} ({})".format(model_path, e))
+            unreadable.append(model_path)
+            continue
+        output_dir = get_output_dir(model)
+        if output_dir is None:
+            print(model_path, "has no $cdmaterials")
+            unreadable.append(model_path)
+            continue
+
+        for mat_name in set(itertools.chain(*model.skins)):
+            if find_material_dir(material_index, model, mat_name) is None:
+                mat_path = "/".join(["materials", output_dir, mat_name.replace("\\", "/") + ".vmt"])
+                missing.setdefault(mat_path, set()).add(model_path)
+    return missing, unreadable
+
+
+def find_parent(material_index: MaterialIndex, mat_path: str, output_dirs: set[str]) -> str or None:
+    # Anything in a folder converted materials go into has most likely been converted already, so the
+    # original is preferred, and then whichever is nearest the top of the materials folder
+    candidates = [p for p in material_index.find_by_name(mat_path) if p != mat_path.lower()]
+    if not candidates:
+        return None
+
+    def rank(path: str):
+        return os.path.dirname(path)[len("materials/") :] in output_dirs, path.count("/"), path
+
+    return min(candidates, key=rank)
+
+
+def _write_material(output_path: str, parent_contents: str) -> str:
+    # Runs in a worker process
+    new_mat_contents = convert_material(parent_contents)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w") as f:
+        f.write(new_mat_contents)
+    return output_path
+
+
+def print_report(fixed: dict[str, str], orphans: dict[str, set[str]], missing: dict[str, set[str]], dry_run: bool):
+    print()
+    print("{} {} materials:".format("Would fix" if dry_run else "Fixed", len(fixed)))
+    for mat_path, parent_path in sorted(fixed.items()):
+        print("  {} <- {} ({} models)".format(mat_path, parent_path, len(missing[mat_path])))
+    if orphans:
+        print("No parent material for {} materials:".format(len(orphans)))
+        for mat_path, model_paths in sorted(orphans.items()):
+            print("  {} (used by {})".format(mat_path, ", ".join(sorted(model_paths))))
+
+
+def main(
+    addon_path: str = None,
+    game=crowbar_settings.DEFAULT_GAME,
+    jobs: int = None,
+    dry_run: bool = False,
+    vpk_path: str = None,
+) -> bool:
+    # Returns whether every missing material could be fixed
+    if vpk_path:
+        addon_path = vpk_publish.get_staging_dir(vpk_path)
+    addon_path = addon_path or crowbar_settings.compile_output_dir
+    if not addon_path or not os.path.isdir(addon_path):
+        raise ValueError("Addon path", addon_path, "does not exist")
+
+    missing, unreadable = find_missing_materials(addon_path, game)
+    filesystem = get_game_filesystem(game)
+    material_index = get_material_index(game)
+    cache = get_converted_material_cache()
+    output_dirs = {os.path.dirname(p)[len("materials/") :].lower() for p in missing}
+
+    # Parents are read here, since that needs the game's filesystem, and only parsing and writing is farmed out
+    fixed = {}
+    orphans = {}
+    conversions = []
+    for mat_path in sorted(missing):
+        parent_path = find_parent(material_index, mat_path, output_dirs)
+        if parent_path is None:
+            orphans[mat_path] = missing[mat_path]
+            continue
+        fixed[mat_path] = parent_path
+        if not dry_run:
+            parent_contents = filesystem[parent_path].open_str().read()
+            parent_hash = hashlib.sha256(parent_contents.encode()).hexdigest()
+            conversions.append((mat_path, parent_path, parent_hash, parent_contents))
+
+    if conversions:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(_write_material, os.path.join(addon_path, mat_path), parent_contents)
+                for mat_path, _, _, parent_contents in conversions
+            ]
+            for (mat_path, parent_path, parent_hash, _), future in zip(conversions, futures):
+                output_path = future.result()
+                print("Wrote new material", output_path)
+                cache.record(output_path, parent_path, parent_hash)
+                material_index.add(mat_path)
+        if vpk_path:
+            vpk_publish.pack(addon_path, vpk_path)
+
+    print_report(fixed, orphans, missing, dry_run)
+    if unreadable:
+        print("Couldn't check {} models: {}".format(len(unreadable), ", ".join(unreadable)))
+    return not orphans
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert missing materials for every model in an addon")
+    parser.add_argument("--addon-path", default=None, help="Defaults to Crowbar's compile output folder")
+    parser.add_argument("--game", default=crowbar_settings.DEFAULT_GAME)
+    parser.add_argument("--jobs", type=int, default=None, help="Number of materials to convert at once (default: CPU count)")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what's missing")
+    parser.add_argument("--vpk", default=None, help="Check and fix what's been published into this VPK instead")
+    args = parser.parse_args()
+
+    success = main(args.addon_path, args.game, args.jobs, args.dry_run, args.vpk)
+    raise SystemExit(0 if success else 1)
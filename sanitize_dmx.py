@@ -1,10 +1,25 @@
-import argparse, os, sys, subprocess
+import argparse, os, sys, subprocess, socket, threading, queue, json, secrets, traceback
+from multiprocessing.connection import Connection
 
+"""
+This script runs both inside and outside of Blender, so it must only import from the standard library
+at module level. Outside of Blender, a pool of background Blender workers can be started so that each
+sanitise job doesn't pay for Blender's startup and addon registration.
+"""
 
-def external_sanitize_dmx(
-    input_path: str, output_path: str, engine_path: str = None, clear_material_path: bool = True
-):
-    cmd_list = [
+WORKER_TOKEN_VARIABLE = "HAMMER_MINUS_WORKER_TOKEN"
+WORKER_STARTUP_TIMEOUT = 120.0
+# Longer than any real mesh should take, so a worker that gets this far has hung
+WORKER_JOB_TIMEOUT = 600.0
+
+_worker_pool = None
+# Workers to start the first time Blender is actually needed, since the native backend rarely falls back to it
+_lazy_pool_size = 0
+_worker_pool_lock = threading.Lock()
+
+
+def _blender_command(*script_args: str) -> list[str]:
+    return [
         "blender",
         "-b",  # background
         "--python-use-system-env",
@@ -14,9 +29,19 @@ def external_sanitize_dmx(
         "--python",
         __file__,
         "--",
-        input_path,
-        output_path,
+        *script_args,
     ]
+
+
+def external_sanitize_dmx(
+    input_path: str, output_path: str, engine_path: str = None, clear_material_path: bool = True
+):
+    worker_pool = _get_worker_pool()
+    if worker_pool is not None:
+        worker_pool.sanitize(input_path, output_path, engine_path, clear_material_path)
+        return
+
+    cmd_list = _blender_command(input_path, output_path)
     if engine_path:
         cmd_list.append("--engine-path")
         cmd_list.append(engine_path)
@@ -25,6 +50,221 @@ def external_sanitize_dmx(
     subprocess.run(cmd_list).check_returncode()
 
 
+class BlenderWorkerTimeout(RuntimeError):
+    pass
+
+
+class BlenderWorker:
+    def __init__(self):
+        server = socket.create_server(("127.0.0.1", 0))
+        server.settimeout(WORKER_STARTUP_TIMEOUT)
+        token = secrets.token_hex(16)
+        env = dict(os.environ)
+        env[WORKER_TOKEN_VARIABLE] = token
+        address = "{}:{}".format(*server.getsockname())
+        self._process = subprocess.Popen(_blender_command("--serve", address), env=env)
+
+        try:
+            sock, _ = server.accept()
+        except socket.timeout:
+            self._process.kill()
+            raise RuntimeError("Blender worker didn't connect within {} seconds".format(WORKER_STARTUP_TIMEOUT))
+        finally:
+            server.close()
+
+        sock.settimeout(None)
+        self._connection = Connection(sock.detach())
+        if self._connection.recv_bytes().decode() != token:
+            self.close()
+            raise RuntimeError("Unexpected connection while waiting for a Blender worker")
+        print("Started Blender worker", self._process.pid)
+
+    @property
+    def alive(self) -> bool:
+        return self._process.poll() is None
+
+    def run(self, job: dict, timeout: float = None):
+        self._connection.send_bytes(json.dumps(job).encode())
+        if timeout is not None and not self._connection.poll(timeout):
+            raise BlenderWorkerTimeout(
+                "Blender worker took more than {} seconds to sanitise {}".format(timeout, job["input_path"])
+            )
+        reply = json.loads(self._connection.recv_bytes())
+        if not reply["ok"]:
+            raise RuntimeError("Blender worker failed to sanitise {}:\n{}".format(job["input_path"], reply["error"]))
+
+    def close(self):
+        self._connection.close()
+        try:
+            self._process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+
+    def kill(self):
+        self._process.kill()
+        self.close()
+
+
+class BlenderWorkerPool:
+    def __init__(self, size: int = 1, job_timeout: float = WORKER_JOB_TIMEOUT):
+        self._job_timeout = job_timeout
+        # Holds None for a slot whose worker couldn't be restarted, so the next job tries again
+        self._idle_workers = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+        # Blender takes a while to start, so bring the workers up side by side
+        threads = [threading.Thread(target=self._add_worker) for _ in range(size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if not self._workers:
+            raise RuntimeError("Couldn't start any Blender workers")
+
+    def _add_worker(self):
+        try:
+            worker = BlenderWorker()
+        except (OSError, RuntimeError) as e:
+            print("Unable to start a Blender worker:", e)
+            return
+        with self._lock:
+            self._workers.append(worker)
+        self._idle_workers.put(worker)
+
+    def _replace_worker(self, worker: BlenderWorker or None, kill: bool = False) -> BlenderWorker:
+        # The old worker is out of the pool even if a new one can't be started
+        if worker is not None:
+            print("Restarting Blender worker", worker._process.pid)
+            with self._lock:
+                if worker in self._workers:
+                    self._workers.remove(worker)
+            if kill:
+                worker.kill()
+            else:
+                worker.close()
+        new_worker = BlenderWorker()
+        with self._lock:
+            self._workers.append(new_worker)
+        return new_worker
+
+    def sanitize(
+        self, input_path: str, output_path: str, engine_path: str = None, clear_material_path: bool = True
+    ):
+        job = {
+            "input_path": input_path,
+            "output_path": output_path,
+            "engine_path": engine_path,
+            "clear_material_path": clear_material_path,
+        }
+        worker = self._idle_workers.get()
+        try:
+            if worker is None or not worker.alive:
+                worker = self._replace_worker(worker)
+            try:
+                try:
+                    worker.run(job, self._job_timeout)
+                except (EOFError, OSError):
+                    # The worker crashed mid-job; give the job one more go on a fresh worker
+                    worker = self._replace_worker(worker)
+                    try:
+                        worker.run(job, self._job_timeout)
+                    except (EOFError, OSError):
+                        raise RuntimeError("Blender worker crashed while sanitising {}".format(input_path))
+            except BlenderWorkerTimeout:
+                # It's hung, and would most likely hang on the same job again, so don't retry. It can't stay in
+                # the pool either, or its reply would go to the next job.
+                worker = self._replace_worker(worker, kill=True)
+                raise
+        finally:
+            # A worker that was taken out of the pool and not replaced leaves its slot empty
+            with self._lock:
+                self._idle_workers.put(worker if worker in self._workers else None)
+
+    def close(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.close()
+
+
+def start_worker_pool(size: int = 1, lazy: bool = False) -> BlenderWorkerPool or None:
+    # A lazy pool is only started when the first job needs it
+    global _worker_pool, _lazy_pool_size
+    with _worker_pool_lock:
+        if lazy:
+            _lazy_pool_size = size
+        elif _worker_pool is None:
+            _worker_pool = BlenderWorkerPool(size)
+        return _worker_pool
+
+
+def _get_worker_pool() -> BlenderWorkerPool or None:
+    global _worker_pool, _lazy_pool_size
+    with _worker_pool_lock:
+        if _worker_pool is None and _lazy_pool_size > 0:
+            size, _lazy_pool_size = _lazy_pool_size, 0
+            print("Starting Blender workers for the first job which needs them")
+            try:
+                _worker_pool = BlenderWorkerPool(size)
+            except RuntimeError as e:
+                print(e, "- running Blender for each job instead")
+        return _worker_pool
+
+
+def stop_worker_pool():
+    global _worker_pool, _lazy_pool_size
+    with _worker_pool_lock:
+        _lazy_pool_size = 0
+        if _worker_pool is not None:
+            _worker_pool.close()
+            _worker_pool = None
+
+
+def reset_scene():
+    import bpy
+
+    data_collections = [
+        bpy.data.objects,
+        bpy.data.meshes,
+        bpy.data.materials,
+        bpy.data.armatures,
+        bpy.data.actions,
+        bpy.data.images,
+        bpy.data.collections,
+    ]
+    for data_collection in data_collections:
+        for block in list(data_collection):
+            data_collection.remove(block)
+
+
+def serve(address: str):
+    import bpy
+
+    host, port = address.rsplit(":", 1)
+    sock = socket.create_connection((host, int(port)))
+    connection = Connection(sock.detach())
+    connection.send_bytes(os.environ[WORKER_TOKEN_VARIABLE].encode())
+
+    # Importing a mesh can change the material path, so put it back before each job
+    default_material_path = bpy.context.scene.vs.material_path
+
+    while True:
+        try:
+            job = json.loads(connection.recv_bytes())
+        except EOFError:
+            break
+
+        try:
+            reset_scene()
+            bpy.context.scene.vs.material_path = default_material_path
+            main(**job)
+            reply = {"ok": True}
+        except Exception:
+            reply = {"ok": False, "error": traceback.format_exc()}
+        connection.send_bytes(json.dumps(reply).encode())
+
+
 def main(
     input_path: str, output_path: str, engine_path: str = None, clear_material_path: bool = True
 ):
@@ -55,6 +295,10 @@ if __name__ == "__main__":
     argv = sys.argv
     argv = argv[argv.index("--") + 1 :]
 
+    if argv and argv[0] == "--serve":
+        serve(argv[1])
+        sys.exit(0)
+
     parser = argparse.ArgumentParser()
     parser.add_argument("input_path")
     parser.add_argument("output_path")
@@ -0,0 +1,41 @@
+import unittest
+from srctools.dmx import Element
+from hammer_minus.downconvert_dmx import split_model
+
+
+def build_root() -> Element:
+    # Two top-level objects, one with a child of its own, under a model which is also a joint
+    model = Element("exportroot", "DmeModel")
+    box_a = Element("Box A", "DmeDag")
+    box_b = Element("box", "DmeDag")
+    box_b_child = Element("box/b", "DmeDag")
+    box_b["children"] = [box_b_child]
+    model["children"] = [box_a, box_b]
+    model["jointList"] = [model, box_a, box_b, box_b_child]
+
+    root = Element("root", "DmElement")
+    root["model"] = model
+    root["skeleton"] = model
+    return root
+
+
+class SplitModelTest(unittest.TestCase):
+    def test_part_names(self):
+        parts = split_model(build_root())
+        self.assertEqual([name for name, _ in parts], ["Box A", "box"])
+
+    def test_joint_names_are_unique(self):
+        for name, part_root in split_model(build_root()):
+            joint_names = [joint.name for joint in part_root["model"].val_elem["jointList"].iter_elem()]
+            self.assertEqual(len(joint_names), len(set(joint_names)), name)
+            self.assertEqual(joint_names[0], "exportroot")
+
+    def test_model_is_its_own_joint(self):
+        for name, part_root in split_model(build_root()):
+            part_model = part_root["model"].val_elem
+            self.assertIs(next(part_model["jointList"].iter_elem()), part_model)
+            self.assertIs(part_root["skeleton"].val_elem, part_model)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,226 @@
+import argparse, os, json, time, hashlib, threading, contextlib
+from srctools.vpk import VPK, get_arch_filename
+from .local_cache import get_cache_dir
+
+"""
+Publishes compiled models and converted materials into a VPK rather than as loose files, which the game and
+Hammer find much faster once there are a lot of them.
+Everything is published loose into a staging folder first, as it would be into an addon, and the VPK is then
+brought in line with it. Only files whose size or modification time changed since the last pack are read,
+only those whose CRC changed are written, and the new data is appended to the archives, so a save costs about
+as much as the files that changed. Replaced data is left behind in the archives until enough of it builds up,
+when the VPK is rebuilt from the staging folder.
+The game reads a VPK's directory when it starts, so models in one don't hotload: keep publishing loose files
+while working on a map, and use a VPK for everything that's settled.
+"""
+
+MANIFEST_NAME = "vpk_manifest.json"
+# Same as Valve's tools, so no archive gets unwieldy
+ARCHIVE_SIZE_LIMIT = 200 * 1024 * 1024
+# Rebuild once more than this fraction of the archives is replaced data, if that's more than the minimum
+COMPACT_FRACTION = 0.5
+COMPACT_MIN_SIZE = 16 * 1024 * 1024
+LOCK_TIMEOUT = 300.0
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def normalise_vpk_path(path: str) -> str:
+    # Multi-chunk VPKs are named after their directory file, pak01_dir.vpk
+    path = os.path.abspath(path)
+    if not path.lower().endswith("_dir.vpk"):
+        path = (path[:-4] if path.lower().endswith(".vpk") else path) + "_dir.vpk"
+    return path
+
+
+def get_staging_dir(vpk_path: str) -> str:
+    # Kept for good, since it's what the VPK gets rebuilt from
+    key = hashlib.sha256(os.path.normcase(normalise_vpk_path(vpk_path)).encode()).hexdigest()[:16]
+    return get_cache_dir("vpk", key)
+
+
+@contextlib.contextmanager
+def _lock(vpk_path: str):
+    # Compiles run in several threads and, with batch_compile, several processes at once
+    with _thread_locks_lock:
+        thread_lock = _thread_locks.setdefault(vpk_path, threading.Lock())
+    lock_dir = vpk_path + ".lock"
+    with thread_lock:
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while True:
+            try:
+                os.mkdir(lock_dir)
+                break
+            except FileExistsError:
+                if time.monotonic() > deadline:
+                    # Whatever held it must have died
+                    print("Taking over stale lock", lock_dir)
+                    break
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            try:
+                os.rmdir(lock_dir)
+            except OSError:
+                pass
+
+
+def _read_manifest(staging_dir: str) -> dict:
+    try:
+        with open(os.path.join(staging_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_manifest(staging_dir: str, manifest: dict):
+    manifest_path = os.path.join(staging_dir, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def _scan(staging_dir: str) -> dict[str, list]:
+    # Path relative to the staging folder -> [size, mtime] of every staged file
+    files = {}
+    for dir_path, dir_names, file_names in os.walk(staging_dir):
+        # Leave out files that are still being published, which are staged in hidden folders of their own
+        dir_names[:] = [d for d in dir_names if not d.startswith(".")]
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            relative_path = os.path.relpath(path, staging_dir).replace(os.sep, "/")
+            if relative_path == MANIFEST_NAME:
+                continue
+            stat = os.stat(path)
+            files[relative_path] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+def _write_dirfile(vpk: VPK):
+    # Written beside it and swapped in, so the game never sees half of a directory
+    dir_path = vpk.path
+    vpk._filename = os.path.basename(dir_path) + ".tmp"
+    try:
+        vpk.write_dirfile()
+    finally:
+        vpk._filename = os.path.basename(dir_path)
+    os.replace(dir_path + ".tmp", dir_path)
+
+
+def _archive_sizes(vpk: VPK) -> tuple[int, int]:
+    # (bytes in the archives, bytes in them which are still used)
+    prefix = vpk.path[: -len("_dir.vpk")]
+    used = {}
+    for info in vpk:
+        if info.arch_index is not None and info.arch_len:
+            used[info.arch_index] = used.get(info.arch_index, 0) + info.arch_len
+    total = 0
+    for index in used:
+        try:
+            total += os.path.getsize(get_arch_filename(prefix, index))
+        except OSError:
+            pass
+    return total, sum(used.values())
+
+
+def _current_archive(vpk: VPK) -> int:
+    prefix = vpk.path[: -len("_dir.vpk")]
+    index = max((info.arch_index for info in vpk if info.arch_index is not None), default=0)
+    archive_path = get_arch_filename(prefix, index)
+    if os.path.isfile(archive_path) and os.path.getsize(archive_path) > ARCHIVE_SIZE_LIMIT:
+        index += 1
+    return index
+
+
+def _rebuild(vpk_path: str, staging_dir: str, files: dict[str, list]):
+    print("Rebuilding", vpk_path)
+    prefix = vpk_path[: -len("_dir.vpk")]
+    temp_prefix = prefix + "_rebuild"
+    vpk = VPK(temp_prefix + "_dir.vpk", mode="w")
+    archive_size = 0
+    arch_index = 0
+    for relative_path in sorted(files):
+        with open(os.path.join(staging_dir, relative_path), "rb") as f:
+            data = f.read()
+        if archive_size > ARCHIVE_SIZE_LIMIT:
+            arch_index += 1
+            archive_size = 0
+        vpk.add_file(relative_path.lower(), data, arch_index=arch_index)
+        archive_size += len(data)
+    vpk.write_dirfile()
+
+    # The archives have to be in place before the directory which points into them
+    for index in range(arch_index + 1):
+        if os.path.isfile(get_arch_filename(temp_prefix, index)):
+            os.replace(get_arch_filename(temp_prefix, index), get_arch_filename(prefix, index))
+    os.replace(temp_prefix + "_dir.vpk", vpk_path)
+    index = arch_index + 1
+    while os.path.isfile(get_arch_filename(prefix, index)):
+        os.remove(get_arch_filename(prefix, index))
+        index += 1
+
+
+def pack(staging_dir: str, vpk_path: str) -> int:
+    # Brings the VPK up to date with the staging folder. Returns the number of files written.
+    vpk_path = normalise_vpk_path(vpk_path)
+    os.makedirs(os.path.dirname(vpk_path), exist_ok=True)
+    with _lock(vpk_path):
+        manifest = _read_manifest(staging_dir)
+        files = _scan(staging_dir)
+        if manifest.get("vpk") != vpk_path or not os.path.isfile(vpk_path):
+            # Never packed into this VPK before, so it all needs checking
+            manifest = {"vpk": vpk_path, "files": {}}
+        changed = [p for p, stat in files.items() if manifest["files"].get(p) != stat]
+        removed = [p for p in manifest["files"] if p not in files]
+        if not changed and not removed:
+            print(vpk_path, "is up to date")
+            return 0
+
+        vpk = VPK(vpk_path, mode="a")
+        arch_index = _current_archive(vpk)
+        written = 0
+        for relative_path in changed:
+            with open(os.path.join(staging_dir, relative_path), "rb") as f:
+                data = f.read()
+            # The game looks files up case-insensitively, by their lowercase names
+            vpk_name = relative_path.lower()
+            if vpk_name in vpk:
+                # Does nothing if the CRC is the same, which it is when a model comes back from the cache
+                info = vpk[vpk_name]
+                crc = info.crc
+                info.write(data, arch_index)
+                written += info.crc != crc
+            else:
+                vpk.add_file(vpk_name, data, arch_index=arch_index)
+                written += 1
+        for relative_path in removed:
+            if relative_path.lower() in vpk and relative_path.lower() not in {p.lower() for p in files}:
+                del vpk[relative_path.lower()]
+        _write_dirfile(vpk)
+        print("Packed {} changed files into {}".format(written, vpk_path))
+
+        total, used = _archive_sizes(vpk)
+        if total - used > max(COMPACT_MIN_SIZE, total * COMPACT_FRACTION):
+            _rebuild(vpk_path, staging_dir, files)
+
+        manifest["files"] = files
+        _write_manifest(staging_dir, manifest)
+        return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bring a VPK up to date with what's been published into it")
+    parser.add_argument("vpk_path")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild it from scratch, dropping replaced data")
+    args = parser.parse_args()
+
+    vpk_path = normalise_vpk_path(args.vpk_path)
+    staging_dir = get_staging_dir(vpk_path)
+    if args.rebuild:
+        with _lock(vpk_path):
+            _rebuild(vpk_path, staging_dir, _scan(staging_dir))
+            _write_manifest(staging_dir, {"vpk": vpk_path, "files": _scan(staging_dir)})
+    else:
+        pack(staging_dir, vpk_path)